@@ -1,145 +1,204 @@
-import sqlite3
+import base64
 import os
+import io
+import csv
+import gzip
+import zlib
 import re
 import random
 import json
 import hashlib
+import html
+import math
 import secrets
-from datetime import datetime, timedelta
+import sys
+import threading
+import time
+import importlib.util
+from datetime import datetime, timedelta, timezone
+import click
+from werkzeug.http import http_date
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for
 from contextlib import contextmanager
-from functools import wraps
+from functools import wraps, lru_cache
+from types import MappingProxyType
+
+import audio
+import bulkhead
+import intents
+import json_provider
+import key_pool
+import model_routing
+import retrieval
 
-# Try to import google.genai
 try:
-    import google.genai as genai
-    USE_NEW_GENAI = True
-    print("✅ Using new google.genai package")
+    import brotli  # optional: smaller pages and JSON for browsers that accept br
 except ImportError:
-    try:
-        import google.generativeai as genai
-        USE_NEW_GENAI = False
-        print("⚠️ Using deprecated google.generativeai package")
-    except ImportError:
-        genai = None
-        print("❌ No Gemini AI package found")
+    brotli = None
+import tts
+
+
+def _lazy_module(name):
+    """name, imported on first attribute access instead of now"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+# SQLAlchemy takes longer to import than Flask; the database layer loads
+# with the first query, which keeps it out of cold start
+storage = _lazy_module('storage')
+migrations = _lazy_module('migrations')
+
+# The Gemini SDKs are heavy import trees, so they are loaded on first LLM use
+# (see load_genai) rather than when this module is imported.
+genai = None
+USE_NEW_GENAI = False
+_genai_loaded = False
+_genai_lock = threading.Lock()
 
 # --- Flask Configuration ---
 app = Flask(__name__)
+app.json = json_provider.JSONProvider(app)  # orjson when installed
 app.secret_key = secrets.token_hex(32)
 DATABASE = 'chatbot_auth.db'
 TOKEN_EXPIRY_DAYS = 7
+BOOTSTRAP_HISTORY_LIMIT = 50  # messages of the newest conversation sent with /bootstrap
+
+# Optional message sharding: MESSAGE_SHARDS SQLite files in MESSAGE_SHARD_DIR
+# (0 keeps messages in the main database). Change it with `flask reshard`.
+MESSAGE_SHARDS = int(os.getenv('MESSAGE_SHARDS', 0))
+MESSAGE_SHARD_DIR = os.getenv('MESSAGE_SHARD_DIR', 'message_shards')
+
+def database_url():
+    """DATABASE_URL (any SQLAlchemy URL) if set, else the local SQLite file"""
+    return os.getenv('DATABASE_URL') or f"sqlite:///{DATABASE}"
+
+def message_shard_urls(count=None):
+    count = MESSAGE_SHARDS if count is None else count
+    return storage.shard_urls(MESSAGE_SHARD_DIR, count) if count else ()
+
+def get_storage(shards=None):
+    """Storage for the configured databases (or for `shards` message shards)"""
+    return storage.get_storage(database_url(), message_shard_urls(shards))
 
 # --- Gemini AI Setup ---
+def _module_available(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
 def init_gemini():
-    """Initialize Gemini AI"""
-    if genai is None:
+    """Check that a Gemini SDK and API key are present, without importing the SDK"""
+    if not (_module_available('google.genai') or _module_available('google.generativeai')):
         print("❌ No Gemini AI package installed")
         return None
     
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
-    if not gemini_api_key:
+    keys = key_pool.get_key_pool()
+    if not keys:
         print("⚠️ WARNING: GEMINI_API_KEY not found")
         return None
     
-    try:
-        # For new google.genai, configuration is different
-        if USE_NEW_GENAI:
-            # New API format - just check if we can create a client
-            # The key is passed directly to the client, not configured globally
-            print("✅ Using new Gemini API format")
-            return True
-        else:
-            # Old API format
-            genai.configure(api_key=gemini_api_key)
-            print("✅ Gemini AI initialized successfully")
-            return True
-    except Exception as e:
-        print(f"⚠️ Gemini AI initialization failed: {e}")
-        return None
+    print(f"✅ Gemini AI package found (loaded on first use), {len(keys)} API key(s)")
+    return True
+
+def load_genai():
+    """Import and configure the Gemini SDK once per process"""
+    global genai, USE_NEW_GENAI, _genai_loaded
+    if _genai_loaded:
+        return genai
+    
+    with _genai_lock:
+        if _genai_loaded:
+            return genai
+        
+        try:
+            import google.genai as sdk
+            USE_NEW_GENAI = True
+            print("✅ Using new google.genai package")
+        except ImportError:
+            try:
+                import google.generativeai as sdk
+                USE_NEW_GENAI = False
+                print("⚠️ Using deprecated google.generativeai package")
+            except ImportError:
+                sdk = None
+                print("❌ No Gemini AI package found")
+        
+        if sdk is not None and not USE_NEW_GENAI:
+            # Old API format: the key is configured globally, so only the first one is used
+            try:
+                sdk.configure(api_key=key_pool.get_key_pool().keys[0].key)
+            except Exception as e:
+                print(f"⚠️ Gemini AI initialization failed: {e}")
+                sdk = None
+        
+        genai = sdk
+        _genai_loaded = True
+        return genai
 
 # Initialize Gemini
 gemini_available = init_gemini()
 
+def gemini_connected():
+    """Whether Gemini can answer: configured, and the SDK loaded if that has been tried"""
+    return bool(gemini_available) and not (_genai_loaded and genai is None)
+
 # --- Database Context Manager ---
+# Queries go through the repositories in storage.py; this raw pooled
+# connection is only for SQLite-specific SQL such as the FTS5 search index.
 @contextmanager
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    try:
+def get_db_connection(user_id=None):
+    """Raw connection to the main database, or to the one holding user_id's messages"""
+    db = get_storage()
+    engine = db.message_engine(user_id) if user_id is not None else None
+    with db.raw_connection(engine) as conn:
         yield conn
-        conn.commit()
-    finally:
-        conn.close()
 
 # --- Database Initialization ---
-def init_db():
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE,
-                password_hash TEXT NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_login DATETIME,
-                is_active INTEGER DEFAULT 1
-            )
-        ''')
-        
-        # User sessions
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                session_token TEXT UNIQUE NOT NULL,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                expires_at DATETIME,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Chat messages
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                conversation_id TEXT NOT NULL,
-                role TEXT NOT NULL,  -- 'user' or 'assistant'
-                content TEXT NOT NULL,
-                voice_style TEXT DEFAULT 'natural',
-                emotion TEXT DEFAULT 'neutral',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # User preferences
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_preferences (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE NOT NULL,
-                voice_style TEXT DEFAULT 'natural',
-                theme TEXT DEFAULT 'light',
-                auto_play_voice INTEGER DEFAULT 1,
-                speech_rate FLOAT DEFAULT 1.0,
-                speech_pitch FLOAT DEFAULT 1.0,
-                conversation_style TEXT DEFAULT 'casual',
-                use_fillers INTEGER DEFAULT 1,
-                use_pauses INTEGER DEFAULT 1,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # Create indexes
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_messages ON chat_messages(user_id, created_at)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversation ON chat_messages(conversation_id)')
-        
+_db_initialized = False
+_db_init_lock = threading.Lock()
+search_available = False  # the FTS5 index exists (see migrations.SearchIndex)
+
+def init_db(force=False):
+    """Apply pending schema migrations; runs once per process unless forced"""
+    global _db_initialized
+    if _db_initialized and not force:
+        return
+    
+    with _db_init_lock:
+        if _db_initialized and not force:
+            return
+        _check_shard_layout()
+        _upgrade_schema()
+        _db_initialized = True
+
+def _check_shard_layout():
+    # Messages written under another shard count would silently disappear
+    on_disk = storage.shard_counts_on_disk(MESSAGE_SHARD_DIR) - {MESSAGE_SHARDS}
+    if on_disk:
+        raise RuntimeError(
+            f"{MESSAGE_SHARD_DIR} holds messages for {sorted(on_disk)} shards but MESSAGE_SHARDS={MESSAGE_SHARDS}; "
+            f"run `flask --app app reshard --from {min(on_disk)} --to {MESSAGE_SHARDS}` first"
+        )
+
+def _upgrade_schema(db=None):
+    """Schema steps of pending migrations, plus any backfill small enough to run now"""
+    global search_available
+    db = db or get_storage()
+    pending = migrations.upgrade(db)
+    search_available = migrations.search_index_ready(db)
+    if not search_available:
+        print("⚠️ Full-text search disabled (needs the SQLite FTS5 index)")
+    for database, migration, rows in pending:
+        print(f"⚠️ {database.name}: {rows:,} rows wait for migration {migration.version} ({migration.name}); "
+              f"run `flask --app app migrate` (safe while serving)")
+    
     print("✅ Database initialized successfully")
 
 # --- Password Hashing ---
@@ -176,138 +235,315 @@ def login_required(f):
 def create_session_token(user_id):
     token = secrets.token_hex(32)
     expires_at = datetime.now() + timedelta(days=TOKEN_EXPIRY_DAYS)
-    
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO user_sessions (user_id, session_token, expires_at)
-            VALUES (?, ?, ?)
-        ''', (user_id, token, expires_at))
-    
+    get_storage().sessions.create(user_id, token, expires_at)
     return token
 
 def verify_session_token(token):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT user_id FROM user_sessions 
-            WHERE session_token = ? AND expires_at > ?
-        ''', (token, datetime.now()))
-        
-        result = cursor.fetchone()
-        return result['user_id'] if result else None
+    return get_storage().sessions.user_for_token(token, datetime.now())
 
 # --- User Management ---
 def create_user(username, email, password):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT id FROM users WHERE username = ? OR email = ?', (username, email))
-        if cursor.fetchone():
-            return None, "Username or email already exists"
-        
-        password_hash = hash_password(password)
-        cursor.execute('''
-            INSERT INTO users (username, email, password_hash, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (username, email, password_hash, datetime.now()))
-        
-        user_id = cursor.lastrowid
-        
-        # Create default preferences
-        cursor.execute('''
-            INSERT INTO user_preferences (user_id, voice_style, theme, auto_play_voice, speech_rate, speech_pitch, conversation_style, use_fillers, use_pauses)
-            VALUES (?, 'natural', 'light', 1, 1.0, 1.0, 'casual', 1, 1)
-        ''', (user_id,))
-        
-        return user_id, None
+    user_id = get_storage().users.create(username, email, hash_password(password), DEFAULT_PREFERENCES)
+    if user_id is None:
+        return None, "Username or email already exists"
+    return user_id, None
 
 def authenticate_user(username, password):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, password_hash FROM users 
-            WHERE username = ? AND is_active = 1
-        ''', (username,))
-        
-        user = cursor.fetchone()
-        if not user:
-            return None, "Invalid username or password"
-        
-        if verify_password(password, user['password_hash']):
-            cursor.execute('UPDATE users SET last_login = ? WHERE id = ?', 
-                         (datetime.now(), user['id']))
-            return user['id'], None
-        else:
-            return None, "Invalid username or password"
+    users = get_storage().users
+    user = users.credentials(username)
+    if not user or not verify_password(password, user.password_hash):
+        return None, "Invalid username or password"
+    
+    users.record_login(user.id)
+    return user.id, None
 
 # --- Chat History ---
 def save_chat_message(user_id, conversation_id, role, content, voice_style='natural', emotion='neutral'):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO chat_messages (user_id, conversation_id, role, content, voice_style, emotion)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, conversation_id, role, content, voice_style, emotion))
-        
-        return cursor.lastrowid
+    return get_storage().messages.add(user_id, conversation_id, role, content, voice_style, emotion)
 
 def get_conversation_history(user_id, conversation_id, limit=10):
-    with get_db_connection() as conn:
+    return get_storage().messages.recent(user_id, conversation_id, limit)
+
+def count_conversation_messages(user_id, conversation_id):
+    return get_storage().messages.count(user_id, conversation_id)
+
+def get_conversation_slice(user_id, conversation_id, offset, limit):
+    """Messages [offset, offset + limit) of a conversation, oldest first"""
+    return get_storage().messages.slice(user_id, conversation_id, offset, limit)
+
+# --- Chat Search ---
+# FTS5 finds the user's matching messages (an intersection with the user_id
+# postings, so it never touches other users' hits); bm25 is then computed
+# here rather than with FTS5's bm25(), which rescans the full posting list of
+# every query term on each call to count documents. Corpus statistics are
+# cached per process for SEARCH_STATS_TTL seconds instead.
+SEARCH_MAX_LIMIT = 100
+SEARCH_CANDIDATE_LIMIT = 2000   # most recent matches considered for ranking
+SEARCH_SCORE_SCALE = 10 ** 6    # scores are ranked and paged as integers in millionths
+SEARCH_STATS_TTL = 300
+SNIPPET_TOKENS = 12
+BM25_K1, BM25_B = 1.2, 0.75
+
+_search_stats = {}  # key -> (expires_at, value)
+_search_stats_lock = threading.Lock()
+
+def _search_terms(text):
+    """[(term, is_prefix)] from free text, lowercased like FTS5's unicode61 tokenizer"""
+    return [(term.rstrip('*'), term.endswith('*')) for term in re.findall(r'\w+\*?', text.lower())]
+
+def _fts_phrase(term, is_prefix):
+    # Quoted so FTS5 operators in user input are matched literally
+    return f'"{term}"*' if is_prefix else f'"{term}"'
+
+def _cached_search_stat(key, compute):
+    now = time.monotonic()
+    cached = _search_stats.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    value = compute()
+    with _search_stats_lock:
+        if len(_search_stats) > 10000:
+            _search_stats.clear()
+        _search_stats[key] = (now + SEARCH_STATS_TTL, value)
+    return value
+
+# Statistics are per message database (`scope`) when messages are sharded
+def _document_frequency(cursor, term, is_prefix, scope=None):
+    def compute():
+        cursor.execute('SELECT count(*) FROM chat_messages_fts WHERE chat_messages_fts MATCH ?',
+                       (f'content : {_fts_phrase(term, is_prefix)}',))
+        return cursor.fetchone()[0]
+    return _cached_search_stat((scope, term, is_prefix), compute)
+
+def _corpus_size(cursor, scope=None):
+    def compute():
+        # max(id) is an O(log n) stand-in for count(*); deleted rows barely move IDF
+        cursor.execute('SELECT max(id) FROM chat_messages')
+        return cursor.fetchone()[0] or 0
+    return _cached_search_stat(('__corpus_size__', scope), compute)
+
+def _bm25_scores(candidates, terms, idf):
+    tokenized = [re.findall(r'\w+', row['content'].lower()) for row in candidates]
+    avgdl = sum(map(len, tokenized)) / len(tokenized) or 1.0
+    scores = []
+    for tokens in tokenized:
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * len(tokens) / avgdl)
+        score = 0.0
+        for (term, is_prefix), weight in zip(terms, idf):
+            if is_prefix:
+                tf = sum(1 for token in tokens if token.startswith(term))
+            else:
+                tf = tokens.count(term)
+            score += weight * tf * (BM25_K1 + 1) / (tf + norm)
+        scores.append(score)
+    return scores
+
+def _snippet(content, terms):
+    """HTML-escaped excerpt around the first match, with matched words in <mark>"""
+    spans = [m.span() for m in re.finditer(r'\w+', content)]
+    
+    def matches(span):
+        token = content[span[0]:span[1]].lower()
+        return any(token.startswith(term) if is_prefix else token == term for term, is_prefix in terms)
+    
+    first = next((i for i, span in enumerate(spans) if matches(span)), 0)
+    start = max(first - SNIPPET_TOKENS // 3, 0)
+    end = min(start + SNIPPET_TOKENS, len(spans))
+    if not spans:
+        return html.escape(content)
+    
+    parts = ['…' if start > 0 else '']
+    position = spans[start][0]
+    for span in spans[start:end]:
+        parts.append(html.escape(content[position:span[0]]))
+        word = html.escape(content[span[0]:span[1]])
+        parts.append(f'<mark>{word}</mark>' if matches(span) else word)
+        position = span[1]
+    parts.append('…' if end < len(spans) else html.escape(content[position:]))
+    return ''.join(parts)
+
+def search_messages(user_id, text, limit=20, after=None):
+    """bm25-ranked matches in a user's history, with keyset pagination.
+    
+    Hits are ordered by score (best first), then id. `after` is the
+    (score, id) of the last hit on the previous page, with the score in
+    fixed point (SEARCH_SCORE_SCALE) so that a float recomputed slightly
+    differently for the next page cannot skip or repeat hits.
+    """
+    terms = _search_terms(text)
+    if not terms:
+        return [], None
+    
+    query = f'user_id : "{int(user_id)}" AND ({" ".join(_fts_phrase(*term) for term in terms)})'
+    scope = str(get_storage().message_engine(user_id).url)
+    
+    with get_db_connection(user_id) as conn:
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT role, content, emotion FROM chat_messages 
-            WHERE user_id = ? AND conversation_id = ?
-            ORDER BY created_at DESC
+            SELECT m.id, m.content, m.conversation_id, m.role, m.emotion, m.created_at
+            FROM chat_messages_fts
+            JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+            WHERE chat_messages_fts MATCH ?
+            ORDER BY chat_messages_fts.rowid DESC
             LIMIT ?
-        ''', (user_id, conversation_id, limit))
+        ''', (query, SEARCH_CANDIDATE_LIMIT))
+        candidates = cursor.fetchall()
+        if not candidates:
+            return [], None
         
-        messages = cursor.fetchall()
-        return [dict(msg) for msg in messages][::-1]  # Reverse to chronological order
+        total = _corpus_size(cursor, scope)
+        idf = []
+        for term, is_prefix in terms:
+            df = _document_frequency(cursor, term, is_prefix, scope)
+            idf.append(math.log((total - df + 0.5) / (df + 0.5) + 1))
+    
+    scored = ((round(score * SEARCH_SCORE_SCALE), row) for score, row in zip(_bm25_scores(candidates, terms, idf), candidates))
+    ranked = sorted(scored, key=lambda hit: (-hit[0], hit[1]['id']))
+    if after is not None:
+        ranked = [hit for hit in ranked if hit[0] < after[0] or (hit[0] == after[0] and hit[1]['id'] > after[1])]
+    page = ranked[:limit]
+    
+    hits = []
+    for score, row in page:
+        hit = dict(row)
+        hit['snippet'] = _snippet(hit.pop('content'), terms)
+        hit['score'] = score / SEARCH_SCORE_SCALE
+        hits.append(hit)
+    
+    next_cursor = f"{page[-1][0]}:{page[-1][1]['id']}" if len(ranked) > limit else None
+    return hits, next_cursor
+
+def parse_search_cursor(cursor):
+    score, _, message_id = cursor.partition(':')
+    return int(score), int(message_id)
+
+# --- Chat Export ---
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_FIELDS = ('id', 'conversation_id', 'role', 'content', 'voice_style', 'emotion', 'created_at')
+
+def iter_user_messages(user_id, chunk_size=EXPORT_CHUNK_ROWS):
+    """Yield chunks of a user's messages, oldest first, from one streaming cursor.
+    
+    Rows are fetched as they are consumed (SQLite steps the statement, server
+    databases use a server-side cursor), so only one chunk is ever held in
+    memory no matter how long the history is.
+    """
+    # Ordered to match idx_user_messages, so the database needs no sort buffer
+    yield from get_storage().messages.iter_chunks(user_id, EXPORT_FIELDS, chunk_size)
+
+def export_messages(user_id, fmt='ndjson', compress=False, chunk_size=EXPORT_CHUNK_ROWS):
+    """Stream a user's history as NDJSON or CSV bytes, optionally gzip-compressed"""
+    if fmt not in ('ndjson', 'csv'):
+        raise ValueError(f"Unsupported export format: {fmt}")
+    
+    def encoded_chunks():
+        if fmt == 'csv':
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(EXPORT_FIELDS)
+            for rows in iter_user_messages(user_id, chunk_size):
+                writer.writerows(rows)
+                yield buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+            if buffer.tell():
+                yield buffer.getvalue().encode('utf-8')
+        else:
+            for rows in iter_user_messages(user_id, chunk_size):
+                yield app.json.ndjson(storage.Rows(EXPORT_FIELDS, rows))
+    
+    if not compress:
+        yield from encoded_chunks()
+        return
+    
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 writes a gzip container
+    for chunk in encoded_chunks():
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
 
 # --- User Preferences ---
+DEFAULT_PREFERENCES = MappingProxyType({
+    'voice_style': 'natural',
+    'theme': 'light',
+    'auto_play_voice': 1,
+    'speech_rate': 1.0,
+    'speech_pitch': 1.0,
+    'conversation_style': 'casual',
+    'use_fillers': 1,
+    'use_pauses': 1
+})
+
+# Write-through preferences cache: user_id -> (generation, read-only prefs).
+# Every update bumps a generation counter in the database in the same
+# transaction; each process polls it at most every PREFERENCES_MAX_STALENESS
+# seconds and drops its cache when another process has written, so a read
+# can be stale for at most that long.
+PREFERENCES_MAX_STALENESS = float(os.getenv('PREFERENCES_MAX_STALENESS', 1.0))
+_preferences_cache = {}
+_preferences_lock = threading.Lock()
+_preferences_generation = None
+_preferences_next_poll = 0.0
+
+def _poll_preferences_generation():
+    global _preferences_generation, _preferences_next_poll
+    now = time.monotonic()
+    if now < _preferences_next_poll:
+        return
+    with _preferences_lock:
+        # One thread polls per interval
+        if now < _preferences_next_poll:
+            return
+        _preferences_next_poll = now + PREFERENCES_MAX_STALENESS
+    
+    generation = get_storage().preferences.generation()
+    
+    with _preferences_lock:
+        if generation != _preferences_generation:
+            _preferences_cache.clear()
+            _preferences_generation = generation
+
+def _store_preferences(user_id, generation, prefs):
+    with _preferences_lock:
+        # A row read before the last clear may predate the write that caused it
+        if _preferences_generation is not None and generation < _preferences_generation:
+            return
+        cached = _preferences_cache.get(user_id)
+        # Never let a slower writer overwrite a newer entry
+        if cached is None or cached[0] <= generation:
+            _preferences_cache[user_id] = (generation, prefs)
+
+def get_cached_preferences(user_id):
+    """Read-only preferences for the per-turn hot path; hits the DB only on a miss"""
+    _poll_preferences_generation()
+    cached = _preferences_cache.get(user_id)
+    if cached is not None:
+        return cached[1]
+    
+    generation, prefs = get_storage().preferences.get(user_id)
+    prefs = MappingProxyType(prefs or dict(DEFAULT_PREFERENCES))
+    _store_preferences(user_id, generation, prefs)
+    return prefs
+
 def get_user_preferences(user_id):
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT voice_style, theme, auto_play_voice, speech_rate, speech_pitch, 
-                   conversation_style, use_fillers, use_pauses
-            FROM user_preferences 
-            WHERE user_id = ?
-        ''', (user_id,))
-        
-        prefs = cursor.fetchone()
-        return dict(prefs) if prefs else {
-            'voice_style': 'natural',
-            'theme': 'light',
-            'auto_play_voice': 1,
-            'speech_rate': 1.0,
-            'speech_pitch': 1.0,
-            'conversation_style': 'casual',
-            'use_fillers': 1,
-            'use_pauses': 1
-        }
+    _, prefs = get_storage().preferences.get(user_id)
+    return prefs or dict(DEFAULT_PREFERENCES)
 
 def update_user_preferences(user_id, **preferences):
-    allowed_fields = ['voice_style', 'theme', 'auto_play_voice', 'speech_rate', 'speech_pitch', 
-                      'conversation_style', 'use_fillers', 'use_pauses']
-    updates = {k: v for k, v in preferences.items() if k in allowed_fields}
+    updates = {k: v for k, v in preferences.items() if k in storage.PREFERENCE_FIELDS}
     
     if not updates:
         return False
     
-    set_clause = ', '.join([f"{k} = ?" for k in updates.keys()])
-    values = list(updates.values()) + [user_id]
+    # Bumps the generation and reads back the row in the same transaction
+    written = get_storage().preferences.update(user_id, updates)
+    if written is None:
+        return False
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(f'''
-            UPDATE user_preferences 
-            SET {set_clause}, updated_at = ?
-            WHERE user_id = ?
-        ''', values + [datetime.now()])
-        
-        return cursor.rowcount > 0
+    generation, prefs = written
+    _store_preferences(user_id, generation, MappingProxyType(prefs))
+    return True
 
 # --- NATURAL VOICE SYSTEM ---
 class NaturalVoiceSystem:
@@ -358,15 +594,236 @@ class NaturalVoiceSystem:
     
     @staticmethod
     def get_voice_settings(style='natural'):
-        """Get natural voice settings"""
-        return NaturalVoiceSystem.VOICE_STYLES.get(style, NaturalVoiceSystem.VOICE_STYLES['natural'])
+        """Get natural voice settings (read-only, shared across requests)"""
+        return STYLE_SETTINGS.get(style, STYLE_SETTINGS['natural'])
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def voice_settings_json(style='natural', user_rate=1.0, user_pitch=1.0):
+        """Pre-serialized voice settings for a style merged with a user's rate and pitch"""
+        settings = dict(NaturalVoiceSystem.get_voice_settings(style))
+        settings['user_rate'] = user_rate
+        settings['user_pitch'] = user_pitch
+        return json.dumps(settings)
+
+# Precomputed once: immutable per-style settings and the /voices body
+STYLE_SETTINGS = {name: MappingProxyType(dict(settings)) for name, settings in NaturalVoiceSystem.VOICE_STYLES.items()}
+VOICE_STYLES_JSON = json.dumps(NaturalVoiceSystem.VOICE_STYLES)
+VOICES_JSON = json.dumps({"status": "success", "voices": NaturalVoiceSystem.VOICE_STYLES})
+
+def json_body(payload, **fragments):
+    """json.dumps(payload) with extra keys whose values are already JSON strings"""
+    body = app.json.dumps(payload)
+    if fragments:
+        # Compact separators, like app.json itself
+        extra = ','.join(f'{json.dumps(key)}:{value}' for key, value in fragments.items())
+        body = body[:-1] + (',' if payload else '') + extra + '}'
+    return body
+
+def json_response(payload, **fragments):
+    """Like jsonify(), but splices in values that are already JSON strings"""
+    return app.response_class(json_body(payload, **fragments) + '\n', mimetype=app.json.mimetype)
+
+# --- GEMINI CONTEXT CACHING ---
+# The persona prompt goes in the system instruction, and once a conversation is
+# long enough its older messages are stored server-side with the Gemini
+# cached-content API, so each turn only sends (and pays full price for) the
+# recent messages. Prefixes are cut at multiples of GEMINI_CACHE_BLOCK
+# messages so one cache serves every turn until the next block fills up.
+# Caches are per model: model_routing picks the model for each turn.
+GEMINI_BASE_URL = os.getenv('GEMINI_BASE_URL')  # e.g. a proxy or gateway in front of the API
+GEMINI_CACHE_ENABLED = os.getenv('GEMINI_CACHE', '1') != '0'
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', 600))
+GEMINI_CACHE_REFRESH = 120          # extend a cache in use when it has less than this left
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv('GEMINI_CACHE_MIN_TOKENS', 1024))  # API minimum for Flash models
+GEMINI_CACHE_BLOCK = int(os.getenv('GEMINI_CACHE_BLOCK', 40))
+GEMINI_CACHE_MAX_ENTRIES = 256
+GEMINI_CACHE_RETRY = 300            # after a failed create, don't retry that prefix for this long
+CHARS_PER_TOKEN = 4                 # rough estimate, only used against the minimum
+
+def gemini_client(api_key):
+    """New-SDK client for one key (created once per key by the key pool)"""
+    if GEMINI_BASE_URL:
+        return genai.Client(api_key=api_key, http_options={'base_url': GEMINI_BASE_URL})
+    return genai.Client(api_key=api_key)
+
+def gemini_contents(messages):
+    """chat_messages rows as Gemini user/model turns"""
+    return [
+        {'role': 'user' if msg['role'] == 'user' else 'model', 'parts': [{'text': msg['content']}]}
+        for msg in messages
+    ]
+
+class GeminiContextCache:
+    """Per-process map from (API key, model, style, conversation prefix) to a Gemini cache name.
+    
+    Entries are extended while in use, deleted upstream when a conversation
+    moves to a longer prefix or the map is full, and otherwise left to expire
+    on the server after GEMINI_CACHE_TTL. Caches belong to the key that
+    created them, so each key has its own.
+    """
+    
+    def __init__(self):
+        self._entries = {}  # key -> (name or None, expires_at); None marks a failed create
+        self._latest = {}   # (account, model, style, user, conversation) -> key of its newest prefix
+        self._lock = threading.Lock()
+        self._counts = {'hits': 0, 'creates': 0, 'refreshes': 0, 'deletes': 0, 'errors': 0, 'cached_tokens': 0}
+    
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+    
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+    
+    def _delete(self, client, name):
+        try:
+            client.caches.delete(name=name)
+            self._count('deletes')
+        except Exception as e:
+            print(f"⚠️ Gemini cache delete failed: {e}")
+    
+    def lookup(self, client, account, model, system_instruction, scope, prefix_length, load_prefix):
+        """Cache name covering the persona plus the first prefix_length messages, or None.
+        
+        account names the API key client uses; scope identifies the
+        conversation; load_prefix() returns its messages.
+        """
+        key = (account, model, hashlib.sha1(system_instruction.encode()).hexdigest(), scope, prefix_length)
+        now = time.time()
+        with self._lock:
+            name, expires_at = self._entries.get(key, (None, 0))
+        
+        if expires_at > now:
+            if name is None:
+                return None
+            if expires_at - now < GEMINI_CACHE_REFRESH:
+                try:
+                    client.caches.update(name=name, config={'ttl': f'{GEMINI_CACHE_TTL}s'})
+                    expires_at = now + GEMINI_CACHE_TTL
+                    self._count('refreshes')
+                except Exception as e:
+                    print(f"⚠️ Gemini cache refresh failed: {e}")
+                    name, expires_at = None, now + GEMINI_CACHE_RETRY
+                with self._lock:
+                    self._entries[key] = (name, expires_at)
+                if name is None:
+                    return None
+            self._count('hits')
+            return name
+        
+        contents = gemini_contents(load_prefix()) if prefix_length else []
+        size = len(system_instruction) + sum(len(c['parts'][0]['text']) for c in contents)
+        if size // CHARS_PER_TOKEN < GEMINI_CACHE_MIN_TOKENS:
+            # Too small for the API to cache; remember that until the prefix grows
+            with self._lock:
+                self._entries[key] = (None, now + GEMINI_CACHE_TTL)
+            return None
+        
+        try:
+            cache = client.caches.create(model=model, config={
+                'system_instruction': system_instruction,
+                'contents': contents,
+                'ttl': f'{GEMINI_CACHE_TTL}s',
+                'display_name': f'aiko-{key[2][:8]}-{prefix_length}',
+            })
+            name = cache.name
+            self._count('creates')
+        except Exception as e:
+            print(f"⚠️ Gemini cache create failed, sending uncached: {e}")
+            self._count('errors')
+            name = None
+        
+        stale = []
+        with self._lock:
+            self._entries[key] = (name, now + (GEMINI_CACHE_TTL if name else GEMINI_CACHE_RETRY))
+            if name:
+                # The conversation's shorter prefix will not be used again
+                previous = self._latest.get((account, model, key[2], scope))
+                self._latest[(account, model, key[2], scope)] = key
+                if previous and previous != key:
+                    stale.append((previous, self._entries.pop(previous, (None, 0))[0]))
+                while len(self._entries) > GEMINI_CACHE_MAX_ENTRIES:
+                    oldest = min(self._entries, key=lambda k: self._entries[k][1])
+                    stale.append((oldest, self._entries.pop(oldest)[0]))
+        for stale_key, stale_name in stale:
+            # Another key's caches can only be deleted with its client; those expire instead
+            if stale_name and stale_key[0] == account:
+                self._delete(client, stale_name)
+        return name
+    
+    def record_usage(self, response):
+        usage = getattr(response, 'usage_metadata', None)
+        cached = getattr(usage, 'cached_content_token_count', None) if usage else None
+        if cached:
+            self._count('cached_tokens', cached)
+
+gemini_cache = GeminiContextCache()
 
 # --- GEMINI AI RESPONSE GENERATOR ---
 class GeminiChatAssistant:
     """Gemini AI with natural conversation flow"""
     
+    # Fallback bank, shared read-only across requests (and forked workers)
+    GREETING_WORDS = ('hi', 'hello', 'hey', 'greetings')
+    
+    FALLBACK_GREETINGS = {
+        'natural': ["Hi there! How are you doing today?", "Hello! It's nice to talk with you.", "Hey! What's on your mind?"],
+        'warm': ["Hello! It's so good to see you. How have you been?", "Hi there! I've been thinking about our conversations.", "Hey! I'm really glad we're talking."],
+        'energetic': ["Hey!! How's it going? I'm excited to chat!", "Hi! Wow, great to hear from you!", "Hello! Let's have an awesome conversation!"],
+        'calm': ["Hello... It's peaceful to talk with you.", "Hi. I hope you're having a calm day.", "Hey. Let's have a gentle conversation."],
+        'playful': ["Hehe, hi there! Ready for some fun chat?", "Hey you! What mischief are we up to today?", "Hi! Let's have a playful conversation!"]
+    }
+    
+    FALLBACK_QUESTIONS = {
+        'natural': ["That's an interesting question. Let me think about it...", "Hmm, I'm not completely sure, but here's what I think...", "Good question! I believe..."],
+        'warm': ["I appreciate you asking that. From what I understand...", "That's a thoughtful question. I feel that...", "Thanks for sharing that question with me. I think..."],
+        'energetic': ["Wow, great question! I'm excited to share my thoughts...", "Awesome question! Here's what comes to mind...", "Cool question! I think..."],
+        'calm': ["That's a peaceful question to consider. I believe...", "I'll ponder that quietly. It seems to me...", "A calm question deserves a thoughtful answer..."],
+        'playful': ["Hehe, tricky question! Let me play with that idea...", "Fun question! I'd say...", "Ooh, interesting! I think..."]
+    }
+    
+    FALLBACK_RESPONSES = {
+        'natural': [
+            "I understand what you mean. That's really interesting.",
+            "Thanks for sharing that with me. It gives me something to think about.",
+            "I see what you're saying. That's a good point to consider.",
+            "You make a good observation there. I appreciate your perspective.",
+            "That's a thoughtful thing to say. I'm enjoying our conversation."
+        ],
+        'warm': [
+            "I really appreciate you sharing that. It means a lot to hear your thoughts.",
+            "Thank you for being so open. I value our conversations.",
+            "That's very considerate of you to mention. I'm touched.",
+            "I'm glad we can talk like this. Your perspective is important.",
+            "You have a kind way of expressing yourself. I enjoy our chats."
+        ],
+        'energetic': [
+            "Wow, that's awesome! I love hearing your thoughts!",
+            "Cool! That's really exciting to hear!",
+            "Fantastic! I'm so glad you mentioned that!",
+            "Amazing! Your perspective is really energizing!",
+            "Great point! I'm pumped about our conversation!"
+        ],
+        'calm': [
+            "That's peaceful to consider. I appreciate the calm in your words.",
+            "Thank you for the gentle thoughts. It's soothing to chat.",
+            "I find comfort in our conversation. Your words are calming.",
+            "That's a serene perspective. I enjoy our peaceful chats.",
+            "Your gentle approach to conversation is refreshing."
+        ],
+        'playful': [
+            "Hehe, that's fun to think about! Let's explore that idea!",
+            "You have a playful perspective! I like that!",
+            "That's a mischievous thought! I'm intrigued!",
+            "Fun idea! Let's play with that concept!",
+            "You make conversation enjoyable with your playful approach!"
+        ]
+    }
+    
     def __init__(self):
-        self.api_key = os.getenv("GEMINI_API_KEY")
+        self.keys = key_pool.get_key_pool()
         self.conversation_styles = {
             'natural': {
                 'prompt': """You are Aiko, a friendly and natural human conversational partner.
@@ -396,65 +853,40 @@ class GeminiChatAssistant:
             }
         }
     
-    def generate_response(self, user_message, conversation_history, user_id, voice_style='natural'):
-        """Generate natural response using Gemini AI"""
+    def generate_response(self, user_message, conversation_history, user_id, voice_style='natural',
+                          conversation_id=None, mode='text'):
+        """Generate natural response using Gemini AI.
         
-        style_prompt = self.conversation_styles.get(voice_style, self.conversation_styles['natural'])['prompt']
-        
-        # Prepare conversation context
-        history_text = ""
-        if conversation_history:
-            for msg in conversation_history:
-                speaker = "User" if msg['role'] == 'user' else "Aiko"
-                history_text += f"{speaker}: {msg['content']}\n"
-        
-        # Construct the prompt
-        prompt = f"""{style_prompt}
-
-Previous conversation:
-{history_text}
-
-User: {user_message}
-
-Aiko:"""
+        Confident small talk ("hi", "thanks", ...) is answered by the local
+        intent router instead; 'intent' names the intent when it was.
+        Otherwise model_routing picks the model tier and output budget from
+        the message, history, voice style and mode ('text' or 'voice');
+        'tier' names it. Calls go through the worker's LLM bulkhead and the
+        API key pool; a call the bulkhead sheds, or that no key has quota
+        for, is answered offline at once.
+        """
         
+        route = None
+        is_gemini = False
         try:
-            if gemini_available and self.api_key:
-                # Use real Gemini API
-                if USE_NEW_GENAI:
-                    # New API format
-                    client = genai.Client(api_key=self.api_key)
-                    response = client.models.generate_content(
-                        model="gemini-2.0-flash",
-                        contents=prompt,
-                        config={
-                            'temperature': 0.9,
-                            'top_p': 0.95,
-                            'top_k': 40,
-                            'max_output_tokens': 200,
-                        }
-                    )
-                    bot_response = response.text
-                else:
-                    # Old API format
-                    model = genai.GenerativeModel('gemini-pro')
-                    response = model.generate_content(
-                        prompt,
-                        generation_config={
-                            'temperature': 0.9,
-                            'top_p': 0.95,
-                            'top_k': 40,
-                            'max_output_tokens': 200,
-                        }
+            local = None
+            if gemini_connected() and self.keys:
+                local = intents.get_router().route(user_message, voice_style, conversation_history)
+            
+            if local is not None:
+                bot_response = local.text
+            elif gemini_connected() and self.keys and load_genai() is not None:
+                route = model_routing.get_router().choose(user_message, conversation_history, voice_style, mode)
+                priority = 'voice' if mode == 'voice' else 'text'
+                with bulkhead.get_llm_bulkhead().slot(priority):
+                    bot_response = self._gemini_reply(
+                        route, user_message, conversation_history, user_id, voice_style, conversation_id
                     )
-                    bot_response = response.text
-                
-                bot_response = self._clean_response(bot_response)
+                is_gemini = True
                 
             else:
                 # Fallback: Generate natural responses
-                bot_response = self._generate_fallback_response(user_message, voice_style)
-                gemini_used = False
+                bot_response = self._generate_fallback_response(user_message, voice_style, user_id)
             
             # Extract emotion from response
             emotion = self._detect_emotion(bot_response)
@@ -464,22 +896,154 @@ Aiko:"""
                 'emotion': emotion,
                 'voice_style': voice_style,
                 'voice_name': NaturalVoiceSystem.VOICE_STYLES[voice_style]['name'],
-                'is_gemini': gemini_available and bool(self.api_key),
+                'is_gemini': is_gemini,
+                'intent': local.intent if local is not None else None,
+                'tier': route.tier if route is not None else None,
                 'timestamp': datetime.now().isoformat()
             }
             
+        except (bulkhead.Rejected, key_pool.KeysExhausted):
+            # Enough calls are already waiting on Gemini, or every key is rate limited: answer offline now
+            return self._offline_result(user_message, voice_style, user_id)
         except Exception as e:
             print(f"❌ Gemini API error: {e}")
-            # Fallback response
-            fallback = self._generate_fallback_response(user_message, voice_style)
-            return {
-                'text': fallback,
-                'emotion': 'neutral',
-                'voice_style': voice_style,
-                'voice_name': NaturalVoiceSystem.VOICE_STYLES[voice_style]['name'],
-                'is_gemini': False,
-                'timestamp': datetime.now().isoformat()
+            return self._offline_result(user_message, voice_style, user_id)
+    
+    def _gemini_reply(self, route, user_message, conversation_history, user_id, voice_style, conversation_id):
+        """One reply on route's model and budget, moving to another API key after a 429"""
+        started = time.perf_counter()
+        tried = []
+        try:
+            while True:
+                # The legacy SDK is configured with the first key only
+                lease = self.keys.acquire((user_id, conversation_id), tried, None if USE_NEW_GENAI else 1)
+                try:
+                    response, prompt_chars = self._call_gemini(
+                        lease, route, user_message, conversation_history, user_id, voice_style, conversation_id
+                    )
+                    break
+                except Exception as e:
+                    if not key_pool.is_rate_limited(e):
+                        self.keys.failed(lease)
+                        raise
+                    self.keys.rate_limited(lease, key_pool.retry_after(e))
+                    tried.append(lease.api_key)
+        except Exception as e:
+            if tried or not isinstance(e, key_pool.KeysExhausted):
+                model_routing.get_router().record(route, time.perf_counter() - started, error=True)
+            raise
+        
+        elapsed = time.perf_counter() - started
+        usage = getattr(response, 'usage_metadata', None)
+        self.keys.succeeded(lease, getattr(usage, 'prompt_token_count', None) or 0,
+                            getattr(usage, 'candidates_token_count', None) or 0)
+        model_routing.get_router().record(route, elapsed, response, prompt_chars)
+        intents.get_router().record_llm(elapsed)
+        return self._clean_response(response.text)
+    
+    def _call_gemini(self, lease, route, user_message, conversation_history, user_id, voice_style, conversation_id):
+        """(response, characters sent) for one generate_content call with lease's key"""
+        if USE_NEW_GENAI:
+            # New API format: persona as system instruction, turns as contents
+            client = self.keys.client(lease, gemini_client)
+            config = {
+                'temperature': 0.9,
+                'top_p': 0.95,
+                'top_k': 40,
+                'max_output_tokens': route.max_output_tokens,
             }
+            contents, cache_name = self._build_contents(
+                client, lease.label, route.model, user_message, conversation_history, user_id, voice_style,
+                conversation_id
+            )
+            if cache_name:
+                config['cached_content'] = cache_name
+            else:
+                config['system_instruction'] = self._style_prompt(voice_style)
+            response = client.models.generate_content(
+                model=route.model,
+                contents=contents,
+                config=config
+            )
+            gemini_cache.record_usage(response)
+            return response, sum(len(part['text']) for turn in contents for part in turn['parts'])
+        
+        # Old API format: no system instructions or caching, one flat prompt
+        prompt = self._build_prompt(user_message, conversation_history, voice_style)
+        model = genai.GenerativeModel(route.legacy_model)
+        response = model.generate_content(
+            prompt,
+            generation_config={
+                'temperature': 0.9,
+                'top_p': 0.95,
+                'top_k': 40,
+                'max_output_tokens': route.max_output_tokens,
+            }
+        )
+        return response, len(prompt)
+    
+    def _offline_result(self, user_message, voice_style, user_id):
+        fallback = self._generate_fallback_response(user_message, voice_style, user_id)
+        return {
+            'text': fallback,
+            'emotion': 'neutral',
+            'voice_style': voice_style,
+            'voice_name': NaturalVoiceSystem.VOICE_STYLES[voice_style]['name'],
+            'is_gemini': False,
+            'intent': None,
+            'tier': None,
+            'timestamp': datetime.now().isoformat()
+        }
+    
+    def _style_prompt(self, voice_style):
+        return self.conversation_styles.get(voice_style, self.conversation_styles['natural'])['prompt']
+    
+    def _build_contents(self, client, account, model, user_message, conversation_history, user_id, voice_style,
+                        conversation_id):
+        """Turns to send and the context cache covering everything before them (or None).
+        
+        Without a usable cache the turns are the recent history passed in. With
+        one, they are every message after the cached block-aligned prefix.
+        """
+        current = {'role': 'user', 'parts': [{'text': user_message}]}
+        if not GEMINI_CACHE_ENABLED or conversation_id is None:
+            return gemini_contents(conversation_history) + [current], None
+        
+        # The user's message is already stored; it is sent separately
+        previous = count_conversation_messages(user_id, conversation_id) - 1
+        prefix_length = previous // GEMINI_CACHE_BLOCK * GEMINI_CACHE_BLOCK
+        # A persona-only cache (no prefix) is shared by every conversation
+        scope = (user_id, conversation_id) if prefix_length else None
+        cache_name = gemini_cache.lookup(
+            client, account, model, self._style_prompt(voice_style), scope, prefix_length,
+            lambda: get_conversation_slice(user_id, conversation_id, 0, prefix_length)
+        )
+        if cache_name is None:
+            return gemini_contents(conversation_history) + [current], None
+        
+        recent = get_conversation_slice(user_id, conversation_id, prefix_length, previous - prefix_length)
+        return gemini_contents(recent) + [current], cache_name
+    
+    def _build_prompt(self, user_message, conversation_history, voice_style='natural'):
+        """Build the flat prompt for the legacy google.generativeai SDK"""
+        style_prompt = self._style_prompt(voice_style)
+        
+        # Prepare conversation context
+        history_text = ""
+        if conversation_history:
+            for msg in conversation_history:
+                speaker = "User" if msg['role'] == 'user' else "Aiko"
+                history_text += f"{speaker}: {msg['content']}\n"
+        
+        # Construct the prompt
+        return f"""{style_prompt}
+
+Previous conversation:
+{history_text}
+
+User: {user_message}
+
+Aiko:"""
     
     def _clean_response(self, text):
         """Clean and format response"""
@@ -510,81 +1074,237 @@ Aiko:"""
         
         return 'neutral'
     
-    def _generate_fallback_response(self, user_message, voice_style):
+    def _retrieved_reply(self, user_message, voice_style, user_id):
+        """The reply to the most similar past message (see retrieval.py), or None"""
+        if not retrieval.RETRIEVAL_ENABLED or user_id is None:
+            return None
+        try:
+            index = retrieval.get_index(get_storage(), CANNED_REPLIES)
+            index.start()  # canned lines until the first build finishes
+            return index.reply(user_message, voice_style, user_id)
+        except Exception as e:
+            print(f"⚠️ Reply retrieval failed: {e}")
+            return None
+    
+    def _generate_fallback_response(self, user_message, voice_style, user_id=None):
         """Generate varied fallback responses"""
+        retrieved = self._retrieved_reply(user_message, voice_style, user_id)
+        if retrieved:
+            return retrieved
+        
         user_lower = user_message.lower()
         
         # Greeting responses
-        if any(word in user_lower for word in ['hi', 'hello', 'hey', 'greetings']):
-            greetings = {
-                'natural': ["Hi there! How are you doing today?", "Hello! It's nice to talk with you.", "Hey! What's on your mind?"],
-                'warm': ["Hello! It's so good to see you. How have you been?", "Hi there! I've been thinking about our conversations.", "Hey! I'm really glad we're talking."],
-                'energetic': ["Hey!! How's it going? I'm excited to chat!", "Hi! Wow, great to hear from you!", "Hello! Let's have an awesome conversation!"],
-                'calm': ["Hello... It's peaceful to talk with you.", "Hi. I hope you're having a calm day.", "Hey. Let's have a gentle conversation."],
-                'playful': ["Hehe, hi there! Ready for some fun chat?", "Hey you! What mischief are we up to today?", "Hi! Let's have a playful conversation!"]
-            }
+        if any(word in user_lower for word in self.GREETING_WORDS):
+            greetings = self.FALLBACK_GREETINGS
             return random.choice(greetings.get(voice_style, greetings['natural']))
         
         # Question responses
         elif '?' in user_message:
-            questions = {
-                'natural': ["That's an interesting question. Let me think about it...", "Hmm, I'm not completely sure, but here's what I think...", "Good question! I believe..."],
-                'warm': ["I appreciate you asking that. From what I understand...", "That's a thoughtful question. I feel that...", "Thanks for sharing that question with me. I think..."],
-                'energetic': ["Wow, great question! I'm excited to share my thoughts...", "Awesome question! Here's what comes to mind...", "Cool question! I think..."],
-                'calm': ["That's a peaceful question to consider. I believe...", "I'll ponder that quietly. It seems to me...", "A calm question deserves a thoughtful answer..."],
-                'playful': ["Hehe, tricky question! Let me play with that idea...", "Fun question! I'd say...", "Ooh, interesting! I think..."]
-            }
+            questions = self.FALLBACK_QUESTIONS
             return random.choice(questions.get(voice_style, questions['natural']))
         
         # Default varied responses
-        responses = {
-            'natural': [
-                "I understand what you mean. That's really interesting.",
-                "Thanks for sharing that with me. It gives me something to think about.",
-                "I see what you're saying. That's a good point to consider.",
-                "You make a good observation there. I appreciate your perspective.",
-                "That's a thoughtful thing to say. I'm enjoying our conversation."
-            ],
-            'warm': [
-                "I really appreciate you sharing that. It means a lot to hear your thoughts.",
-                "Thank you for being so open. I value our conversations.",
-                "That's very considerate of you to mention. I'm touched.",
-                "I'm glad we can talk like this. Your perspective is important.",
-                "You have a kind way of expressing yourself. I enjoy our chats."
-            ],
-            'energetic': [
-                "Wow, that's awesome! I love hearing your thoughts!",
-                "Cool! That's really exciting to hear!",
-                "Fantastic! I'm so glad you mentioned that!",
-                "Amazing! Your perspective is really energizing!",
-                "Great point! I'm pumped about our conversation!"
-            ],
-            'calm': [
-                "That's peaceful to consider. I appreciate the calm in your words.",
-                "Thank you for the gentle thoughts. It's soothing to chat.",
-                "I find comfort in our conversation. Your words are calming.",
-                "That's a serene perspective. I enjoy our peaceful chats.",
-                "Your gentle approach to conversation is refreshing."
-            ],
-            'playful': [
-                "Hehe, that's fun to think about! Let's explore that idea!",
-                "You have a playful perspective! I like that!",
-                "That's a mischievous thought! I'm intrigued!",
-                "Fun idea! Let's play with that concept!",
-                "You make conversation enjoyable with your playful approach!"
-            ]
-        }
-        
+        responses = self.FALLBACK_RESPONSES
         return random.choice(responses.get(voice_style, responses['natural']))
 
+# Replies made without the LLM; the retrieval index skips them
+CANNED_REPLIES = frozenset(
+    line
+    for bank in (GeminiChatAssistant.FALLBACK_GREETINGS, GeminiChatAssistant.FALLBACK_QUESTIONS,
+                 GeminiChatAssistant.FALLBACK_RESPONSES, *intents.REPLIES.values())
+    for lines in bank.values()
+    for line in lines
+)
+
 # Initialize systems
 voice_system = NaturalVoiceSystem()
 chat_assistant = GeminiChatAssistant()
 
+# --- Application Startup ---
+_started = False
+_startup_lock = threading.Lock()
+
+def startup():
+    """Per-process startup: database schema and background TTS warm-up"""
+    global _started
+    if _started:
+        return
+    
+    with _startup_lock:
+        if _started:
+            return
+        init_db()
+        index_page()
+        if retrieval.RETRIEVAL_ENABLED and not (gemini_connected() and chat_assistant.keys):
+            # Without Gemini every reply comes from the fallback tier
+            retrieval.get_index(get_storage(), CANNED_REPLIES).start()
+        tts.start_warmup()
+        if tts.get_tts_router().available():
+            tts.start_ack_bank(render_ack)
+        _started = True
+
+def create_app():
+    """App factory for WSGI servers, e.g. gunicorn 'app:create_app()'"""
+    startup()
+    return app
+
+def preload_shared_state():
+    """Build read-only state in a pre-fork master so workers share it copy-on-write.
+    
+    TTS models are not loaded here: ONNX runtime sessions own thread pools that
+    do not survive fork, so each worker warms them up after forking.
+    """
+    init_db()
+    index_page()
+    intents.get_router().model()
+    for style in NaturalVoiceSystem.VOICE_STYLES:
+        NaturalVoiceSystem.voice_settings_json(style)
+    # Move everything allocated so far out of the GC's view; otherwise the
+    # first collection in each worker touches (and copies) every shared page.
+    import gc
+    gc.collect()
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+def is_ready():
+    """True once startup finished and configured TTS voices are warm"""
+    return _started and tts.warmup_done.is_set()
+
+@app.before_request
+def _ensure_started():
+    # Covers servers that import `app:app` directly instead of the factory
+    if not _started:
+        startup()
+
+# --- HTTP Caching and Compression ---
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))  # below this, headers outweigh the savings
+# Per-request JSON uses the fastest settings: on a 19 KB history they cut it
+# to ~4.8 KB for ~0.1 ms, where gzip -6 saves 700 more bytes for 4x the CPU.
+# Constant bodies are compressed once, at the highest settings.
+JSON_GZIP_LEVEL = 1
+JSON_BROTLI_QUALITY = 1
+
+def _compress(body, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(body, quality=JSON_BROTLI_QUALITY if level is None else level)
+    return gzip.compress(body, compresslevel=JSON_GZIP_LEVEL if level is None else level, mtime=0)
+
+def _accepted_encoding(available):
+    """The best of `available` content codings the client accepts (br over gzip), or None"""
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+def _body_etag(body):
+    return hashlib.blake2b(body, digest_size=12).hexdigest()
+
+class PreparedResponse:
+    """A constant response body with its ETag and compressed variants built once.
+    
+    The ETag is weak so that every encoding of the body shares it; requests
+    carrying it (or an If-Modified-Since not older than last_modified) get
+    a 304 with no body. Headers are prepared up front too: werkzeug's header
+    helpers cost more per request than sending the page.
+    """
+    
+    def __init__(self, body, mimetype, last_modified=None):
+        self.etag = _body_etag(body)
+        self.last_modified = (last_modified or datetime.now(timezone.utc)).replace(microsecond=0)
+        self.variants = {None: body, 'gzip': _compress(body, 'gzip', level=9)}
+        if brotli is not None:
+            self.variants['br'] = _compress(body, 'br', level=11)
+        
+        self.validators = [
+            ('ETag', f'W/"{self.etag}"'),
+            ('Last-Modified', http_date(self.last_modified)),
+            ('Cache-Control', 'no-cache'),  # revalidate every time: a deploy can change it
+            ('Vary', 'Accept-Encoding'),
+        ]
+        content_type = f'{mimetype}; charset=utf-8' if mimetype.startswith('text/') else mimetype
+        self.headers = {
+            encoding: [('Content-Type', content_type), *self.validators]
+                      + ([('Content-Encoding', encoding)] if encoding else [])
+            for encoding in self.variants
+        }
+    
+    def not_modified(self):
+        if 'If-None-Match' in request.headers:
+            return request.if_none_match.contains_weak(self.etag)
+        since = request.if_modified_since
+        return since is not None and since >= self.last_modified
+    
+    def response(self):
+        if self.not_modified():
+            return app.response_class(status=304, headers=self.validators)
+        encoding = _accepted_encoding(self.variants)
+        return app.response_class(self.variants[encoding], headers=self.headers[encoding])
+
+_index_pages = {}  # template mtime -> PreparedResponse
+
+def index_page():
+    """The rendered index.html, re-rendered only when the template file changes"""
+    path = os.path.join(app.root_path, app.template_folder, 'index.html')
+    mtime = os.stat(path).st_mtime
+    page = _index_pages.get(mtime)
+    if page is None:
+        with app.app_context():
+            body = render_template('index.html').encode()
+        page = PreparedResponse(body, 'text/html', datetime.fromtimestamp(mtime, timezone.utc))
+        _index_pages.clear()
+        _index_pages[mtime] = page
+    return page
+
+@lru_cache(maxsize=8)
+def service_status(gemini_connected, server_tts):
+    """The /status body, also embedded in /bootstrap"""
+    return json.dumps({
+        "status": "success",
+        "server": "running",
+        "gemini_ai": "connected" if gemini_connected else "disconnected",
+        "features": {
+            "natural_voice": True,
+            "human_like_conversation": True,
+            "emotion_detection": True,
+            "voice_input": True,
+            "gemini_responses": gemini_connected,
+            "server_tts": server_tts
+        }
+    })
+
+@lru_cache(maxsize=8)
+def status_page(gemini_connected, server_tts):
+    return PreparedResponse(service_status(gemini_connected, server_tts).encode(), app.json.mimetype)
+
+VOICES_PAGE = PreparedResponse(VOICES_JSON.encode(), 'application/json')
+
+@app.after_request
+def _conditional_and_compressed(response):
+    """Per-request JSON: an ETag (and 304) for GETs, compression above COMPRESS_MIN_BYTES"""
+    if (response.mimetype != 'application/json' or response.status_code != 200 or response.is_streamed
+            or response.direct_passthrough or response.content_encoding):
+        return response
+    body = response.get_data()
+    if request.method == 'GET' and response.get_etag()[0] is None:
+        response.set_etag(_body_etag(body), weak=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response = response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+    if len(body) >= COMPRESS_MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+        encoding = _accepted_encoding(('br', 'gzip') if brotli is not None else ('gzip',))
+        if encoding:
+            response.set_data(_compress(body, encoding))
+            response.content_encoding = encoding
+    return response
+
 # --- Flask Routes ---
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return index_page().response()
 
 @app.route('/register', methods=['POST'])
 def register():
@@ -626,10 +1346,7 @@ def login():
     
     token = create_session_token(user_id)
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT username, email FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
+    user = get_storage().users.profile(user_id)
     
     return jsonify({
         "status": "success",
@@ -646,32 +1363,17 @@ def profile():
     """Get user profile information"""
     user_id = request.user_id
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT username, email, created_at, last_login FROM users WHERE id = ?', (user_id,))
-        user = cursor.fetchone()
-        
-        if not user:
-            return jsonify({"status": "error", "message": "User not found"}), 404
+    user = get_storage().users.profile(user_id)
+    if not user:
+        return jsonify({"status": "error", "message": "User not found"}), 404
     
     return jsonify({
         "status": "success",
-        "profile": dict(user)
+        "profile": user
     })
 
-@app.route('/chat', methods=['POST'])
-@login_required
-def chat():
-    """Handle chat with natural responses"""
-    user_id = request.user_id
-    data = request.get_json()
-    user_message = data.get('message', '').strip()
-    voice_style = data.get('voice_style', 'natural')
-    conversation_id = data.get('conversation_id', f"conv_{datetime.now().timestamp()}")
-    
-    if not user_message:
-        return jsonify({"status": "error", "message": "No message provided"}), 400
-    
+def _chat_reply(user_id, user_message, voice_style, conversation_id, user_prefs, mode='text', **extra):
+    """Generate and store one assistant turn; returns the JSON body"""
     # Get conversation history for context
     history = get_conversation_history(user_id, conversation_id, limit=5)
     
@@ -679,27 +1381,146 @@ def chat():
     save_chat_message(user_id, conversation_id, 'user', user_message, voice_style)
     
     # Generate response using Gemini AI
-    response_data = chat_assistant.generate_response(user_message, history, user_id, voice_style)
+    response_data = chat_assistant.generate_response(user_message, history, user_id, voice_style, conversation_id, mode)
     
     # Save bot response with emotion
     save_chat_message(user_id, conversation_id, 'assistant', response_data['text'], 
                      voice_style, response_data['emotion'])
     
-    # Get voice settings
-    voice_settings = voice_system.get_voice_settings(voice_style)
-    
-    # Add user's custom speech preferences
-    user_prefs = get_user_preferences(user_id)
-    voice_settings['user_rate'] = user_prefs.get('speech_rate', 1.0)
-    voice_settings['user_pitch'] = user_prefs.get('speech_pitch', 1.0)
+    # Voice settings merged with the user's custom speech preferences
+    voice_settings = voice_system.voice_settings_json(
+        voice_style, user_prefs.get('speech_rate', 1.0), user_prefs.get('speech_pitch', 1.0)
+    )
     
-    return jsonify({
+    return json_body({
         "status": "success",
         **response_data,
-        "voice_settings": voice_settings,
         "conversation_id": conversation_id,
         "timestamp": datetime.now().isoformat(),
-        "gemini_used": response_data['is_gemini']
+        "gemini_used": response_data['is_gemini'],
+        **extra
+    }, voice_settings=voice_settings)
+
+@app.route('/chat', methods=['POST'])
+@login_required
+def chat():
+    """Handle chat with natural responses.
+    
+    With "stream": true the response is NDJSON: an acknowledgement clip
+    ({"type": "ack", ...}) is flushed at once, then {"type": "reply", ...}
+    follows when the reply is ready. "mode": "voice" marks a spoken turn,
+    which gets a shorter reply budget.
+    """
+    user_id = request.user_id
+    data = request.get_json()
+    user_message = data.get('message', '').strip()
+    voice_style = data.get('voice_style', 'natural')
+    conversation_id = data.get('conversation_id') or storage.new_ulid()
+    mode = data.get('mode') if data.get('mode') in model_routing.MODES else 'text'
+    
+    if not user_message:
+        return jsonify({"status": "error", "message": "No message provided"}), 400
+    
+    user_prefs = get_cached_preferences(user_id)
+    if not data.get('stream'):
+        body = _chat_reply(user_id, user_message, voice_style, conversation_id, user_prefs, mode)
+        return app.response_class(body + '\n', mimetype=app.json.mimetype)
+    
+    fmt = data.get('format', audio.DEFAULT_FORMAT)
+    ack = ack_clip(voice_style, user_prefs.get('use_fillers', 1), fmt if fmt in audio.AUDIO_FORMATS else audio.DEFAULT_FORMAT)
+    
+    def events():
+        if ack is not None:
+            yield app.json.dumps({"type": "ack", **ack}) + '\n'
+        yield _chat_reply(user_id, user_message, voice_style, conversation_id, user_prefs, mode, type="reply") + '\n'
+    
+    return app.response_class(events(), mimetype='application/x-ndjson')
+
+TTS_MAX_CHARS = 2000
+
+def render_speech(text, voice_style='natural', prefs=DEFAULT_PREFERENCES, quality='standard'):
+    """Synthesize text with the voice style's prosody and the user's preferences applied.
+    
+    Returns (int16 samples, sample rate, names of the engines used).
+    """
+    settings = voice_system.get_voice_settings(voice_style)
+    if prefs.get('use_fillers', 1):
+        text = audio.add_fillers(text)
+    pauses = len(audio.split_sentences(text)) - 1 if prefs.get('use_pauses', 1) else 0
+    
+    samples, sample_rate, engines = tts.get_tts_router().synthesize(text, voice_style, quality)
+    samples = audio.apply_prosody(
+        samples, sample_rate,
+        rate=settings['rate'] * prefs.get('speech_rate', 1.0),
+        pitch=settings['pitch'] * prefs.get('speech_pitch', 1.0),
+        volume=settings['volume'],
+        pauses=pauses,
+        pause_seconds=audio.SENTENCE_PAUSE_SECONDS * settings['pause_duration'],
+    )
+    return samples, sample_rate, engines
+
+# Acknowledgement phrases already carry their own fillers and are one sentence
+ACK_PREFERENCES = MappingProxyType({**DEFAULT_PREFERENCES, 'use_fillers': 0, 'use_pauses': 0})
+_ack_audio = {}  # (style, text, format) -> encoded clip
+
+def render_ack(text, voice_style):
+    """Renderer for tts.ack_bank: same engines and prosody as the replies it precedes"""
+    samples, sample_rate, _ = render_speech(text, voice_style, ACK_PREFERENCES)
+    return samples, sample_rate
+
+def ack_clip(voice_style, use_fillers, fmt=audio.DEFAULT_FORMAT):
+    """A ready-made acknowledgement clip as a JSON-able dict, or None"""
+    clip = tts.ack_bank.pick(voice_style, use_fillers)
+    if clip is None:
+        return None
+    text, samples, sample_rate = clip
+    key = (voice_style, text, fmt)
+    encoded = _ack_audio.get(key)
+    if encoded is None:
+        body, mimetype = audio.encode_audio(samples, sample_rate, fmt)
+        encoded = _ack_audio[key] = {
+            "text": text,
+            "mimetype": mimetype,
+            "audio": base64.b64encode(body).decode('ascii'),
+            "duration": round(len(samples) / sample_rate, 3)
+        }
+    return encoded
+
+@app.route('/tts', methods=['POST'])
+@login_required
+def text_to_speech():
+    """Synthesize speech server-side and return compressed audio"""
+    data = request.get_json() or {}
+    text = data.get('text', '').strip()
+    voice_style = data.get('voice_style', 'natural')
+    fmt = data.get('format', audio.DEFAULT_FORMAT)
+    
+    if not text:
+        return jsonify({"status": "error", "message": "No text provided"}), 400
+    if len(text) > TTS_MAX_CHARS:
+        return jsonify({"status": "error", "message": f"Text longer than {TTS_MAX_CHARS} characters"}), 400
+    if fmt not in audio.AUDIO_FORMATS:
+        return jsonify({"status": "error", "message": f"format must be one of {', '.join(audio.AUDIO_FORMATS)}"}), 400
+    
+    quality = data.get('quality', 'standard')
+    if quality not in tts.QUALITY_LEVELS:
+        return jsonify({"status": "error", "message": f"quality must be one of {', '.join(tts.QUALITY_LEVELS)}"}), 400
+    
+    if not tts.get_tts_router().available(voice_style, quality):
+        return jsonify({"status": "error", "message": "Server-side voice not configured"}), 503
+    
+    try:
+        samples, sample_rate, engines = render_speech(text, voice_style, get_cached_preferences(request.user_id), quality)
+    except tts.NoEngineError as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
+    except tts.TTSError as e:
+        print(f"❌ TTS error: {e}")
+        return jsonify({"status": "error", "message": "Voice generation failed"}), 502
+    
+    body, mimetype = audio.encode_audio(samples, sample_rate, fmt)
+    return app.response_class(body, mimetype=mimetype, headers={
+        "X-Audio-Duration": f"{len(samples) / sample_rate:.3f}",
+        "X-TTS-Engine": ','.join(engines)
     })
 
 @app.route('/history', methods=['GET'])
@@ -709,55 +1530,127 @@ def get_history():
     conversation_id = request.args.get('conversation_id', 'default')
     limit = request.args.get('limit', 50, type=int)
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT role, content, voice_style, emotion, created_at
-            FROM chat_messages 
-            WHERE user_id = ? AND conversation_id = ?
-            ORDER BY created_at ASC
-            LIMIT ?
-        ''', (user_id, conversation_id, limit))
-        
-        messages = cursor.fetchall()
+    messages = get_storage().messages.history(user_id, conversation_id, limit)
     
     return jsonify({
         "status": "success",
-        "messages": [dict(msg) for msg in messages],
+        "messages": messages,
         "conversation_id": conversation_id
     })
 
+@app.route('/search', methods=['GET'])
+@login_required
+def search():
+    """Full-text search over the user's chat history"""
+    user_id = request.user_id
+    text = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 20, type=int), 1), SEARCH_MAX_LIMIT)
+    
+    if not search_available:
+        return jsonify({"status": "error", "message": "Search is not available"}), 503
+    if not text:
+        return jsonify({"status": "error", "message": "No search query provided"}), 400
+    
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = parse_search_cursor(request.args['cursor'])
+        except ValueError:
+            return jsonify({"status": "error", "message": "Invalid cursor"}), 400
+    
+    hits, next_cursor = search_messages(user_id, text, limit, after)
+    
+    return jsonify({
+        "status": "success",
+        "results": hits,
+        "next_cursor": next_cursor
+    })
+
+@app.route('/export', methods=['GET'])
+@login_required
+def export():
+    """Download the user's full chat history as NDJSON or CSV (streamed)"""
+    user_id = request.user_id
+    fmt = request.args.get('format', 'ndjson')
+    compress = request.args.get('gzip', '0').lower() in ('1', 'true', 'yes')
+    
+    if fmt not in ('ndjson', 'csv'):
+        return jsonify({"status": "error", "message": "format must be 'ndjson' or 'csv'"}), 400
+    
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    filename = f"aiko_history.{fmt}" + ('.gz' if compress else '')
+    if compress:
+        mimetype = 'application/gzip'
+    
+    return app.response_class(
+        export_messages(user_id, fmt, compress),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 @app.route('/conversations', methods=['GET'])
 @login_required
 def get_conversations():
     """Get list of user's conversations"""
     user_id = request.user_id
     
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT DISTINCT conversation_id, MAX(created_at) as last_activity
-            FROM chat_messages 
-            WHERE user_id = ?
-            GROUP BY conversation_id
-            ORDER BY last_activity DESC
-            LIMIT 20
-        ''', (user_id,))
-        
-        conversations = cursor.fetchall()
+    conversations = get_storage().messages.conversations(user_id, limit=20)
     
     return jsonify({
         "status": "success",
-        "conversations": [dict(conv) for conv in conversations]
+        "conversations": conversations
     })
 
+@app.route('/bootstrap', methods=['GET'])
+def bootstrap():
+    """Everything the page needs once loaded, in one round trip.
+    
+    Profile, preferences, voice styles, service status, the recent
+    conversations and the latest page of the newest one. The token check and
+    every read share one read transaction, so the parts are consistent.
+    """
+    auth_token = request.headers.get('Authorization') or request.cookies.get('auth_token')
+    if not auth_token:
+        return jsonify({"status": "error", "message": "Authentication required"}), 401
+    
+    limit = min(max(request.args.get('limit', BOOTSTRAP_HISTORY_LIMIT, type=int), 1), BOOTSTRAP_HISTORY_LIMIT)
+    db = get_storage()
+    
+    with db.read_transaction() as conn:
+        user_id = db.sessions.user_for_token(auth_token, datetime.now(), conn)
+        if not user_id:
+            return jsonify({"status": "error", "message": "Invalid or expired token"}), 401
+        
+        user = db.users.profile(user_id, conn)
+        if not user:
+            return jsonify({"status": "error", "message": "User not found"}), 404
+        
+        generation, prefs = db.preferences.get(user_id, conn)
+        with db.message_reads(user_id, conn) as message_conn:
+            conversations = db.messages.conversations(user_id, limit=20, conn=message_conn)
+            conversation_id = conversations[0]['conversation_id'] if conversations else None
+            messages = db.messages.latest_page(user_id, conversation_id, limit, message_conn) if conversation_id else []
+    
+    prefs = MappingProxyType(prefs or dict(DEFAULT_PREFERENCES))
+    _store_preferences(user_id, generation, prefs)
+    
+    return json_response({
+        "status": "success",
+        "user_id": user_id,
+        "profile": user,
+        "preferences": dict(prefs),
+        "conversations": conversations,
+        "conversation_id": conversation_id,
+        "messages": messages
+    }, voices=VOICE_STYLES_JSON, service=service_status(gemini_connected(), tts.get_tts_router().available()))
+
 @app.route('/preferences', methods=['GET', 'PUT'])
 @login_required
 def preferences():
     user_id = request.user_id
     
     if request.method == 'GET':
-        prefs = get_user_preferences(user_id)
+        prefs = dict(get_cached_preferences(user_id))
         return jsonify({"status": "success", "preferences": prefs})
     
     elif request.method == 'PUT':
@@ -774,9 +1667,7 @@ def logout():
     auth_token = request.headers.get('Authorization') or request.cookies.get('auth_token')
     
     if auth_token:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute('DELETE FROM user_sessions WHERE session_token = ?', (auth_token,))
+        get_storage().sessions.delete(auth_token)
     
     return jsonify({
         "status": "success",
@@ -785,36 +1676,132 @@ def logout():
 
 @app.route('/voices', methods=['GET'])
 def get_voices():
-    return jsonify({
-        "status": "success",
-        "voices": voice_system.VOICE_STYLES
-    })
+    return VOICES_PAGE.response()
 
 @app.route('/status', methods=['GET'])
 def status():
+    return status_page(gemini_connected(), tts.get_tts_router().available()).response()
+
+# /metrics shows key labels, the worker pid and engine internals, so it is
+# for operators only: requests need "Authorization: Bearer <METRICS_TOKEN>",
+# and without a token configured the endpoint is off
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Runtime counters for this worker process"""
+    if not METRICS_TOKEN:
+        return jsonify({"status": "error", "message": "Metrics are disabled (set METRICS_TOKEN)"}), 404
+    if not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return jsonify({"status": "error", "message": "Authentication required"}), 401
+    
     return jsonify({
         "status": "success",
-        "server": "running",
-        "gemini_ai": "connected" if gemini_available else "disconnected",
-        "features": {
-            "natural_voice": True,
-            "human_like_conversation": True,
-            "emotion_detection": True,
-            "voice_input": True,
-            "gemini_responses": gemini_available
-        }
+        "pid": os.getpid(),
+        "tts_batching": tts.get_piper_batcher().stats(),
+        "tts_engines": tts.get_tts_router().stats(),
+        "gemini_cache": gemini_cache.stats(),
+        "local_intents": intents.get_router().stats(),
+        "model_tiers": model_routing.get_router().stats(),
+        "llm_bulkhead": bulkhead.get_llm_bulkhead().stats(),
+        "gemini_keys": key_pool.get_key_pool().stats()
     })
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    """Readiness probe for load balancers and rolling reloads"""
+    if is_ready():
+        return jsonify({"status": "success", "ready": True})
+    return jsonify({"status": "error", "ready": False}), 503
+
 @app.route('/api/key', methods=['GET'])
 @login_required
 def get_api_key():
     """Check if API key is available"""
-    gemini_api_key = os.getenv("GEMINI_API_KEY")
     return jsonify({
         "status": "success",
-        "has_key": bool(gemini_api_key)
+        "has_key": bool(key_pool.get_key_pool())
     })
 
+# --- CLI Commands ---
+@app.cli.command('export')
+@click.argument('username')
+@click.option('--format', 'fmt', type=click.Choice(['ndjson', 'csv']), default='ndjson')
+@click.option('--gzip', 'compress', is_flag=True, help="gzip-compress the output")
+@click.option('--output', '-o', type=click.Path(dir_okay=False), required=True, help="output file")
+def export_command(username, fmt, compress, output):
+    """Export a user's chat history: flask --app app export USERNAME -o FILE"""
+    startup()
+    user_id = get_storage().users.id_for_username(username)
+    if not user_id:
+        raise click.ClickException(f"User not found: {username}")
+    
+    with open(output, 'wb') as stream:
+        for chunk in export_messages(user_id, fmt, compress):
+            stream.write(chunk)
+    click.echo(f"✅ Exported {username}'s history to {output}")
+
+@app.cli.command('migrate')
+@click.option('--batch-size', type=int, default=1000, show_default=True, help="rows per transaction")
+@click.option('--pause', type=float, default=0.05, show_default=True, help="seconds to sleep between batches")
+@click.option('--dry-run', is_flag=True, help="estimate the pending migrations in a rolled-back transaction")
+def migrate_command(batch_size, pause, dry_run):
+    """Apply pending schema migrations; backfills run in small batches while the app serves"""
+    _check_shard_layout()
+    db = get_storage()
+    if dry_run:
+        for database in migrations.databases(db):
+            version, results = migrations.estimate(database, batch_size, pause)
+            click.echo(f"{database.name}: version {version}, latest {migrations.LATEST_VERSION}")
+            for migration, schema_seconds, rows, backfill_seconds in results:
+                if schema_seconds is None:
+                    click.echo(f"  {migration.version} {migration.name}: no estimate (DDL is not transactional here)")
+                    continue
+                line = f"  {migration.version} {migration.name}: schema {schema_seconds:.2f} s"
+                if rows:
+                    line += (f", backfill {rows:,} rows in ~{backfill_seconds:.1f} s "
+                             f"({math.ceil(rows / batch_size):,} batches)")
+                click.echo(line)
+        return
+    
+    migrations.upgrade(db, backfill_below=0)
+    for database in migrations.databases(db):
+        current, done = None, 0
+        for migration, rows in migrations.run_backfills(database, batch_size):
+            if migration is not current:
+                if current is not None:
+                    click.echo(err=True)
+                current, done = migration, 0
+            done += rows
+            click.echo(f"\r  {database.name}: {migration.version} {migration.name}: {done:,} rows", nl=False, err=True)
+            time.sleep(pause)
+        if current is not None:
+            click.echo(err=True)
+    click.echo(f"✅ Schema at version {migrations.LATEST_VERSION}")
+
+@app.cli.command('reshard')
+@click.option('--from', 'source', type=int, default=None, help="current shard count (default: MESSAGE_SHARDS)")
+@click.option('--to', 'target', type=int, required=True, help="new shard count, 0 for the main database")
+@click.option('--chunk-size', type=int, default=5000, show_default=True)
+def reshard_command(source, target, chunk_size):
+    """Move chat messages to a new shard count; run with the app stopped"""
+    source = MESSAGE_SHARDS if source is None else source
+    if source == target:
+        raise click.ClickException(f"Messages are already in {source} shards")
+    
+    source_db, target_db = get_storage(source), get_storage(target)
+    for db in (source_db, target_db):
+        # Finish backfills first: deleting moved rows fires the search index
+        # triggers, which expect every message to be indexed
+        migrations.upgrade(db, backfill_below=0)
+        for database in migrations.databases(db):
+            for _ in migrations.run_backfills(database, chunk_size):
+                pass
+    moved = storage.reshard(source_db, target_db, chunk_size,
+                            progress=lambda count: click.echo(f"\r  {count:,} messages moved", nl=False, err=True))
+    click.echo(f"\n✅ Moved {moved:,} messages to {f'{target} shards' if target else 'the main database'}; "
+               f"set MESSAGE_SHARDS={target} and restart")
+
 # --- Main Entry Point ---
 if __name__ == '__main__':
     print("=" * 70)
@@ -826,19 +1813,13 @@ if __name__ == '__main__':
     print("   • 5 distinct personality styles")
     print("=" * 70)
     
-    # Initialize database
+    # Initialize database; on failure, stop rather than serve (or lose) existing data
     try:
-        init_db()
-        print("✅ Database initialized successfully")
+        startup()
     except Exception as e:
-        print(f"⚠️ Database initialization error: {e}")
-        try:
-            if os.path.exists(DATABASE):
-                os.remove(DATABASE)
-            init_db()
-            print("✅ Database recreated successfully")
-        except:
-            print("❌ Failed to initialize database")
+        print(f"❌ Database initialization failed: {e}")
+        print("   Nothing was deleted; fix the cause, then run `flask --app app migrate --dry-run` to check")
+        raise SystemExit(1)
     
     port = int(os.environ.get('PORT', 5000))
     print(f"🌐 Server: http://localhost:{port}")
@@ -0,0 +1,258 @@
+"""Audio buffer helpers for server-side speech.
+
+Audio moves through the server as numpy int16 arrays (mono). Decoding
+wraps the raw PCM bytes without copying, and encoding goes straight to an
+in-memory compressed file, so each reply is copied as few times as possible.
+numpy, scipy and soundfile are imported on first use to keep app startup fast.
+"""
+import io
+import random
+import re
+
+# format -> (soundfile container, subtype, compression level, mimetype)
+# Vorbis is the default: at a similar size (~20 KB for 4 s of speech) it
+# encodes about 10x faster than libsndfile's Opus encoder.
+AUDIO_FORMATS = {
+    'ogg': ('OGG', 'VORBIS', 0.9, 'audio/ogg; codecs=vorbis'),
+    'opus': ('OGG', 'OPUS', 0.9, 'audio/ogg; codecs=opus'),
+    'flac': ('FLAC', 'PCM_16', None, 'audio/flac'),
+    'wav': ('WAV', 'PCM_16', None, 'audio/wav'),
+}
+DEFAULT_FORMAT = 'ogg'
+# Opus only encodes at these rates; anything else is resampled first
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+
+def pcm16_from_bytes(data):
+    """View little-endian 16-bit PCM bytes as an int16 array (no copy)"""
+    import numpy as np
+    if len(data) % 2:
+        data = memoryview(data)[:-1]
+    return np.frombuffer(data, dtype='<i2')
+
+
+def parse_pcm_mimetype(mimetype, default_rate=24000):
+    """Sample rate from an 'audio/L16;codec=pcm;rate=24000' mimetype"""
+    for param in mimetype.split(';')[1:]:
+        key, _, value = param.strip().partition('=')
+        if key == 'rate' and value.isdigit():
+            return int(value)
+    return default_rate
+
+
+def resample(samples, sample_rate, target_rate):
+    """Resample int16 mono audio to target_rate"""
+    from math import gcd
+    import numpy as np
+    from scipy.signal import resample_poly
+    divisor = gcd(sample_rate, target_rate)
+    resampled = resample_poly(samples.astype(np.float32), target_rate // divisor, sample_rate // divisor)
+    return np.clip(resampled, -32768, 32767).astype(np.int16)
+
+
+def encode_audio(samples, sample_rate, fmt=DEFAULT_FORMAT):
+    """Encode int16 mono samples; returns (bytes, mimetype)"""
+    import soundfile as sf
+
+    container, subtype, compression_level, mimetype = AUDIO_FORMATS[fmt]
+    if subtype == 'OPUS' and sample_rate not in OPUS_SAMPLE_RATES:
+        target = min(rate for rate in OPUS_SAMPLE_RATES if rate >= min(sample_rate, 48000))
+        samples, sample_rate = resample(samples, sample_rate, target), target
+
+    buffer = io.BytesIO()
+    sf.write(buffer, samples, sample_rate, format=container, subtype=subtype,
+             compression_level=compression_level)
+    return buffer.getvalue(), mimetype
+
+
+# --- Prosody post-processing ---
+# Everything below works on whole arrays (STFT frames, boolean masks, cumulative
+# sums); there are no per-sample Python loops, so the cost scales with numpy.
+STFT_SIZE = 1024
+STFT_HOP = 256
+SENTENCE_PAUSE_SECONDS = 0.35   # scaled by a voice style's pause_duration
+SILENCE_FRAME_SECONDS = 0.01
+SILENCE_THRESHOLD_DB = -40.0
+TARGET_RMS_DB = -20.0
+PEAK_LIMIT = 10 ** (-1.0 / 20)  # -1 dBFS
+
+FILLERS = ("Well, ", "Hmm, ", "So, ", "You know, ")
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def split_sentences(text):
+    return [sentence for sentence in _SENTENCE_END.split(text.strip()) if sentence]
+
+
+def add_fillers(text, probability=0.25):
+    """Start some sentences with a conversational filler (deterministic per text)"""
+    rng = random.Random(text)
+    sentences = split_sentences(text)
+    for i, sentence in enumerate(sentences):
+        if rng.random() < probability and sentence[:1].isupper():
+            sentences[i] = rng.choice(FILLERS) + sentence[0].lower() + sentence[1:]
+    return ' '.join(sentences)
+
+
+def _to_float(samples):
+    import numpy as np
+    return samples.astype(np.float32) / 32768.0
+
+
+def _to_int16(samples):
+    import numpy as np
+    return (np.clip(samples, -1.0, 1.0) * 32767.0).astype(np.int16)
+
+
+def _hann():
+    import numpy as np
+    return (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(STFT_SIZE) / STFT_SIZE)).astype(np.float32)
+
+
+def _stft(samples):
+    """Frames x bins spectrum; the signal is padded by half a frame on each side"""
+    import numpy as np
+    padded = np.pad(samples, STFT_SIZE // 2)
+    frames = np.lib.stride_tricks.sliding_window_view(padded, STFT_SIZE)[::STFT_HOP]
+    return np.fft.rfft(frames * _hann(), axis=1).astype(np.complex64)
+
+
+def _istft(spectrum, length):
+    """Weighted overlap-add of all frames at once (the hop divides the frame size)"""
+    import numpy as np
+    window = _hann()
+    frames = np.fft.irfft(spectrum, n=STFT_SIZE, axis=1).astype(np.float32) * window
+    count, overlap = frames.shape[0], STFT_SIZE // STFT_HOP
+    # Split each frame into hop-sized blocks; block j of frame i lands at hop i + j
+    blocks = frames.reshape(count, overlap, STFT_HOP)
+    output = np.zeros((count + overlap - 1, STFT_HOP), dtype=np.float32)
+    norm = np.zeros_like(output)
+    squared = (window * window).reshape(overlap, STFT_HOP)
+    for j in range(overlap):
+        output[j:j + count] += blocks[:, j]
+        norm[j:j + count] += squared[j]
+    output = (output / np.maximum(norm, 1e-6)).ravel()
+    return output[STFT_SIZE // 2:STFT_SIZE // 2 + length]
+
+
+def time_stretch(samples, rate):
+    """Phase-vocoder time stretch: rate > 1 is faster/shorter, pitch unchanged"""
+    import numpy as np
+
+    if abs(rate - 1.0) < 1e-3 or samples.size < STFT_SIZE:
+        return samples
+
+    spectrum = _stft(samples)
+    magnitudes, phases = np.abs(spectrum), np.angle(spectrum)
+    positions = np.arange(0, spectrum.shape[0] - 1, rate)
+    left = positions.astype(int)
+    frac = (positions - left)[:, np.newaxis].astype(np.float32)
+
+    magnitude = (1 - frac) * magnitudes[left] + frac * magnitudes[left + 1]
+
+    # Expected phase advance per hop for each bin, plus the measured deviation;
+    # the output phase is their running sum, taken with one cumsum
+    expected = (2 * np.pi * STFT_HOP / STFT_SIZE * np.arange(spectrum.shape[1])).astype(np.float32)
+    advance = phases[left + 1] - phases[left] - expected
+    advance -= 2 * np.pi * np.round(advance / (2 * np.pi))
+    advance += expected
+    phase = phases[0] + np.cumsum(advance, axis=0) - advance[0]
+
+    stretched = np.empty(phase.shape, dtype=np.complex64)
+    stretched.real = magnitude * np.cos(phase)
+    stretched.imag = magnitude * np.sin(phase)
+    return _istft(stretched, int(round(samples.size / rate)))
+
+
+def _resample_ratio(samples, ratio):
+    from fractions import Fraction
+    from scipy.signal import resample_poly
+    fraction = Fraction(ratio).limit_denominator(64)
+    return resample_poly(samples, fraction.numerator, fraction.denominator).astype(samples.dtype)
+
+
+def change_rate_and_pitch(samples, rate=1.0, pitch=1.0):
+    """Speed up by `rate` and raise pitch by `pitch` (both ratios), on float audio.
+
+    Pitch shifting is a stretch by pitch/rate followed by resampling by 1/pitch,
+    so both changes cost a single phase-vocoder pass.
+    """
+    if abs(pitch - 1.0) < 1e-3:
+        return time_stretch(samples, rate)
+    stretched = time_stretch(samples, rate / pitch)
+    return _resample_ratio(stretched, 1.0 / pitch)
+
+
+def _frame_db(samples, frame):
+    import numpy as np
+    usable = samples[:samples.size - samples.size % frame].reshape(-1, frame)
+    return 10 * np.log10(np.mean(usable * usable, axis=1) + 1e-12)
+
+
+def extend_pauses(samples, sample_rate, count, seconds):
+    """Lengthen the `count` longest internal silences to at least `seconds` each.
+
+    Used on replies synthesized in one piece, where sentence boundaries show
+    up as the longest gaps in the waveform.
+    """
+    import numpy as np
+
+    if count <= 0 or seconds <= 0:
+        return samples
+    frame = max(int(sample_rate * SILENCE_FRAME_SECONDS), 1)
+    silent = _frame_db(samples, frame) < SILENCE_THRESHOLD_DB
+    if not silent.any():
+        return samples
+
+    edges = np.diff(np.concatenate(([0], silent.view(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    internal = (starts > 0) & (ends < silent.size)
+    starts, ends = starts[internal], ends[internal]
+    if starts.size == 0:
+        return samples
+
+    longest = np.argsort(ends - starts)[::-1][:count]
+    starts, ends = starts[longest], ends[longest]
+    missing = np.maximum(int(seconds * sample_rate) - (ends - starts) * frame, 0)
+    keep = missing > 0
+    if not keep.any():
+        return samples
+
+    # One vectorized insert: each gap's midpoint repeated by the samples it lacks
+    midpoints = ((starts[keep] + ends[keep]) * frame) // 2
+    return np.insert(samples, np.repeat(midpoints, missing[keep]), 0)
+
+
+def normalize_loudness(samples, sample_rate, target_db=TARGET_RMS_DB):
+    """Scale voiced frames to target RMS, then limit peaks to -1 dBFS"""
+    import numpy as np
+    frame = max(int(sample_rate * SILENCE_FRAME_SECONDS), 1)
+    levels = _frame_db(samples, frame)
+    voiced = levels > SILENCE_THRESHOLD_DB
+    if not voiced.any():
+        return samples
+
+    rms_db = 10 * np.log10(np.mean(10 ** (levels[voiced] / 10)))
+    gain = 10 ** ((target_db - rms_db) / 20)
+    peak = np.max(np.abs(samples)) * gain
+    if peak > PEAK_LIMIT:
+        gain *= PEAK_LIMIT / peak
+    return samples * gain
+
+
+def apply_prosody(samples, sample_rate, rate=1.0, pitch=1.0, volume=1.0,
+                  pauses=0, pause_seconds=0.0, normalize=True):
+    """Full post-processing chain on int16 mono audio; returns int16.
+
+    pauses/pause_seconds lengthen that many sentence gaps (see extend_pauses)
+    before the rate change, so the pause length scales with speaking rate.
+    """
+    samples = _to_float(samples)
+    if pauses:
+        samples = extend_pauses(samples, sample_rate, pauses, pause_seconds)
+    samples = change_rate_and_pitch(samples, rate, pitch)
+    if normalize:
+        samples = normalize_loudness(samples, sample_rate)
+    if volume != 1.0:
+        samples = samples * volume
+    return _to_int16(samples)
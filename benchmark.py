@@ -0,0 +1,1586 @@
+"""Offline microbenchmarks for the per-turn hot paths in app.py.
+
+Every case runs offline: Gemini and the TTS engines are stubbed, and cases
+that need a database build a throwaway SQLite fixture (or use DATABASE_URL
+when it is set). Timings come from timeit (best of several repeats,
+reported as ns per call) and allocations from tracemalloc (peak bytes
+allocated during a single call).
+
+Usage:
+    python benchmark.py                 # run and compare with the stored baseline
+    python benchmark.py --save          # run and overwrite the stored baseline
+    python benchmark.py -k emotion      # only cases whose name contains "emotion"
+    python benchmark.py --check         # exit 1 if any case regressed
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from contextlib import contextmanager
+
+# Keep every case offline: without a key the assistant uses its local fallback
+# (the canned lines; the retrieval tier has its own group)
+os.environ.pop("GEMINI_API_KEY", None)
+os.environ["RETRIEVAL"] = "0"
+
+import app as aiko
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+REGRESSION_THRESHOLD = 1.5
+CALIBRATION_DATA = [f"{i:05d}-{i * 7919 % 10007}" for i in range(2000)]
+
+BENCHMARKS = []
+
+
+def benchmark(name, group='hot', max_peak_bytes=None):
+    """Register a zero-argument callable as a benchmark case.
+
+    With max_peak_bytes, the case fails if one call allocates more than that.
+    """
+    def decorator(fn):
+        BENCHMARKS.append({'name': name, 'group': group, 'fn': fn, 'max_peak_bytes': max_peak_bytes})
+        return fn
+    return decorator
+
+
+# --- Fixtures ---
+assistant = aiko.GeminiChatAssistant()
+
+SHORT_REPLY = "That's a **really** good point, I think."
+LONG_REPLY = " ".join(
+    ["Honestly, I *think* that's a **wonderful** idea and I'd love to hear more about it"] * 40
+)
+NEUTRAL_LONG_REPLY = " ".join(["The train leaves the station at nine in the evening"] * 40)
+KEYWORD_HEAVY_REPLY = " ".join(
+    ["Perhaps we could relax, have fun, and maybe consider something amazing, haha"] * 25
+)
+
+SHORT_MESSAGE = "hi"
+QUESTION_MESSAGE = "What do you think about learning to play the piano as an adult?"
+LONG_MESSAGE = " ".join(["I had a long day at work and I just want to talk about it"] * 20)
+
+HISTORY = [
+    {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"Message number {i}. " * 12, 'emotion': 'neutral'}
+    for i in range(10)
+]
+
+PASSWORD = "correct horse battery staple"
+STORED_HASH = aiko.hash_password(PASSWORD)
+
+
+# --- Cases ---
+@benchmark('detect_emotion_short')
+def _detect_emotion_short():
+    assistant._detect_emotion(SHORT_REPLY)
+
+
+@benchmark('detect_emotion_long_no_match')
+def _detect_emotion_long_no_match():
+    assistant._detect_emotion(NEUTRAL_LONG_REPLY)
+
+
+@benchmark('detect_emotion_many_keywords')
+def _detect_emotion_many_keywords():
+    assistant._detect_emotion(KEYWORD_HEAVY_REPLY)
+
+
+@benchmark('clean_response_short')
+def _clean_response_short():
+    assistant._clean_response(SHORT_REPLY)
+
+
+@benchmark('clean_response_long')
+def _clean_response_long():
+    assistant._clean_response(LONG_REPLY)
+
+
+@benchmark('fallback_greeting')
+def _fallback_greeting():
+    assistant._generate_fallback_response(SHORT_MESSAGE, 'warm')
+
+
+@benchmark('fallback_question')
+def _fallback_question():
+    assistant._generate_fallback_response(QUESTION_MESSAGE, 'calm')
+
+
+@benchmark('fallback_long_message')
+def _fallback_long_message():
+    assistant._generate_fallback_response(LONG_MESSAGE, 'playful')
+
+
+@benchmark('verify_password')
+def _verify_password():
+    aiko.verify_password(PASSWORD, STORED_HASH)
+
+
+@benchmark('build_prompt_empty_history')
+def _build_prompt_empty_history():
+    assistant._build_prompt(QUESTION_MESSAGE, [], 'natural')
+
+
+@benchmark('build_prompt_long_history')
+def _build_prompt_long_history():
+    assistant._build_prompt(LONG_MESSAGE, HISTORY, 'energetic')
+
+
+@benchmark('get_voice_settings')
+def _get_voice_settings():
+    aiko.NaturalVoiceSystem.get_voice_settings('calm')
+
+
+@benchmark('voice_settings_json_cached')
+def _voice_settings_json_cached():
+    aiko.NaturalVoiceSystem.voice_settings_json('calm', 1.1, 0.9)
+
+
+@benchmark('generate_response_offline')
+def _generate_response_offline():
+    assistant.generate_response(QUESTION_MESSAGE, HISTORY, 1, 'natural')
+
+
+# Local intent routing: a pattern hit, a model hit, a message left to the LLM,
+# and the share of a sample of turns that would be answered locally
+intent_router = aiko.intents.IntentRouter()
+INTENT_SAMPLE = (
+    "hi", "Hello!", "hey aiko", "how are you?", "thanks!", "thank you very much", "ok", "bye",
+    "good night", "cool", QUESTION_MESSAGE, LONG_MESSAGE, "Can you recommend a book?",
+    "I had a rough day", "what's your favourite song?", "Tell me about the moon", "why?",
+    "hi, can you help me with my essay?", "thanks, but that isn't right", "how old are you",
+)
+
+
+@benchmark('intent_route_pattern')
+def _intent_route_pattern():
+    intent_router.route(SHORT_MESSAGE, 'natural')
+
+
+@benchmark('intent_route_model')
+def _intent_route_model():
+    intent_router.route("thanks a bunch :)", 'natural')
+
+
+@benchmark('intent_route_to_llm')
+def _intent_route_to_llm():
+    intent_router.route(QUESTION_MESSAGE, 'natural')
+
+
+@benchmark('intent_route_sample')
+def _intent_route_sample():
+    local = sum(intent_router.route(message) is not None for message in INTENT_SAMPLE)
+    return {'local_rate': round(local / len(INTENT_SAMPLE), 2)}
+
+
+# Model tier routing over the same sample: decision cost, the share of turns
+# per tier and the mean output budget (it was 200 tokens for every turn)
+model_router = aiko.model_routing.ModelRouter(aiko.model_routing.load_policy(None), enabled=True)
+
+
+@benchmark('model_route_sample')
+def _model_route_sample():
+    routes = [model_router.choose(message, HISTORY[-4:]) for message in INTENT_SAMPLE]
+    tiers = [route.tier for route in routes]
+    return {**{tier: tiers.count(tier) for tier in model_router.policy['tiers']},
+            'mean_budget': round(sum(route.max_output_tokens for route in routes) / len(routes))}
+
+
+# --- Startup (run with --group startup) ---
+def _cold_start(code):
+    subprocess.run([sys.executable, '-c', code], check=True, capture_output=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+@benchmark('cold_start_import_flask', group='startup')
+def _cold_start_import_flask():
+    _cold_start('import flask')
+
+
+@benchmark('cold_start_import_app', group='startup')
+def _cold_start_import_app():
+    _cold_start('import app')
+
+
+@benchmark('cold_start_first_response', group='startup')
+def _cold_start_first_response():
+    _cold_start('import app; app.chat_assistant.generate_response("hi", [], 1)')
+
+
+# --- Database fixtures ---
+# With DATABASE_URL set, the DB-backed groups run against that server
+# database instead of throwaway SQLite files. It holds one fixture at a time,
+# so switching between fixtures rebuilds them there.
+SERVER_DB = bool(os.environ.get('DATABASE_URL'))
+INSERT_BATCH_ROWS = 10_000
+_active_fixture = None
+
+
+def fresh_database(name):
+    """Empty, initialized database for fixture `name`"""
+    global _active_fixture
+    _active_fixture = name
+    if SERVER_DB:
+        aiko.storage.metadata.drop_all(aiko.get_storage().engine)
+        aiko.migrations.metadata.drop_all(aiko.get_storage().engine)
+        aiko.get_storage().messages.clear_cache()
+    else:
+        aiko.DATABASE = os.path.join(tempfile.mkdtemp(prefix='aiko-bench-'), f'{name}.db')
+    aiko.init_db(force=True)
+    aiko._preferences_cache.clear()
+    return aiko.database_url() if SERVER_DB else aiko.DATABASE
+
+
+def fixture_is_current(name, database):
+    """True if `database` (built earlier for fixture `name`) can be reused as-is"""
+    if database is None or (SERVER_DB and _active_fixture != name):
+        return False
+    if not SERVER_DB:
+        aiko.DATABASE = database
+    return True
+
+
+def insert_rows(table, columns, rows):
+    """Bulk insert row tuples through SQLAlchemy, batch by batch"""
+    from itertools import islice
+    rows = iter(rows)
+    with aiko.get_storage().engine.begin() as conn:
+        while batch := [dict(zip(columns, row)) for row in islice(rows, INSERT_BATCH_ROWS)]:
+            conn.execute(table.insert(), batch)
+
+
+def insert_users(*user_ids):
+    insert_rows(aiko.storage.users, ('id', 'username', 'password_hash'),
+                ((user_id, f"bench{user_id}", STORED_HASH) for user_id in user_ids))
+
+
+# --- History fixtures (run with --group search) ---
+HISTORY_ROWS = int(os.environ.get('AIKO_BENCH_ROWS', 2_000_000))
+HISTORY_USERS = 5000
+_history_db = None
+
+
+def history_fixture():
+    """Build (once) a throwaway database with HISTORY_ROWS chat messages"""
+    global _history_db
+    if fixture_is_current('history', _history_db):
+        return _history_db
+
+    _history_db = fresh_database('history')
+
+    rnd = random.Random(42)
+    vocabulary = [f"word{i}" for i in range(20000)] + [
+        'piano', 'music', 'coffee', 'weather', 'travel', 'dog', 'cat', 'work', 'movie', 'book'
+    ] * 200
+
+    def rows():
+        for i in range(HISTORY_ROWS):
+            yield (rnd.randrange(HISTORY_USERS), f"conv_{i // 20}",
+                   'user' if i % 2 == 0 else 'assistant', ' '.join(rnd.choices(vocabulary, k=12)))
+
+    print(f"building {HISTORY_ROWS:,}-row history fixture...", file=sys.stderr)
+    with aiko.get_db_connection() as conn:
+        conn.executemany(
+            'INSERT INTO chat_messages (user_id, conversation_id, role, content) VALUES (?, ?, ?, ?)', rows()
+        )
+    return _history_db
+
+
+@benchmark('search_rare_term', group='search')
+def _search_rare_term():
+    history_fixture()
+    aiko.search_messages(123, 'word5')
+
+
+@benchmark('search_common_term', group='search')
+def _search_common_term():
+    history_fixture()
+    aiko.search_messages(123, 'piano')
+
+
+@benchmark('search_two_common_terms', group='search')
+def _search_two_common_terms():
+    history_fixture()
+    aiko.search_messages(123, 'piano coffee')
+
+
+@benchmark('search_prefix', group='search')
+def _search_prefix():
+    history_fixture()
+    aiko.search_messages(123, 'trav*')
+
+
+@benchmark('search_common_term_cold_stats', group='search')
+def _search_common_term_cold_stats():
+    history_fixture()
+    aiko._search_stats.clear()
+    aiko.search_messages(123, 'piano')
+
+
+@benchmark('search_second_page', group='search')
+def _search_second_page():
+    history_fixture()
+    _, cursor = aiko.search_messages(123, 'music', limit=10)
+    aiko.search_messages(123, 'music', limit=10, after=aiko.parse_search_cursor(cursor))
+
+
+# --- Export (run with --group export) ---
+EXPORT_ROWS = int(os.environ.get('AIKO_BENCH_EXPORT_ROWS', 1_000_000))
+EXPORT_SMALL_ROWS = 10_000
+EXPORT_MAX_PEAK = 4 * 1024 * 1024  # must hold regardless of history size
+_export_db = None
+
+
+def export_fixture():
+    """User 1 has EXPORT_ROWS messages, user 2 EXPORT_SMALL_ROWS"""
+    global _export_db
+    if fixture_is_current('export', _export_db):
+        return _export_db
+
+    _export_db = fresh_database('export')
+    insert_users(1, 2)
+
+    def rows(user_id, count):
+        for i in range(count):
+            yield (user_id, f"conv_{i // 50}", 'user' if i % 2 == 0 else 'assistant',
+                   f"Message {i}, with \"quotes\", commas and some ünïcode to escape. " * 2)
+
+    print(f"building {EXPORT_ROWS:,}-row export fixture...", file=sys.stderr)
+    columns = ('user_id', 'conversation_id', 'role', 'content')
+    insert_rows(aiko.storage.chat_messages, columns, rows(1, EXPORT_ROWS))
+    insert_rows(aiko.storage.chat_messages, columns, rows(2, EXPORT_SMALL_ROWS))
+    return _export_db
+
+
+def _drain_export(user_id, fmt, compress=False):
+    export_fixture()
+    for _ in aiko.export_messages(user_id, fmt, compress):
+        pass
+
+
+@benchmark('export_ndjson_10k', group='export', max_peak_bytes=EXPORT_MAX_PEAK)
+def _export_ndjson_small():
+    _drain_export(2, 'ndjson')
+
+
+@benchmark('export_ndjson_1m', group='export', max_peak_bytes=EXPORT_MAX_PEAK)
+def _export_ndjson_large():
+    _drain_export(1, 'ndjson')
+
+
+@benchmark('export_csv_1m', group='export', max_peak_bytes=EXPORT_MAX_PEAK)
+def _export_csv_large():
+    _drain_export(1, 'csv')
+
+
+@benchmark('export_ndjson_gzip_1m', group='export', max_peak_bytes=EXPORT_MAX_PEAK)
+def _export_ndjson_gzip_large():
+    _drain_export(1, 'ndjson', compress=True)
+
+
+# --- Storage repositories (run with --group storage) ---
+# The per-turn queries, on SQLite by default or on DATABASE_URL if set.
+STORAGE_HISTORY_ROWS = 200
+STORAGE_THREADS = 16
+STORAGE_TURNS = 20  # per thread
+_storage_user = None
+
+
+def storage_fixture():
+    """(user_id, token) of a user with a STORAGE_HISTORY_ROWS-message conversation"""
+    global _storage_user
+    if _storage_user is not None and fixture_is_current('storage', _storage_user[2]):
+        return _storage_user[:2]
+
+    database = fresh_database('storage')
+    user_id, _ = aiko.create_user('storage', 'storage@example.com', PASSWORD)
+    token = aiko.create_session_token(user_id)
+    insert_rows(aiko.storage.chat_messages, ('user_id', 'conversation_id', 'role', 'content'),
+                ((user_id, 'bench', 'user' if i % 2 == 0 else 'assistant', f"Message number {i}. " * 12)
+                 for i in range(STORAGE_HISTORY_ROWS)))
+    _storage_user = (user_id, token, database)
+    return _storage_user[:2]
+
+
+@benchmark('storage_verify_session', group='storage')
+def _storage_verify_session():
+    _, token = storage_fixture()
+    aiko.verify_session_token(token)
+
+
+@benchmark('storage_recent_history', group='storage')
+def _storage_recent_history():
+    user_id, _ = storage_fixture()
+    aiko.get_conversation_history(user_id, 'bench', limit=5)
+
+
+@benchmark('storage_save_message', group='storage')
+def _storage_save_message():
+    user_id, _ = storage_fixture()
+    aiko.save_chat_message(user_id, 'scratch', 'user', SHORT_MESSAGE)
+
+
+@benchmark('storage_preferences_miss', group='storage')
+def _storage_preferences_miss():
+    user_id, _ = storage_fixture()
+    aiko._preferences_cache.clear()
+    aiko.get_cached_preferences(user_id)
+
+
+@benchmark('storage_concurrent_turns', group='storage')
+def _storage_concurrent_turns():
+    # The database side of a chat turn from many request threads at once
+    from concurrent.futures import ThreadPoolExecutor
+    user_id, token = storage_fixture()
+
+    def turns(_):
+        for _ in range(STORAGE_TURNS):
+            aiko.verify_session_token(token)
+            aiko.get_conversation_history(user_id, 'bench', limit=5)
+            aiko.save_chat_message(user_id, 'scratch', 'user', SHORT_MESSAGE)
+            aiko.save_chat_message(user_id, 'scratch', 'assistant', SHORT_REPLY)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(STORAGE_THREADS) as pool:
+        list(pool.map(turns, range(STORAGE_THREADS)))
+    elapsed = time.perf_counter() - start
+    return {'turns_per_s': round(STORAGE_THREADS * STORAGE_TURNS / elapsed), 'backend': aiko.get_storage().engine.dialect.name}
+
+
+# --- Conversation ids (run with --group conversations) ---
+# A history saved before the conversations table (text conversation ids,
+# idx_conversation), and a copy of it after the conversation links migration.
+CONVERSATION_ROWS = int(os.environ.get('AIKO_BENCH_CONVERSATION_ROWS', 500_000))
+CONVERSATION_USERS = 5000
+CONVERSATION_LENGTH = 20
+# The probe: an earlier 100-message conversation of user 0, who has written
+# every 100th message since (5,000 at the default size) in other conversations
+PROBE_LENGTH = 100
+HEAVY_USER_EVERY = 100
+LEGACY_MESSAGES_SQL = """
+    CREATE TABLE chat_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, conversation_id TEXT NOT NULL,
+        role TEXT NOT NULL, content TEXT NOT NULL, voice_style TEXT DEFAULT 'natural',
+        emotion TEXT DEFAULT 'neutral', created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX idx_user_messages ON chat_messages(user_id, created_at);
+    CREATE INDEX idx_conversation ON chat_messages(conversation_id);
+"""
+_conversation_dbs = None
+
+
+def _index_bytes(path, *names):
+    import sqlite3
+    with sqlite3.connect(path) as conn:
+        return sum(conn.execute('SELECT coalesce(sum(pgsize), 0) FROM dbstat WHERE name = ?', (name,)).fetchone()[0]
+                   for name in names)
+
+
+def conversation_fixture():
+    """(legacy connection, migrated path and connection, probe (user_id, conversation_id, pk), figures)"""
+    global _conversation_dbs
+    if _conversation_dbs is not None:
+        return _conversation_dbs
+
+    import shutil
+    import sqlite3
+    directory = tempfile.mkdtemp(prefix='aiko-bench-')
+    legacy, migrated = os.path.join(directory, 'legacy.db'), os.path.join(directory, 'migrated.db')
+
+    def rows():
+        # Conversations interleave like real traffic; ids look like the old client's conv_<timestamp>
+        conversations = CONVERSATION_ROWS // CONVERSATION_LENGTH
+        for i in range(CONVERSATION_ROWS):
+            if i < PROBE_LENGTH:
+                user_id, conversation = 0, -1
+            elif i % HEAVY_USER_EVERY == 0:
+                user_id, conversation = 0, conversations + i // (HEAVY_USER_EVERY * CONVERSATION_LENGTH)
+            else:
+                conversation = i % conversations
+                user_id = 1 + conversation % (CONVERSATION_USERS - 1)
+            yield (user_id, f"conv_{1697712345.123456 + conversation * 37.25:.6f}",
+                   'user' if i % 2 == 0 else 'assistant', f"Message number {i}. " * 6)
+
+    print(f"building {CONVERSATION_ROWS:,}-row legacy history...", file=sys.stderr)
+    with sqlite3.connect(legacy) as conn:
+        conn.executescript(LEGACY_MESSAGES_SQL)
+        conn.executemany('INSERT INTO chat_messages (user_id, conversation_id, role, content) VALUES (?, ?, ?, ?)',
+                         rows())
+    shutil.copy(legacy, migrated)
+
+    database = aiko.migrations.Database(aiko.storage.get_engine(f"sqlite:///{migrated}"), main=True)
+    aiko.migrations.apply_schema(database)
+    start = time.perf_counter()
+    for _ in aiko.migrations.run_backfills(database, batch_size=5000, through=aiko.migrations.ConversationLinks.version):
+        pass
+    backfill_seconds = time.perf_counter() - start
+    with sqlite3.connect(migrated) as conn:
+        conn.execute('VACUUM')
+
+    figures = {
+        'idx_conversation_bytes': _index_bytes(legacy, 'idx_conversation'),
+        'idx_conversation_messages_bytes': _index_bytes(migrated, 'idx_conversation_messages'),
+        'conversations_table_bytes': _index_bytes(migrated, 'conversations', 'uq_user_conversation',
+                                                  'sqlite_autoindex_conversations_1'),
+        'backfill_rows_per_s': round(CONVERSATION_ROWS / backfill_seconds),
+    }
+    user_id, conversation_id = next(rows())[:2]
+    migrated_conn = sqlite3.connect(migrated)
+    conversation_pk, = migrated_conn.execute('SELECT id FROM conversations WHERE user_id = ? AND public_id = ?',
+                                             (user_id, conversation_id)).fetchone()
+    probe = (user_id, conversation_id, conversation_pk)
+    _conversation_dbs = (sqlite3.connect(legacy), migrated, migrated_conn, probe, figures)
+    return _conversation_dbs
+
+
+@benchmark('conversation_index_size', group='conversations')
+def _conversation_index_size():
+    return conversation_fixture()[4]
+
+
+@benchmark('conversation_lookup_text_id', group='conversations')
+def _conversation_lookup_text_id():
+    # Before: the old get_conversation_history query
+    conn, _, _, (user_id, conversation_id, _), _ = conversation_fixture()
+    conn.execute('SELECT role, content, emotion FROM chat_messages WHERE user_id = ? AND conversation_id = ? '
+                 'ORDER BY created_at DESC LIMIT 5', (user_id, conversation_id)).fetchall()
+
+
+@benchmark('conversation_lookup_pk', group='conversations')
+def _conversation_lookup_pk():
+    # After: the same rows through idx_conversation_messages (the app caches the pk)
+    _, _, conn, (_, _, conversation_pk), _ = conversation_fixture()
+    conn.execute('SELECT role, content, emotion FROM chat_messages WHERE conversation_pk = ? '
+                 'ORDER BY id DESC LIMIT 5', (conversation_pk,)).fetchall()
+
+
+@benchmark('conversation_recent_repository', group='conversations')
+def _conversation_recent_repository():
+    # The app's path (pooled connection, cached conversation id)
+    _, migrated, _, (user_id, conversation_id, _), _ = conversation_fixture()
+    aiko.storage.get_storage(f"sqlite:///{migrated}").messages.recent(user_id, conversation_id, 5)
+
+
+# --- Message shards (run with --group shards) ---
+# Concurrent save_chat_message calls from several worker processes, as under
+# gunicorn; shard count 0 is the unsharded main database. Writes are durable
+# (one fsync per commit), and writers in different processes can only commit
+# concurrently if they hit different files.
+SHARD_COUNTS = (0, 1, 2, 4, 8)
+SHARD_PROCESSES = 4
+SHARD_THREADS = 4  # per process
+SHARD_WRITES = 25  # per thread
+_shard_dirs = {}
+
+
+def shard_fixture(count):
+    """Point the app at a throwaway layout with `count` message shards"""
+    name = f'shards{count}'
+    if count in _shard_dirs and fixture_is_current(name, _shard_dirs[count][1]):
+        aiko.MESSAGE_SHARDS, aiko.MESSAGE_SHARD_DIR = count, _shard_dirs[count][0]
+        return
+
+    directory = tempfile.mkdtemp(prefix='aiko-bench-')
+    aiko.MESSAGE_SHARDS, aiko.MESSAGE_SHARD_DIR = count, directory
+    _shard_dirs[count] = (directory, fresh_database(name))
+
+
+def _shard_worker(process, barrier):
+    from concurrent.futures import ThreadPoolExecutor
+    users = range(process * SHARD_THREADS + 1, (process + 1) * SHARD_THREADS + 1)
+    for user_id in users:
+        aiko.get_conversation_history(user_id, 'bench', limit=1)  # open this worker's connections
+
+    def writer(user_id):
+        for i in range(SHARD_WRITES):
+            aiko.save_chat_message(user_id, 'bench', 'user' if i % 2 == 0 else 'assistant', SHORT_REPLY)
+
+    barrier.wait()
+    with ThreadPoolExecutor(SHARD_THREADS) as pool:
+        list(pool.map(writer, users))
+
+
+def _shard_writes(count):
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    saved = aiko.MESSAGE_SHARDS, aiko.MESSAGE_SHARD_DIR
+    shard_fixture(count)
+    barrier = context.Barrier(SHARD_PROCESSES + 1)
+    workers = [context.Process(target=_shard_worker, args=(process, barrier)) for process in range(SHARD_PROCESSES)]
+    try:
+        for worker in workers:
+            worker.start()
+        barrier.wait()  # time the writes only, not process startup
+        start = time.perf_counter()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        # Later groups build unsharded fixtures, which must not see these shard files
+        aiko.MESSAGE_SHARDS, aiko.MESSAGE_SHARD_DIR = saved
+    writes = SHARD_PROCESSES * SHARD_THREADS * SHARD_WRITES
+    return {'writes_per_s': round(writes / elapsed)}
+
+
+for _count in SHARD_COUNTS:
+    benchmark(f'shard_writes_{_count}', group='shards')(lambda count=_count: _shard_writes(count))
+
+
+# --- Server-side TTS against a local Gemini stub (run with --group tts) ---
+TTS_SECONDS = 4.0
+TTS_RATE = 24000
+_tts_stub = None
+
+
+def _speech_like_pcm(seconds, rate):
+    """Voiced-speech stand-in: harmonics with syllable-rate amplitude modulation"""
+    import numpy as np
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = 180 + 30 * np.sin(2 * np.pi * 0.7 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 8))
+    envelope = np.clip(np.sin(2 * np.pi * 4 * t), 0, None)
+    noise = np.random.default_rng(0).normal(0, 0.02, t.size)
+    return (np.clip(voiced * envelope * 0.3 + noise, -1, 1) * 32767).astype('<i2')
+
+
+def tts_stub():
+    """Local HTTP server answering like Gemini TTS with a canned L16 reply"""
+    global _tts_stub
+    if _tts_stub is not None:
+        return _tts_stub
+
+    import base64
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    pcm = _speech_like_pcm(TTS_SECONDS, TTS_RATE).tobytes()
+    body = json.dumps({'candidates': [{'content': {'parts': [{'inlineData': {
+        'mimeType': f'audio/L16;codec=pcm;rate={TTS_RATE}',
+        'data': base64.b64encode(pcm).decode('ascii'),
+    }}]}}]}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, so the client pool is exercised
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = aiko.tts.GeminiTTSClient('bench-key', base_url=f"http://127.0.0.1:{server.server_port}/v1beta")
+    _tts_stub = {'client': client, 'json_bytes': len(body), 'pcm_bytes': len(pcm)}
+    return _tts_stub
+
+
+def _tts_proxy(fmt):
+    stub = tts_stub()
+    samples, rate = stub['client'].synthesize("Hello there, how are you today?", 'Kore')
+    body, _ = aiko.audio.encode_audio(samples, rate, fmt)
+    return {'audio_seconds': TTS_SECONDS, 'upstream_json_bytes': stub['json_bytes'], 'response_bytes': len(body)}
+
+
+@benchmark('tts_browser_direct_baseline', group='tts')
+def _tts_browser_direct_baseline():
+    # What the browser used to do: fetch the base64 JSON and build an uncompressed WAV
+    stub = tts_stub()
+    response = stub['client'].session.post(stub['client'].url, json={})
+    response.json()
+    return {'response_bytes': len(response.content), 'wav_bytes': stub['pcm_bytes'] + 44}
+
+
+@benchmark('tts_proxy_ogg_vorbis', group='tts')
+def _tts_proxy_ogg():
+    return _tts_proxy('ogg')
+
+
+@benchmark('tts_proxy_ogg_opus', group='tts')
+def _tts_proxy_opus():
+    return _tts_proxy('opus')
+
+
+@benchmark('tts_proxy_flac', group='tts')
+def _tts_proxy_flac():
+    return _tts_proxy('flac')
+
+
+@benchmark('tts_proxy_wav', group='tts')
+def _tts_proxy_wav():
+    return _tts_proxy('wav')
+
+
+# --- TTS engine routing with stub engines (run with --group router) ---
+ROUTER_TEXT = "Hi there. I'm happy to help. What would you like to talk about today?"
+
+
+class StubEngine(aiko.tts.TTSEngine):
+    """Canned audio after a fixed delay; fails every call from fail_after on"""
+
+    def __init__(self, name, delay=0.0, fail_after=None, rate=TTS_RATE, quality=2):
+        self.name, self.delay, self.fail_after, self.rate, self.quality = name, delay, fail_after, rate, quality
+        self.calls = 0
+
+    def synthesize(self, text, voice_style):
+        import numpy as np
+        self.calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_after is not None and self.calls > self.fail_after:
+            raise aiko.tts.TTSError(f"{self.name} is down")
+        return np.zeros(int(0.05 * len(text) * self.rate), dtype=np.int16), self.rate
+
+
+def stub_router(*engines):
+    router = aiko.tts.TTSRouter()
+    for engine in engines:
+        router.register(engine)
+    return router
+
+
+@benchmark('router_overhead', group='router')
+def _router_overhead():
+    # Routing bookkeeping alone: instant engines, three sentences
+    router = stub_router(StubEngine('a'), StubEngine('b'))
+    router.synthesize(ROUTER_TEXT)
+
+
+@benchmark('router_picks_fastest', group='router')
+def _router_picks_fastest():
+    slow, fast = StubEngine('slow', delay=0.02), StubEngine('fast', delay=0.001)
+    slow.expected_latency = fast.expected_latency = 0.0  # unmeasured engines tie; time both
+    router = stub_router(slow, fast)
+    for _ in range(4):
+        router.synthesize("Hello there.")
+    _, _, used = router.synthesize(ROUTER_TEXT)
+    return {'engine': used[0]}
+
+
+@benchmark('router_failover_mid_reply', group='router')
+def _router_failover_mid_reply():
+    # The primary dies after the first sentence; the rest of the reply moves
+    # to the backup and is resampled to the primary's rate
+    primary = StubEngine('primary', fail_after=1, rate=22050)
+    backup = StubEngine('backup', delay=0.001, quality=3)
+    router = stub_router(primary, backup)
+    samples, rate, used = router.synthesize(ROUTER_TEXT)
+    stats = router.stats()
+    return {'engines': '+'.join(used), 'rate': rate, 'primary_error_rate': stats['primary']['error_rate']}
+
+
+# --- Time to first sound (run with --group ack) ---
+# A stub LLM delay and a stub TTS engine stand in for Gemini; the figure of
+# interest is how long the user hears nothing after sending a message.
+LLM_DELAY = 0.5
+TTS_SENTENCE_DELAY = 0.2
+_ack_client = None
+
+
+def ack_fixture():
+    """Test client logged in against a throwaway database, acknowledgement bank built"""
+    global _ack_client
+    if _ack_client is not None and fixture_is_current('ack', _ack_client[2]):
+        return _ack_client[:2]
+
+    database = fresh_database('ack')
+    aiko.tts._router = stub_router(StubEngine('stub', delay=TTS_SENTENCE_DELAY))
+    aiko.tts.ack_bank.cache_dir = tempfile.mkdtemp(prefix='aiko-bench-')
+    aiko.tts.ack_bank.build(aiko.render_ack)
+
+    if _ack_client is None:
+        generate = aiko.chat_assistant.generate_response
+
+        def slow_generate(*args, **kwargs):
+            time.sleep(LLM_DELAY)
+            return generate(*args, **kwargs)
+
+        aiko.chat_assistant.generate_response = slow_generate
+
+    client = aiko.app.test_client()
+    client.post('/register', json={'username': 'bench', 'password': 'bench-pass', 'email': 'bench@example.com'})
+    token = client.post('/login', json={'username': 'bench', 'password': 'bench-pass'}).get_json()['token']
+    _ack_client = (client, {'Authorization': token}, database)
+    return _ack_client[:2]
+
+
+@benchmark('ttfs_reply_audio', group='ack')
+def _ttfs_reply_audio():
+    # Before: silence until /chat returns and the reply has been synthesized
+    client, headers = ack_fixture()
+    start = time.perf_counter()
+    reply = client.post('/chat', json={'message': 'Tell me something nice', 'voice_style': 'warm'},
+                        headers=headers).get_json()
+    client.post('/tts', json={'text': reply['text'], 'voice_style': 'warm'}, headers=headers)
+    return {'time_to_first_sound_ms': round(1000 * (time.perf_counter() - start), 1)}
+
+
+@benchmark('ttfs_ack_clip', group='ack')
+def _ttfs_ack_clip():
+    # After: the acknowledgement clip is the first line of the streamed /chat
+    client, headers = ack_fixture()
+    start = time.perf_counter()
+    response = client.post('/chat', json={'message': 'Tell me something nice', 'voice_style': 'warm',
+                                          'stream': True}, headers=headers, buffered=False)
+    events = iter(response.response)
+    first = json.loads(next(events))
+    ttfs = time.perf_counter() - start
+    for _ in events:
+        pass
+    response.close()
+    return {'first_event': first['type'], 'time_to_first_sound_ms': round(1000 * ttfs, 1)}
+
+
+# --- Prosody post-processing throughput (run with --group prosody) ---
+PROSODY_SECONDS = 20.0
+_prosody_clip = None
+
+
+def prosody_clip():
+    """Five 'sentences' of speech-like audio separated by short gaps"""
+    global _prosody_clip
+    if _prosody_clip is None:
+        import numpy as np
+        sentence = _speech_like_pcm(PROSODY_SECONDS / 5 - 0.1, TTS_RATE)
+        gap = np.zeros(int(0.1 * TTS_RATE), dtype=sentence.dtype)
+        _prosody_clip = np.concatenate([sentence, gap] * 5)
+    return _prosody_clip
+
+
+def _prosody(**settings):
+    # Throughput in seconds of audio per CPU-second, the figure that decides
+    # how many concurrent replies one worker core can post-process
+    clip = prosody_clip()
+    start = time.process_time()
+    aiko.audio.apply_prosody(clip, TTS_RATE, **settings)
+    cpu = time.process_time() - start
+    seconds = clip.size / TTS_RATE
+    return {'audio_seconds': seconds, 'audio_s_per_cpu_s': round(seconds / max(cpu, 1e-9), 1)}
+
+
+@benchmark('prosody_loudness_only', group='prosody')
+def _prosody_loudness_only():
+    return _prosody()
+
+
+@benchmark('prosody_rate', group='prosody')
+def _prosody_rate():
+    return _prosody(rate=1.2)
+
+
+@benchmark('prosody_rate_and_pitch', group='prosody')
+def _prosody_rate_and_pitch():
+    return _prosody(rate=1.2, pitch=0.9)
+
+
+@benchmark('prosody_full_energetic', group='prosody')
+def _prosody_full_energetic():
+    style = aiko.STYLE_SETTINGS['energetic']
+    return _prosody(rate=style['rate'], pitch=style['pitch'], volume=style['volume'],
+                    pauses=4, pause_seconds=aiko.audio.SENTENCE_PAUSE_SECONDS * style['pause_duration'])
+
+
+# --- Piper micro-batching (run with --group piper; needs a voice model) ---
+# PIPER_BENCH_MODEL (or the first PIPER_MODELS entry) names the .onnx voice
+PIPER_BENCH_MODEL = os.getenv('PIPER_BENCH_MODEL') or next(iter(aiko.tts.configured_models()), None)
+PIPER_CLIENTS = 16
+PIPER_SENTENCES = [
+    "I'm really glad you told me about that.",
+    "Let's take it one step at a time.",
+    "That sounds like a wonderful plan for the weekend!",
+    "Hmm, I'm not completely sure, but I think so.",
+]
+
+
+def _concurrent_piper(synthesize):
+    """PIPER_CLIENTS threads each synthesize one sentence at the same moment"""
+    import threading
+    barrier = threading.Barrier(PIPER_CLIENTS)
+    samples = [0] * PIPER_CLIENTS
+
+    def client(i):
+        barrier.wait()
+        samples[i] = synthesize(PIPER_SENTENCES[i % len(PIPER_SENTENCES)])
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(PIPER_CLIENTS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    rate = aiko.tts.get_piper_voice(PIPER_BENCH_MODEL).config.sample_rate
+    return {'clients': PIPER_CLIENTS, 'audio_s_per_s': round(sum(samples) / rate / elapsed, 1)}
+
+
+if PIPER_BENCH_MODEL:
+    @benchmark('piper_unbatched_concurrent', group='piper')
+    def _piper_unbatched():
+        voice = aiko.tts.get_piper_voice(PIPER_BENCH_MODEL)
+        return _concurrent_piper(lambda text: len(aiko.tts.synthesize_raw(voice, text)) // 2)
+
+    @benchmark('piper_batched_concurrent', group='piper')
+    def _piper_batched():
+        batcher = aiko.tts.get_piper_batcher()
+        result = _concurrent_piper(lambda text: batcher.synthesize(PIPER_BENCH_MODEL, text)[0].size)
+        stats = batcher.stats()
+        result.update(mean_batch_size=stats['mean_batch_size'], max_queue_depth=stats['max_queue_depth'])
+        return result
+
+
+# --- HTTP responses (run with --group http) ---
+# Server time per request (one WSGI call, as a server makes it) and bytes on
+# the wire for the page and JSON endpoints, with the headers a browser sends.
+# The *_uncached cases are the old paths: the page rendered per hit (replayed
+# on a bare Flask app) and JSON sent uncompressed.
+BROWSER_HEADERS = {'Accept-Encoding': 'gzip, deflate, br'}
+HTTP_HISTORY_ROWS = 50
+JSON_HISTORY_ROWS = 10_000  # the 'long' conversation, for --group json
+_http_fixture = None
+
+
+def http_fixture():
+    """(auth headers of a user with HTTP_HISTORY_ROWS- and JSON_HISTORY_ROWS-message conversations, the old index app)"""
+    global _http_fixture
+    if _http_fixture is not None and fixture_is_current('http', _http_fixture[2]):
+        return _http_fixture[:2]
+
+    from flask import Flask, render_template
+    database = fresh_database('http')
+    user_id, _ = aiko.create_user('http', 'http@example.com', PASSWORD)
+    auth = {'Authorization': aiko.create_session_token(user_id)}
+    # Varied words, so the JSON compresses like real chat rather than repeated filler
+    words = sorted({word.strip('*.,').lower() for text in (LONG_REPLY, KEYWORD_HEAVY_REPLY, LONG_MESSAGE,
+                                                           QUESTION_MESSAGE, NEUTRAL_LONG_REPLY)
+                    for word in text.split()})
+    rng = random.Random(HTTP_HISTORY_ROWS)
+    insert_rows(aiko.storage.chat_messages, ('user_id', 'conversation_id', 'role', 'content'),
+                ((user_id, 'bench', 'user' if i % 2 == 0 else 'assistant',
+                  ' '.join(rng.choice(words) for _ in range(rng.randint(10, 90))).capitalize() + '.')
+                 for i in range(HTTP_HISTORY_ROWS)))
+    insert_rows(aiko.storage.chat_messages, ('user_id', 'conversation_id', 'role', 'content'),
+                ((user_id, 'long', 'user' if i % 2 == 0 else 'assistant',
+                  ' '.join(rng.choice(words) for _ in range(rng.randint(10, 90))).capitalize() + '.')
+                 for i in range(JSON_HISTORY_ROWS)))
+    old_app = Flask('uncached', root_path=aiko.app.root_path, template_folder=aiko.app.template_folder)
+    old_app.add_url_rule('/', 'index', lambda: render_template('index.html'))
+    _http_fixture = (auth, old_app, database)
+    return _http_fixture[:2]
+
+
+_environs = {}
+_history_etag = None
+
+
+def _wsgi(path, headers=(), wsgi_app=None):
+    """One request through the WSGI app; returns figures for the response"""
+    from werkzeug.test import EnvironBuilder
+    auth, old_app = http_fixture()
+    key = (path, tuple(headers), wsgi_app is None)
+    if key not in _environs:
+        _environs[key] = EnvironBuilder(path=path, headers={**auth, **dict(headers)}).get_environ()
+    started = []
+    body = b''.join((wsgi_app or aiko.app)(dict(_environs[key]), lambda status, response_headers: started.append(
+        (int(status.split()[0]), dict(response_headers).get('Content-Encoding', 'identity')))))
+    status, encoding = started[0]
+    return {'status': status, 'bytes': len(body), 'encoding': encoding}
+
+
+@benchmark('http_index_uncached', group='http')
+def _http_index_uncached():
+    return _wsgi('/', BROWSER_HEADERS.items(), wsgi_app=http_fixture()[1])
+
+
+@benchmark('http_index', group='http')
+def _http_index():
+    return _wsgi('/', BROWSER_HEADERS.items())
+
+
+@benchmark('http_index_revalidated', group='http')
+def _http_index_revalidated():
+    return _wsgi('/', (*BROWSER_HEADERS.items(), ('If-None-Match', f'W/"{aiko.index_page().etag}"')))
+
+
+@benchmark('http_history_uncompressed', group='http')
+def _http_history_uncompressed():
+    return _wsgi('/history?conversation_id=bench', [('Accept-Encoding', 'identity')])
+
+
+@benchmark('http_history', group='http')
+def _http_history():
+    return _wsgi('/history?conversation_id=bench', BROWSER_HEADERS.items())
+
+
+@benchmark('http_history_revalidated', group='http')
+def _http_history_revalidated():
+    global _history_etag
+    if _history_etag is None:
+        _history_etag = aiko.app.test_client().get('/history?conversation_id=bench', headers=http_fixture()[0]).headers['ETag']
+    return _wsgi('/history?conversation_id=bench', (*BROWSER_HEADERS.items(), ('If-None-Match', _history_etag)))
+
+
+@benchmark('http_status', group='http')
+def _http_status():
+    return _wsgi('/status', BROWSER_HEADERS.items())
+
+
+# Page ready: the requests index.html makes once loaded, grouped into round
+# trips (requests in one trip go out together). ns/call is the server time of
+# the whole sequence; ready_ms adds BENCH_RTT_MS per round trip on top.
+# Before /bootstrap the page fetched /status, then /profile, then /profile
+# again (chained to /preferences) alongside /history.
+PAGE_LOAD_SEPARATE = (('/status',), ('/profile',), ('/profile', '/history?conversation_id=bench'), ('/preferences',))
+PAGE_LOAD_BOOTSTRAP = (('/bootstrap',),)
+BENCH_RTT_MS = float(os.getenv('BENCH_RTT_MS', 50))
+
+
+def _page_load(round_trips):
+    started = time.perf_counter()
+    responses = [_wsgi(path, BROWSER_HEADERS.items()) for trip in round_trips for path in trip]
+    server_ms = (time.perf_counter() - started) * 1e3
+    assert all(response['status'] == 200 for response in responses)
+    return {'requests': len(responses), 'round_trips': len(round_trips),
+            'bytes': sum(response['bytes'] for response in responses),
+            'ready_ms': round(server_ms + len(round_trips) * BENCH_RTT_MS, 1)}
+
+
+@benchmark('http_page_ready_separate', group='http')
+def _http_page_ready_separate():
+    return _page_load(PAGE_LOAD_SEPARATE)
+
+
+@benchmark('http_page_ready_bootstrap', group='http')
+def _http_page_ready_bootstrap():
+    return _page_load(PAGE_LOAD_BOOTSTRAP)
+
+
+# --- JSON encoding (run with --group json) ---
+# The JSON_HISTORY_ROWS-message /history body. *_dicts is the old path: the
+# repository made a dict per row (converting timestamps in Python) for
+# Flask's stdlib provider; the others encode storage.Rows through
+# json_provider, with and without orjson. The http cases add the query and
+# the WSGI round trip.
+_json_rows = None
+
+
+@contextmanager
+def _without_orjson():
+    saved, aiko.json_provider.orjson = aiko.json_provider.orjson, None
+    try:
+        yield
+    finally:
+        aiko.json_provider.orjson = saved
+
+
+def json_rows():
+    """(the 'long' conversation as rows with datetimes, as read before, and as storage.Rows)"""
+    global _json_rows
+    if _json_rows is None:
+        from sqlalchemy import select
+        auth, _ = http_fixture()
+        user_id = aiko.verify_session_token(auth['Authorization'])
+        messages = aiko.storage.chat_messages
+        with aiko.get_storage().engine.connect() as conn:
+            old = conn.execute(select(*(messages.c[name] for name in aiko.storage.HISTORY_COLUMNS))
+                               .where(messages.c.user_id == user_id, messages.c.conversation_id == 'long')
+                               .order_by(messages.c.id)).all()
+        _json_rows = (old, aiko.get_storage().messages.history(user_id, 'long', JSON_HISTORY_ROWS))
+    return _json_rows
+
+
+def _history_body(messages):
+    return {"status": "success", "messages": messages, "conversation_id": 'long'}
+
+
+@benchmark('json_history_10k_dicts', group='json')
+def _json_history_dicts():
+    from flask.json.provider import DefaultJSONProvider
+    with aiko.app.app_context():
+        rows, _ = json_rows()
+        response = DefaultJSONProvider(aiko.app).response(_history_body([aiko.storage._plain(row) for row in rows]))
+    return {'bytes': len(response.get_data())}
+
+
+@benchmark('json_history_10k_stdlib', group='json')
+def _json_history_stdlib():
+    with aiko.app.app_context(), _without_orjson():
+        response = aiko.app.json.response(_history_body(json_rows()[1]))
+    return {'bytes': len(response.get_data())}
+
+
+@benchmark('json_history_10k', group='json')
+def _json_history():
+    with aiko.app.app_context():
+        response = aiko.app.json.response(_history_body(json_rows()[1]))
+    return {'bytes': len(response.get_data())}
+
+
+@benchmark('json_history_10k_http_stdlib', group='json')
+def _json_history_http_stdlib():
+    with _without_orjson():
+        return _wsgi(f'/history?conversation_id=long&limit={JSON_HISTORY_ROWS}', [('Accept-Encoding', 'identity')])
+
+
+@benchmark('json_history_10k_http', group='json')
+def _json_history_http():
+    return _wsgi(f'/history?conversation_id=long&limit={JSON_HISTORY_ROWS}', [('Accept-Encoding', 'identity')])
+
+
+# --- Retrieval fallback (run with --group retrieval) ---
+# retrieval.ReplyIndex over RETRIEVAL_PAIRS synthetic (user -> assistant)
+# pairs: Zipf-distributed words from a RETRIEVAL_VOCABULARY-word vocabulary,
+# 5 voice styles, 5,000 users. Rows come from memory rather than a database,
+# so the figures are the index's own build and query cost.
+RETRIEVAL_PAIRS = int(os.environ.get('AIKO_BENCH_RETRIEVAL_PAIRS', 1_000_000))
+RETRIEVAL_VOCABULARY = 20_000
+RETRIEVAL_STYLES = ('natural', 'warm', 'energetic', 'calm', 'playful')
+_retrieval = None
+
+
+class _GeneratedMessages:
+    """iter_since() over generated rows, standing in for a MessageRepository"""
+
+    def __init__(self, pairs, seed=0):
+        import numpy as np
+        rng = np.random.default_rng(seed)
+        weights = 1.0 / np.arange(1, RETRIEVAL_VOCABULARY + 1)
+        self.words = [f"w{i}" for i in rng.choice(RETRIEVAL_VOCABULARY, size=pairs * 12, p=weights / weights.sum())]
+        self.lengths = rng.integers(4, 20, size=pairs)
+        self.pairs = pairs
+        self.new = []
+
+    def question(self, i):
+        start = i * 12
+        return ' '.join(self.words[start:start + min(self.lengths[i], 12)])
+
+    def iter_since(self, after_id, chunk_size):
+        rows = []
+        for i in range(after_id // 2, self.pairs):
+            user_id, style = i % 5000, RETRIEVAL_STYLES[i % len(RETRIEVAL_STYLES)]
+            rows.append((2 * i + 1, user_id, f"c{i}", 'user', self.question(i), style))
+            rows.append((2 * i + 2, user_id, f"c{i}", 'assistant', f"reply {i}", style))
+            if len(rows) >= chunk_size:
+                yield rows
+                rows = []
+        if rows:
+            yield rows
+        yield from ([row for row in self.new if row[0] > after_id],) if self.new else ()
+
+    def content(self, message_id):
+        return f"reply {message_id // 2 - 1}"
+
+
+def retrieval_fixture():
+    global _retrieval
+    if _retrieval is None:
+        messages = _GeneratedMessages(RETRIEVAL_PAIRS)
+        index = aiko.retrieval.ReplyIndex([messages])
+        print(f"indexing {RETRIEVAL_PAIRS:,} pairs...", file=sys.stderr)
+        started = time.perf_counter()
+        index.catch_up()
+        figures = {'build_s': round(time.perf_counter() - started, 1), 'segments': len(index.segments),
+                   'index_mb': round(sum(segment.matrix.data.nbytes + segment.matrix.indices.nbytes
+                                         + segment.matrix.indptr.nbytes + segment.buckets.nbytes
+                                         for segment in index.segments) / 2**20)}
+        _retrieval = (index, messages, figures)
+    return _retrieval
+
+
+@benchmark('retrieval_query_same_user', group='retrieval')
+def _retrieval_query_same_user():
+    index, messages, figures = retrieval_fixture()
+    i = 123_457 % messages.pairs
+    found = index.search(messages.question(i), RETRIEVAL_STYLES[i % len(RETRIEVAL_STYLES)], i % 5000)
+    return {**figures, 'score': round(found[0], 2) if found else None}
+
+
+@benchmark('retrieval_query_all_users', group='retrieval')
+def _retrieval_query_all_users():
+    index, messages, _ = retrieval_fixture()
+    index.scope = 'all'
+    try:
+        found = index.search(messages.question(42), RETRIEVAL_STYLES[42 % len(RETRIEVAL_STYLES)])
+    finally:
+        index.scope = aiko.retrieval.RETRIEVAL_SCOPE
+    return {'score': round(found[0], 2) if found else None}
+
+
+@benchmark('retrieval_add_turn', group='retrieval')
+def _retrieval_add_turn():
+    # One new turn picked up by catch_up, then a query that flushes it into a segment
+    index, messages, _ = retrieval_fixture()
+    next_id = 2 * messages.pairs + 2 * len(messages.new) + 1
+    messages.new += [(next_id, 7, 'new', 'user', "brand new question about w17 and w923", 'calm'),
+                     (next_id + 1, 7, 'new', 'assistant', "reply", 'calm')]
+    index.catch_up()
+    return {'segments': len(index.segments)}
+
+
+# --- LLM bulkhead (run with --group bulkhead) ---
+# One gthread worker (a pool of BULKHEAD_THREADS threads) gets a burst of chat
+# turns while the stub Gemini takes BULKHEAD_LLM_DELAY per call, then a
+# /status request. Without a bulkhead /status waits for threads stuck
+# upstream; with one, the overflow is answered offline and /status is served
+# at once.
+BULKHEAD_THREADS = 4
+BULKHEAD_TURNS = 12
+BULKHEAD_LLM_DELAY = 0.3
+
+
+class _SlowGemini:
+    class Client:
+        def __init__(self, api_key):
+            self.models = self
+
+        def generate_content(self, model, contents, config):
+            time.sleep(BULKHEAD_LLM_DELAY)
+            return type('Response', (), {'text': "Let me think about that.", 'usage_metadata': None})()
+
+
+@contextmanager
+def slow_gemini(llm_bulkhead):
+    saved = (aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available,
+             assistant.keys, aiko.bulkhead._llm_bulkhead)
+    aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available = _SlowGemini, True, True, True
+    assistant.keys, aiko.bulkhead._llm_bulkhead = aiko.key_pool.KeyPool([('bench', 0, 0)]), llm_bulkhead
+    try:
+        yield
+    finally:
+        (aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available,
+         assistant.keys, aiko.bulkhead._llm_bulkhead) = saved
+
+
+def _burst(llm_bulkhead):
+    from concurrent.futures import ThreadPoolExecutor
+
+    with slow_gemini(llm_bulkhead), ThreadPoolExecutor(BULKHEAD_THREADS) as pool:
+        turns = [pool.submit(assistant.generate_response, QUESTION_MESSAGE, [], 1, 'natural', None)
+                 for _ in range(BULKHEAD_TURNS)]
+        started = time.perf_counter()
+        pool.submit(aiko.status_page, True, ()).result()
+        status_ms = 1000 * (time.perf_counter() - started)
+        replies = [turn.result() for turn in turns]
+    return {'status_ms': round(status_ms, 1),
+            'gemini': sum(reply['is_gemini'] for reply in replies),
+            'offline': sum(not reply['is_gemini'] for reply in replies)}
+
+
+@benchmark('bulkhead_off_status_during_burst', group='bulkhead')
+def _bulkhead_off_status_during_burst():
+    return _burst(aiko.bulkhead.Bulkhead(limit=BULKHEAD_THREADS * BULKHEAD_TURNS, queue_size=0))
+
+
+@benchmark('bulkhead_on_status_during_burst', group='bulkhead')
+def _bulkhead_on_status_during_burst():
+    limit = max(1, BULKHEAD_THREADS // 2)
+    llm_bulkhead = aiko.bulkhead.Bulkhead(limit=limit, queue_size=BULKHEAD_THREADS - limit - 1)
+    result = _burst(llm_bulkhead)
+    return {**result, 'wait_p95_ms': llm_bulkhead.stats()['wait_ms']['p95']}
+
+
+# --- Gemini key pool (run with --group keys) ---
+# A local HTTP server answers generateContent like Gemini and enforces
+# KEYS_STUB_RPM requests per key per KEYS_WINDOW seconds (a scaled-down
+# minute), answering 429 RESOURCE_EXHAUSTED with a retry delay beyond that.
+# The real SDK client talks to it through GEMINI_BASE_URL. A burst of turns
+# goes through one key, then a pool of KEYS_COUNT keys with their quotas
+# declared, then the same pool relying on 429s alone. The balancing,
+# cooldown and affinity rules are covered by tests/test_key_pool.py.
+KEYS_COUNT = 3
+KEYS_STUB_RPM = 10
+KEYS_WINDOW = 1.0
+KEYS_TURNS = 60
+KEYS_THREADS = 8
+_keys_stub = None
+
+
+def keys_stub():
+    """Local quota-enforcing Gemini stub; returns its state ({'url', 'answered', 'refused'})"""
+    global _keys_stub
+    if _keys_stub is not None:
+        return _keys_stub
+
+    import threading
+    from collections import defaultdict, deque
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    state = {'answered': defaultdict(int), 'refused': defaultdict(int)}
+    windows = defaultdict(deque)
+    lock = threading.Lock()
+    ok = json.dumps({
+        'candidates': [{'content': {'role': 'model', 'parts': [{'text': "Learning piano as an adult is great."}]},
+                        'finishReason': 'STOP'}],
+        'usageMetadata': {'promptTokenCount': 120, 'candidatesTokenCount': 12, 'totalTokenCount': 132},
+    }).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            key, now = self.headers.get('x-goog-api-key'), time.monotonic()
+            with lock:
+                window = windows[key]
+                while window and window[0] <= now - KEYS_WINDOW:
+                    window.popleft()
+                allowed = len(window) < KEYS_STUB_RPM
+                if allowed:
+                    window.append(now)
+                    state['answered'][key] += 1
+                else:
+                    state['refused'][key] += 1
+                    delay = window[0] + KEYS_WINDOW - now
+            if allowed:
+                status, body = 200, ok
+            else:
+                status, body = 429, json.dumps({'error': {
+                    'code': 429, 'status': 'RESOURCE_EXHAUSTED',
+                    'message': f"Resource has been exhausted (e.g. check quota). Please retry in {delay:.3f}s.",
+                }}).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    state['url'] = f"http://127.0.0.1:{server.server_port}/"
+    _keys_stub = state
+    return state
+
+
+@contextmanager
+def gemini_through(pool, sdk, base_url=None, window=KEYS_WINDOW):
+    """Route the assistant's Gemini calls through pool and sdk for the with block"""
+    saved = (aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available, aiko.GEMINI_BASE_URL,
+             assistant.keys, aiko.bulkhead._llm_bulkhead, aiko.key_pool.QUOTA_WINDOW)
+    aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available = sdk, True, True, True
+    aiko.GEMINI_BASE_URL, assistant.keys = base_url, pool
+    aiko.bulkhead._llm_bulkhead = aiko.bulkhead.Bulkhead(limit=KEYS_THREADS, queue_size=0)
+    aiko.key_pool.QUOTA_WINDOW = window
+    try:
+        yield
+    finally:
+        (aiko.genai, aiko.USE_NEW_GENAI, aiko._genai_loaded, aiko.gemini_available, aiko.GEMINI_BASE_URL,
+         assistant.keys, aiko.bulkhead._llm_bulkhead, aiko.key_pool.QUOTA_WINDOW) = saved
+
+
+def _key_burst(specs):
+    """KEYS_TURNS turns from KEYS_THREADS threads through a pool of specs against the stub"""
+    import google.genai
+    from concurrent.futures import ThreadPoolExecutor
+
+    stub = keys_stub()
+    time.sleep(KEYS_WINDOW)  # start with every key's window empty
+    stub['answered'].clear()
+    stub['refused'].clear()
+    pool = aiko.key_pool.KeyPool(specs)
+    with gemini_through(pool, google.genai, stub['url']):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(KEYS_THREADS) as executor:
+            replies = list(executor.map(
+                lambda i: assistant.generate_response(QUESTION_MESSAGE, [], i, 'natural', None),
+                range(KEYS_TURNS)))
+        burst_ms = 1000 * (time.perf_counter() - started)
+    return {'burst_ms': round(burst_ms),
+            'gemini': sum(reply['is_gemini'] for reply in replies),
+            'offline': sum(not reply['is_gemini'] for reply in replies),
+            'upstream_429s': sum(stub['refused'].values()),
+            'per_key': '/'.join(str(stats['requests'] - stats['rate_limited'])
+                                for stats in pool.stats().values())}
+
+
+@benchmark('keys_single_key', group='keys')
+def _keys_single_key():
+    return _key_burst([('bench-key-0', KEYS_STUB_RPM, 0)])
+
+
+@benchmark('keys_pool_with_quotas', group='keys')
+def _keys_pool_with_quotas():
+    return _key_burst([(f'bench-key-{i}', KEYS_STUB_RPM, 0) for i in range(KEYS_COUNT)])
+
+
+@benchmark('keys_pool_429_only', group='keys')
+def _keys_pool_429_only():
+    # No declared quota: keys are only taken out of rotation by their 429s
+    return _key_burst([(f'bench-key-{i}', 0, 0) for i in range(KEYS_COUNT)])
+
+
+def _new_client(key):
+    import google.genai
+    return google.genai.Client(api_key=key)
+
+
+client_pool = aiko.key_pool.KeyPool([('bench-key-0', 0, 0)])
+
+
+@benchmark('keys_client_per_call', group='keys')
+def _keys_client_per_call():
+    # Before: a new SDK client for every turn
+    _new_client('bench-key-0')
+
+
+@benchmark('keys_client_reused', group='keys')
+def _keys_client_reused():
+    client_pool.client(client_pool.acquire(), _new_client)
+
+
+# --- Runner ---
+def measure(fn, repeat=5):
+    """Return (ns per call, peak bytes allocated in one call, fn's return value)"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    best = min(timer.repeat(repeat=repeat, number=number))
+    ns_per_call = best / number * 1e9
+
+    fn()  # warm caches so the allocation figure reflects steady state
+    tracemalloc.start()
+    try:
+        if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+            tracemalloc.reset_peak()
+        start, _ = tracemalloc.get_traced_memory()
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return ns_per_call, max(peak - start, 0), result
+
+
+def _calibration_workload():
+    # Sorting, hashing and string work, like the cases themselves
+    counts = {}
+    for item in sorted(CALIBRATION_DATA, key=lambda item: item[-4:]):
+        counts[item[:2]] = counts.get(item[:2], 0) + len(item.split('-')[1])
+    return counts
+
+
+def calibrate():
+    """ns per call of a fixed workload: how fast this machine is running right now"""
+    return measure(_calibration_workload)[0]
+
+
+def _change(ns, calibration, base):
+    """ns relative to the baseline entry `base`, or None without one.
+
+    Each entry keeps the calibration time of the run that saved it, and the
+    comparison discounts how much slower the machine is running now (a busy
+    CI runner, a laptop on battery). A faster machine is not credited, so
+    cases that mostly wait on sleeps or timeouts cannot hide a regression.
+    """
+    if not base:
+        return None
+    slowdown = max(calibration / base['calibration_ns'], 1.0) if base.get('calibration_ns') else 1.0
+    return ns / slowdown / base['ns_per_call']
+
+
+def load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE) as f:
+        return json.load(f).get('results', {})
+
+
+def save_baseline(results):
+    payload = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(BASELINE_FILE, 'w') as f:
+        json.dump(payload, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Aiko hot-path microbenchmarks")
+    parser.add_argument('-k', dest='keyword', default='', help="only run cases whose name contains this")
+    parser.add_argument('--group', default='hot', help="benchmark group to run ('all' for every group)")
+    parser.add_argument('--save', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--check', action='store_true', help="exit non-zero if a case regressed")
+    args = parser.parse_args(argv)
+
+    random.seed(0)
+    baseline = load_baseline()
+    results = {}
+    regressions = []
+    over_budget = []
+
+    print(f"{'case':<34} {'ns/call':>12} {'peak B':>10} {'vs base':>9}")
+    print("-" * 68)
+    calibrated_group, calibration = None, None
+    for case in BENCHMARKS:
+        if args.group != 'all' and case['group'] != args.group:
+            continue
+        if args.keyword not in case['name']:
+            continue
+        if SERVER_DB and case['group'] == 'search':
+            continue  # the search index is SQLite FTS5
+
+        if case['group'] != calibrated_group:
+            calibrated_group, calibration = case['group'], calibrate()
+            print(f"[{case['group']}: calibration {calibration:,.0f} ns]")
+
+        ns, peak, extra = measure(case['fn'])
+        base = baseline.get(case['name'])
+        change = _change(ns, calibration, base)
+        if change is not None and change > REGRESSION_THRESHOLD:
+            # Confirm with a second run before calling it a regression: one
+            # slow stretch on a shared machine can cover a whole measurement
+            calibration = calibrate()
+            ns = min(ns, measure(case['fn'])[0])
+            change = _change(ns, calibration, base)
+
+        results[case['name']] = {'ns_per_call': round(ns, 1), 'peak_bytes': peak,
+                                 'calibration_ns': round(calibration, 1)}
+        if isinstance(extra, dict):
+            # Cases may report extra figures (payload sizes, rates, ...)
+            results[case['name']].update(extra)
+        if case['max_peak_bytes'] is not None and peak > case['max_peak_bytes']:
+            over_budget.append(case['name'])
+
+        ratio = ""
+        if change is not None:
+            ratio = f"{change:.2f}x"
+            if change > REGRESSION_THRESHOLD:
+                regressions.append(case['name'])
+                ratio += " ⚠️"
+        print(f"{case['name']:<34} {ns:>12,.0f} {peak:>10,} {ratio:>9}")
+        if isinstance(extra, dict):
+            print("    " + ", ".join(f"{key}={value:,}" if isinstance(value, int) else f"{key}={value}"
+                                   for key, value in extra.items()))
+
+    if args.save:
+        merged = dict(baseline)
+        merged.update(results)
+        save_baseline(merged)
+        print(f"\n✅ Baseline saved to {os.path.basename(BASELINE_FILE)}")
+
+    if over_budget:
+        print(f"\n❌ Allocated more than their memory budget: {', '.join(over_budget)}")
+        return 1
+
+    if regressions:
+        print(f"\n⚠️ Slower than baseline by >{REGRESSION_THRESHOLD}x: {', '.join(regressions)}")
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Bulkhead for upstream LLM calls.
+
+A gthread worker has THREADS request threads (serve.py). When Gemini slows
+down, every one of them can end up waiting inside generate_content and
+/status, /history and /login queue behind them. The bulkhead lets at most
+LLM_MAX_CONCURRENT calls per worker go upstream; up to LLM_QUEUE_SIZE more
+wait, highest priority first (spoken turns, then typed turns, then
+background work), for at most their deadline. A call that finds the queue
+full, waits past its deadline, or is pushed out of a full queue by a more
+urgent one gets Rejected at once, and the caller answers offline. The
+defaults leave at least one thread per worker free for everything else.
+
+Time spent queued is recorded per call for /metrics.
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+WORKER_THREADS = int(os.getenv('THREADS', 4))
+LLM_MAX_CONCURRENT = int(os.getenv('LLM_MAX_CONCURRENT', max(1, WORKER_THREADS // 2)))
+LLM_QUEUE_SIZE = int(os.getenv('LLM_QUEUE_SIZE', max(0, WORKER_THREADS - LLM_MAX_CONCURRENT - 1)))
+LLM_QUEUE_TIMEOUT = float(os.getenv('LLM_QUEUE_TIMEOUT', 2.0))   # seconds an interactive turn may wait
+WAIT_SAMPLES = 1024             # recent admitted calls kept for the wait percentiles
+
+# Lower rank is served first
+PRIORITIES = {'voice': 0, 'text': 1, 'background': 2}
+
+
+class Rejected(Exception):
+    """The call was shed: reason is 'full', 'timeout' or 'displaced'"""
+
+    def __init__(self, reason):
+        super().__init__(f"LLM bulkhead rejected the call ({reason})")
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ('event', 'state')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.state = None   # 'granted' or 'displaced' once decided
+
+
+class Bulkhead:
+    """Caps concurrent calls; queues the overflow by priority with a deadline"""
+
+    def __init__(self, limit=LLM_MAX_CONCURRENT, queue_size=LLM_QUEUE_SIZE):
+        self.limit = limit
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queue = []                # heap of (rank, seq, priority, waiter)
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._counts = {priority: {'admitted': 0, 'queued': 0, 'wait_seconds': 0.0,
+                                   'full': 0, 'timeout': 0, 'displaced': 0}
+                        for priority in PRIORITIES}
+
+    @contextmanager
+    def slot(self, priority='text', timeout=LLM_QUEUE_TIMEOUT):
+        """Hold one upstream slot for the with block; raises Rejected if none comes in time"""
+        self._acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _acquire(self, priority, timeout):
+        rank = PRIORITIES[priority]
+        counts = self._counts[priority]
+        with self._lock:
+            if self._active < self.limit and not self._queue:
+                self._active += 1
+                self._admit(counts, 0.0)
+                return
+            if len(self._queue) >= self.queue_size:
+                worst = max(self._queue, default=None)
+                if worst is None or worst[0] <= rank:
+                    counts['full'] += 1
+                    raise Rejected('full')
+                # A less urgent call gives up its place
+                self._queue.remove(worst)
+                heapq.heapify(self._queue)
+                worst[3].state = 'displaced'
+                worst[3].event.set()
+            waiter = _Waiter()
+            heapq.heappush(self._queue, (rank, next(self._seq), priority, waiter))
+            counts['queued'] += 1
+
+        started = time.perf_counter()
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.state == 'granted':
+                self._admit(counts, time.perf_counter() - started)
+                return
+            if waiter.state is None:
+                self._queue = [entry for entry in self._queue if entry[3] is not waiter]
+                heapq.heapify(self._queue)
+                counts['timeout'] += 1
+                raise Rejected('timeout')
+            counts['displaced'] += 1
+            raise Rejected('displaced')
+
+    def _admit(self, counts, waited):
+        counts['admitted'] += 1
+        counts['wait_seconds'] += waited
+        self._waits.append(waited)
+
+    def _release(self):
+        with self._lock:
+            if self._queue:
+                # Hand the slot straight to the most urgent waiter
+                waiter = heapq.heappop(self._queue)[3]
+                waiter.state = 'granted'
+                waiter.event.set()
+            else:
+                self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            by_priority = {
+                priority: {
+                    'admitted': counts['admitted'],
+                    'queued': counts['queued'],
+                    'shed': {reason: counts[reason] for reason in ('full', 'timeout', 'displaced')},
+                    'mean_wait_ms': round(1000 * counts['wait_seconds'] / counts['admitted'], 1)
+                    if counts['admitted'] else None,
+                }
+                for priority, counts in self._counts.items()
+            }
+            return {
+                'limit': self.limit,
+                'queue_size': self.queue_size,
+                'in_flight': self._active,
+                'queued': len(self._queue),
+                'wait_ms': {
+                    'p50': round(1000 * waits[len(waits) // 2], 1) if waits else None,
+                    'p95': round(1000 * waits[int(len(waits) * 0.95)], 1) if waits else None,
+                    'max': round(1000 * waits[-1], 1) if waits else None,
+                },
+                'by_priority': by_priority,
+            }
+
+
+_llm_bulkhead = None
+
+
+def get_llm_bulkhead():
+    """Per-process bulkhead for Gemini calls (each worker has its own threads)"""
+    global _llm_bulkhead
+    if _llm_bulkhead is None:
+        _llm_bulkhead = Bulkhead()
+    return _llm_bulkhead
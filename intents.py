@@ -0,0 +1,271 @@
+"""Local intent router: answers small talk without calling the LLM.
+
+A message is normalized and matched against precompiled patterns for a few
+small-talk intents (greetings, thanks, goodbyes, ...). Anything the patterns
+miss is scored by a small vectorized model: hashed character trigram
+vectors compared (cosine) with example utterances of each intent and of
+ordinary chat, best example per intent. The router answers locally only when
+an intent wins with at least INTENT_THRESHOLD confidence; everything else,
+and any message longer than INTENT_MAX_WORDS, goes to the LLM.
+
+numpy is imported when the model is first built.
+"""
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+INTENT_THRESHOLD = float(os.getenv('INTENT_THRESHOLD', 0.8))
+INTENT_MAX_WORDS = 6          # longer messages always go to the LLM
+FEATURE_BITS = 12             # 4,096 hashed trigram buckets
+OTHER = 'other'               # the model's label for "needs the LLM"
+
+# intent -> (pattern over the whole normalized message, example utterances for
+# the model, whether it can still be answered locally right after the
+# assistant asked a question: "sure" or "ok" then answer that question)
+INTENTS = {
+    'greeting': (
+        r"(hi+|hey+|hello+|hiya|heya|howdy|yo|greetings|good (morning|afternoon|evening))( there| aiko| again)*",
+        ("hi", "hello", "hey", "hey there", "hello aiko", "hi aiko", "good morning", "good evening",
+         "hiya", "heyy", "hello hello", "morning", "hi again", "hey you", "helo", "hellooo there"),
+        True,
+    ),
+    'how_are_you': (
+        r"(hi |hey |hello )?(how are (you|u)( doing| today)*|how('?s| is) it going|how have you been|what'?s up|sup|wassup)",
+        ("how are you", "how are you doing", "how's it going", "what's up", "how are you today",
+         "how have you been", "how r u", "how are u", "hey how are you", "how is your day", "how you doing",
+         "how's your day going"),
+        True,
+    ),
+    'thanks': (
+        r"(thanks+|thank (you|u)|thx|ty|tysm|many thanks|thanks (a lot|so much)|thank (you|u) (so|very) much)( aiko)?",
+        ("thanks", "thank you", "thx", "ty", "thanks a lot", "thank you so much", "thanks aiko",
+         "many thanks", "thank u", "thanks so much", "thanks again", "tysm", "cheers thanks", "thankyou",
+         "thanks a bunch", "thank you very much"),
+        True,
+    ),
+    'goodbye': (
+        r"(bye+|goodbye|bye bye|see (you|ya|u)( later| soon| tomorrow)?|good ?night|gtg|got to go|gotta go|talk (to you )?(later|soon)|later|cya)( aiko)?",
+        ("bye", "goodbye", "see you later", "good night", "gtg", "gotta go", "talk later", "see ya",
+         "bye aiko", "bye bye", "see you tomorrow", "night night", "cya", "i have to go now", "ok bye"),
+        True,
+    ),
+    'acknowledge': (
+        r"(ok(ay)?|k|cool|nice|great|got it|alright|sounds good|i see|fair enough|makes sense|lol|haha+)",
+        ("ok", "okay", "cool", "nice", "got it", "alright", "sounds good", "i see", "great",
+         "makes sense", "fair enough", "lol", "haha", "ok cool", "nice one"),
+        False,
+    ),
+}
+
+# Ordinary chat the model must leave to the LLM, including short messages
+# that start like small talk
+OTHER_EXAMPLES = (
+    "what is the weather like", "tell me a joke", "can you help me", "i need advice", "what time is it",
+    "explain black holes", "hi can you help me with homework", "hello i have a question",
+    "thanks but that is wrong", "why is the sky blue", "who won the game", "write me a poem",
+    "i feel sad today", "what should i eat", "do you like music", "what do you think about that",
+    "how do i cook rice", "how does this work", "what is your favorite movie", "tell me more",
+    "can you explain that again", "i don't understand", "that is not what i meant", "are you real",
+    "good question what about dogs", "remind me tomorrow", "translate this to french",
+    "how far is the moon", "what's the capital of france", "i am bored", "let's play a game",
+    "how old are you", "where are you from", "how are you so smart", "what are you doing",
+    "what's up with that", "thanks for nothing",
+)
+
+REPLIES = {
+    'greeting': {
+        'natural': ["Hi! Good to see you. What's on your mind?", "Hey there! How's your day going?"],
+        'warm': ["Hello! I'm so glad you stopped by. How are you?", "Hi there! It's lovely to hear from you."],
+        'energetic': ["Hey hey! Great to see you! What's up?", "Hi!! Ready for a fun chat?"],
+        'calm': ["Hello. It's nice to hear from you.", "Hi. I hope your day is going gently."],
+        'playful': ["Well hello there! Miss me?", "Hiya! What are we getting up to today?"],
+    },
+    'how_are_you': {
+        'natural': ["I'm doing well, thanks for asking! How about you?", "Pretty good! What about you?"],
+        'warm': ["I'm doing well, and even better now that we're talking. How are you feeling?",
+                 "That's sweet of you to ask! I'm good. How are you, really?"],
+        'energetic': ["I'm great, thanks! Full of energy! How about you?", "Awesome, as always! What about you?"],
+        'calm': ["I'm well, thank you. How are you feeling today?", "Peaceful and content. And you?"],
+        'playful': ["Fabulous, obviously! And you?", "Better now that you're here! How about you?"],
+    },
+    'thanks': {
+        'natural': ["You're welcome!", "No problem at all!"],
+        'warm': ["You're so welcome. I'm always happy to help.", "Anytime! It was my pleasure."],
+        'energetic': ["You're welcome! Happy to help!", "Anytime! That was fun!"],
+        'calm': ["You're welcome.", "It was my pleasure."],
+        'playful': ["Aww, you're welcome!", "Anytime! You owe me one, hehe."],
+    },
+    'goodbye': {
+        'natural': ["Bye! Talk to you soon.", "See you later! Take care."],
+        'warm': ["Take care of yourself! I'll be here whenever you want to talk.", "Goodbye for now. It was lovely chatting."],
+        'energetic': ["Bye! That was awesome, come back soon!", "See ya! Have an amazing day!"],
+        'calm': ["Goodbye. Rest well.", "Take care. Talk soon."],
+        'playful': ["Bye bye! Don't have too much fun without me!", "See ya later, alligator!"],
+    },
+    'acknowledge': {
+        'natural': ["Great! Anything else on your mind?", "Alright! What would you like to talk about next?"],
+        'warm': ["Wonderful. I'm here if you want to talk about anything else.", "Okay! I'm listening whenever you're ready."],
+        'energetic': ["Awesome! What's next?", "Cool! Let's keep going!"],
+        'calm': ["Alright. Take your time.", "Okay. I'm here when you need me."],
+        'playful': ["Cool cool! What's next on the agenda?", "Okie dokie! What now?"],
+    },
+}
+
+_NOT_WORD = re.compile(r"[^a-z0-9' ]+")
+_SPACES = re.compile(r"\s+")
+_PATTERNS = [(intent, re.compile(pattern)) for intent, (pattern, _, _) in INTENTS.items()]
+
+
+def normalize(text):
+    """Lowercase words only: punctuation and emoji dropped, curly apostrophes straightened"""
+    text = _NOT_WORD.sub(' ', text.lower().replace('’', "'"))
+    return _SPACES.sub(' ', text).strip()
+
+
+def _trigrams(text):
+    """Bucket numbers of the padded word-boundary character trigrams of normalized text"""
+    padded = f" {text} "
+    mask = (1 << FEATURE_BITS) - 1
+    return [zlib.crc32(padded[i:i + 3].encode()) & mask for i in range(len(padded) - 2)]
+
+
+class IntentModel:
+    """Nearest-example classifier over L2-normalized hashed trigram counts"""
+
+    def __init__(self, examples):
+        import numpy as np
+        labels, rows = [], []
+        for label, texts in examples.items():
+            for text in texts:
+                labels.append(label)
+                rows.append(_trigrams(normalize(text)))
+        matrix = np.zeros((len(rows), 1 << FEATURE_BITS), dtype=np.float32)
+        for row, buckets in zip(matrix, rows):
+            np.add.at(row, buckets, 1.0)
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.labels = np.array(labels)
+        self.names = sorted(set(labels))
+        # Column-major, so the columns of one message's buckets are gathered cheaply
+        self.matrix = np.asfortranarray(matrix)
+        self._np = np
+
+    def classify(self, text):
+        """(label, cosine similarity to its closest example)"""
+        np = self._np
+        buckets, counts = np.unique(_trigrams(text), return_counts=True)
+        if not len(buckets):
+            return OTHER, 0.0
+        scores = self.matrix[:, buckets] @ (counts / np.sqrt((counts * counts).sum())).astype(np.float32)
+        best = int(scores.argmax())
+        return str(self.labels[best]), float(scores[best])
+
+
+class LocalAnswer:
+    __slots__ = ('intent', 'text', 'confidence', 'source')
+
+    def __init__(self, intent, text, confidence, source):
+        self.intent = intent
+        self.text = text
+        self.confidence = confidence
+        self.source = source  # 'pattern' or 'model'
+
+
+class IntentRouter:
+    """Decides per message between a local small-talk reply and the LLM, and counts both"""
+
+    def __init__(self, threshold=INTENT_THRESHOLD):
+        self.threshold = threshold
+        self._model = None
+        self._lock = threading.Lock()
+        self._counts = {'messages': 0, 'pattern': 0, 'model': 0}
+        self._by_intent = dict.fromkeys(INTENTS, 0)
+        self._route_seconds = 0.0
+        self._llm_calls = 0
+        self._llm_seconds = 0.0
+
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    examples = {intent: spec[1] for intent, spec in INTENTS.items()}
+                    examples[OTHER] = OTHER_EXAMPLES
+                    self._model = IntentModel(examples)
+        return self._model
+
+    def classify(self, text, after_question=False):
+        """(intent or None, confidence, source) for one message"""
+        text = normalize(text)
+        if not text or text.count(' ') >= INTENT_MAX_WORDS:
+            return None, 0.0, None
+
+        for intent, pattern in _PATTERNS:
+            if pattern.fullmatch(text):
+                source, confidence = 'pattern', 1.0
+                break
+        else:
+            intent, confidence = self.model().classify(text)
+            source = 'model'
+            if intent == OTHER or confidence < self.threshold:
+                return None, confidence, None
+
+        if after_question and not INTENTS[intent][2]:
+            return None, confidence, None
+        return intent, confidence, source
+
+    def route(self, message, voice_style='natural', history=()):
+        """A LocalAnswer for confident small talk, or None to ask the LLM"""
+        self.model()  # built once per process (preload_shared_state does it before forking); not timed
+        started = time.perf_counter()
+        after_question = bool(history) and history[-1]['role'] != 'user' and history[-1]['content'].rstrip().endswith('?')
+        intent, confidence, source = self.classify(message, after_question)
+        answer = None
+        if intent is not None:
+            replies = REPLIES[intent]
+            answer = LocalAnswer(intent, random.choice(replies.get(voice_style, replies['natural'])), confidence, source)
+
+        with self._lock:
+            self._counts['messages'] += 1
+            self._route_seconds += time.perf_counter() - started
+            if answer is not None:
+                self._counts[source] += 1
+                self._by_intent[intent] += 1
+        return answer
+
+    def record_llm(self, seconds):
+        """Time of one LLM reply, to estimate what local answers saved"""
+        with self._lock:
+            self._llm_calls += 1
+            self._llm_seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            messages = self._counts['messages']
+            local = self._counts['pattern'] + self._counts['model']
+            llm_ms = 1000 * self._llm_seconds / self._llm_calls if self._llm_calls else None
+            route_us = 1e6 * self._route_seconds / messages if messages else 0.0
+            return {
+                'messages': messages,
+                'local': local,
+                'local_rate': round(local / messages, 3) if messages else 0.0,
+                'pattern_hits': self._counts['pattern'],
+                'model_hits': self._counts['model'],
+                'by_intent': dict(self._by_intent),
+                'mean_route_us': round(route_us, 1),
+                'mean_llm_ms': None if llm_ms is None else round(llm_ms, 1),
+                # Each local answer saves one LLM reply, minus the time spent routing every message
+                'latency_saved_ms': None if llm_ms is None else round(local * llm_ms - messages * route_us / 1000, 1),
+            }
+
+
+_router = None
+
+
+def get_router():
+    """Per-process router (its counters are per worker, like /metrics)"""
+    global _router
+    if _router is None:
+        _router = IntentRouter()
+    return _router
@@ -0,0 +1,72 @@
+"""
+Flask JSON provider backed by orjson, with the stdlib json module as fallback.
+
+With orjson installed (`pip install orjson`) responses are encoded several
+times faster; without it, encoding goes through Flask's default provider.
+Both paths accept rows.Rows (what storage returns), query rows that stay
+tuples until the encoder turns each into a {column: value} object, so large
+histories and exports skip per-row conversion in Python.
+"""
+
+from itertools import repeat
+
+from flask.json.provider import DefaultJSONProvider
+
+from rows import Rows
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if orjson is not None:
+    # Dates go through default() as with the stdlib, so both paths agree
+    ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+    ORJSON_INDENT_OPTIONS = ORJSON_OPTIONS | orjson.OPT_INDENT_2
+
+
+def _objects(rows):
+    # dict(zip()) runs in C; measured faster than formatting each row as text
+    return list(map(dict, map(zip, repeat(rows.columns), rows.rows)))
+
+
+class JSONProvider(DefaultJSONProvider):
+    sort_keys = False  # insertion order is already stable, and sorting large payloads costs
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Rows):
+            return _objects(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def dumps_bytes(self, obj, indent=False):
+        """obj as UTF-8 JSON"""
+        if orjson is None:
+            return super().dumps(obj, indent=2 if indent else None).encode()
+        options = ORJSON_INDENT_OPTIONS if indent else ORJSON_OPTIONS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=options)
+
+    def ndjson(self, rows):
+        """storage.Rows as newline-delimited JSON objects (UTF-8)"""
+        if orjson is None:
+            return ''.join(DefaultJSONProvider.dumps(self, o) + '\n' for o in rows).encode()
+        return b''.join([orjson.dumps(o, default=self.default, option=ORJSON_OPTIONS) + b'\n' for o in rows])
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dumps_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
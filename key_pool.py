@@ -0,0 +1,252 @@
+"""Pool of Gemini API keys with quota-aware balancing.
+
+GEMINI_API_KEYS lists several keys (comma or whitespace separated), each
+optionally followed by its own limits as key:rpm or key:rpm:tpm; keys
+without them get GEMINI_KEY_RPM requests and GEMINI_KEY_TPM tokens per
+minute (0 means unlimited). GEMINI_API_KEY still works on its own or as one
+more key.
+
+Each call takes the key with the largest share of its per-minute quota left
+in a sliding window, so keys with different limits fill up evenly. A
+conversation stays on the key it last used while that key has quota, which
+keeps its Gemini context caches (created per key) usable. A key answered
+with 429 cools down for the delay the API asks for, or for a backoff that
+doubles with each consecutive 429, and calls move to the other keys; when
+every key is cooling down or out of quota, acquire raises KeysExhausted and
+the turn is answered offline. Each key's SDK client is created once and
+reused. Requests, tokens, 429s and errors are counted per key for /metrics.
+
+Usage is tracked per process; serve.py gives each gunicorn worker its share
+of every key's limits (KeyPool.split). The shares add up to the key's
+quota, so a key with fewer calls per minute than there are workers is only
+used by some of them. Gemini TTS leases keys from the same pool.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+GEMINI_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', 15))
+GEMINI_KEY_TPM = int(os.getenv('GEMINI_KEY_TPM', 1_000_000))
+GEMINI_KEY_COOLDOWN = float(os.getenv('GEMINI_KEY_COOLDOWN', 5.0))   # first backoff after a 429
+MAX_COOLDOWN = 300.0
+QUOTA_WINDOW = 60.0             # seconds; the per-minute limits are enforced over a sliding window
+AFFINITY_ENTRIES = 4096         # conversations remembered for key affinity
+
+_RETRY_DELAY = re.compile(r"retry(?:Delay['\"]?\s*:\s*['\"]?| in )(\d+(?:\.\d+)?)s", re.IGNORECASE)
+
+
+class KeysExhausted(Exception):
+    """Every key is cooling down after a 429 or out of its per-minute quota"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"all Gemini API keys are rate limited (retry in {retry_after:.1f}s)")
+        self.retry_after = retry_after
+
+
+def is_rate_limited(error):
+    """Whether an SDK exception is a 429 / RESOURCE_EXHAUSTED answer"""
+    code = getattr(error, 'code', None)
+    if code == 429:     # google.genai APIError; google.api_core's HTTPStatus compares equal too
+        return True
+    return 'RESOURCE_EXHAUSTED' in str(error) or str(error).startswith('429 ')
+
+
+def retry_after(error):
+    """Seconds the API asked us to wait before retrying, if it said"""
+    match = _RETRY_DELAY.search(str(error))
+    return float(match.group(1)) if match else None
+
+
+def parse_keys(keys, single=None):
+    """[(key, rpm, tpm)] from GEMINI_API_KEYS-style text plus an optional GEMINI_API_KEY"""
+    specs = []
+    for entry in re.split(r"[\s,]+", keys or ''):
+        if not entry:
+            continue
+        key, *limits = entry.split(':')
+        rpm = int(limits[0]) if len(limits) > 0 and limits[0] else GEMINI_KEY_RPM
+        tpm = int(limits[1]) if len(limits) > 1 and limits[1] else GEMINI_KEY_TPM
+        specs.append((key, rpm, tpm))
+    if single and single not in (spec[0] for spec in specs):
+        specs.insert(0, (single, GEMINI_KEY_RPM, GEMINI_KEY_TPM))
+    return specs
+
+
+class ApiKey:
+    """One key's limits, sliding-window usage, cooldown and counters"""
+
+    def __init__(self, key, rpm, tpm, label):
+        self.key = key
+        self.rpm = rpm
+        self.tpm = tpm
+        self.label = label          # safe to log: the last characters only
+        self.client = None
+        self.window = deque()       # (started, tokens) of the calls in the last QUOTA_WINDOW
+        self.window_tokens = 0
+        self.cooldown_until = 0.0
+        self.strikes = 0            # consecutive 429s
+        self.counts = {'requests': 0, 'rate_limited': 0, 'errors': 0, 'input_tokens': 0, 'output_tokens': 0}
+
+    def expire(self, now):
+        while self.window and self.window[0][0] <= now - QUOTA_WINDOW:
+            self.window_tokens -= self.window.popleft()[1]
+
+    def remaining(self, now):
+        """Share (0..1) of this minute's quota still free"""
+        self.expire(now)
+        share = 1.0 - len(self.window) / self.rpm if self.rpm else 1.0
+        if self.tpm:
+            share = min(share, 1.0 - self.window_tokens / self.tpm)
+        return share
+
+    def next_free(self, now):
+        """Seconds until this key can take a call"""
+        wait = max(self.cooldown_until - now, 0.0)
+        if self.rpm and len(self.window) >= self.rpm:
+            wait = max(wait, self.window[0][0] + QUOTA_WINDOW - now)
+        return wait
+
+
+class Lease:
+    """One call's claim on a key, returned by KeyPool.acquire"""
+    __slots__ = ('api_key', 'entry')
+
+    def __init__(self, api_key, entry):
+        self.api_key = api_key
+        self.entry = entry
+
+    @property
+    def label(self):
+        return self.api_key.label
+
+
+class KeyPool:
+    """Balances calls across API keys by remaining quota"""
+
+    def __init__(self, specs):
+        self.keys = [ApiKey(key, rpm, tpm, f"key{i + 1}…{key[-4:]}") for i, (key, rpm, tpm) in enumerate(specs)]
+        self._lock = threading.Lock()
+        self._affinity = OrderedDict()      # conversation -> ApiKey it last used
+
+    def __bool__(self):
+        return bool(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def acquire(self, affinity=None, exclude=(), only=None):
+        """Lease the best key for one call; raises KeysExhausted if none can take it now.
+
+        affinity names the conversation, exclude holds keys already tried for
+        this call, and only restricts the choice to the first `only` keys.
+        """
+        now = time.monotonic()
+        with self._lock:
+            candidates = [api_key for api_key in self.keys[:only] if api_key not in exclude]
+            if not candidates:
+                raise KeysExhausted(min(api_key.next_free(now) for api_key in self.keys[:only]))
+            shares = {api_key: api_key.remaining(now) for api_key in candidates}
+            usable = [api_key for api_key in candidates
+                      if api_key.cooldown_until <= now and shares[api_key] > 0]
+            if not usable:
+                raise KeysExhausted(min(api_key.next_free(now) for api_key in candidates))
+
+            chosen = self._affinity.get(affinity) if affinity is not None else None
+            if chosen not in usable:
+                chosen = max(usable, key=shares.__getitem__)
+            if affinity is not None:
+                self._affinity[affinity] = chosen
+                self._affinity.move_to_end(affinity)
+                if len(self._affinity) > AFFINITY_ENTRIES:
+                    self._affinity.popitem(last=False)
+
+            entry = [now, 0]
+            chosen.window.append(entry)
+            chosen.counts['requests'] += 1
+            return Lease(chosen, entry)
+
+    def client(self, lease, factory):
+        """The key's SDK client, made with factory(api_key) on first use"""
+        api_key = lease.api_key
+        if api_key.client is None:
+            with self._lock:
+                if api_key.client is None:
+                    api_key.client = factory(api_key.key)
+        return api_key.client
+
+    def succeeded(self, lease, input_tokens=0, output_tokens=0):
+        api_key = lease.api_key
+        with self._lock:
+            api_key.strikes = 0
+            api_key.counts['input_tokens'] += input_tokens
+            api_key.counts['output_tokens'] += output_tokens
+            if lease.entry[0] > time.monotonic() - QUOTA_WINDOW:
+                # Tokens count against the minute the call was made in
+                lease.entry[1] = input_tokens + output_tokens
+                api_key.window_tokens += lease.entry[1]
+
+    def rate_limited(self, lease, delay=None):
+        """The API answered 429: cool the key down for delay, or an exponential backoff"""
+        api_key = lease.api_key
+        with self._lock:
+            api_key.counts['rate_limited'] += 1
+            api_key.strikes += 1
+            if delay is None:
+                delay = min(GEMINI_KEY_COOLDOWN * 2 ** (api_key.strikes - 1), MAX_COOLDOWN)
+            api_key.cooldown_until = max(api_key.cooldown_until, time.monotonic() + delay)
+
+    def split(self, workers, slot=0):
+        """Give this process its share of each key's quota when several workers use the keys.
+
+        Worker `slot` (0 to workers - 1) gets limit // workers plus one of the
+        remainder if slot < limit % workers, so the shares of all workers add
+        up to the limit. Keys whose share here is zero are dropped from this
+        process's pool.
+        """
+        def share(limit):
+            return limit // workers + (1 if slot < limit % workers else 0)
+
+        with self._lock:
+            kept = []
+            for api_key in self.keys:
+                rpm = share(api_key.rpm) if api_key.rpm else 0
+                tpm = share(api_key.tpm) if api_key.tpm else 0
+                if (api_key.rpm and not rpm) or (api_key.tpm and not tpm):
+                    continue
+                api_key.rpm, api_key.tpm = rpm, tpm
+                kept.append(api_key)
+            self.keys = kept
+
+    def failed(self, lease):
+        with self._lock:
+            lease.api_key.counts['errors'] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            for api_key in self.keys:
+                api_key.expire(now)
+            return {
+                api_key.label: {
+                    **api_key.counts,
+                    'rpm': api_key.rpm,
+                    'tpm': api_key.tpm,
+                    'last_minute_requests': len(api_key.window),
+                    'last_minute_tokens': api_key.window_tokens,
+                    'cooldown_s': round(max(api_key.cooldown_until - now, 0.0), 1),
+                }
+                for api_key in self.keys
+            }
+
+
+_pool = None
+
+
+def get_key_pool():
+    """Per-process pool over the configured keys (quotas are tracked per worker)"""
+    global _pool
+    if _pool is None:
+        _pool = KeyPool(parse_keys(os.getenv('GEMINI_API_KEYS'), os.getenv('GEMINI_API_KEY')))
+    return _pool
@@ -0,0 +1,462 @@
+"""Versioned schema migrations for the main database and each message shard.
+
+Every database records the last migration fully applied to it: SQLite in
+PRAGMA user_version, other databases in a one-row schema_version table.
+A migration has up to two parts:
+
+- schema(): quick, idempotent DDL (tables, columns, indexes, triggers).
+  init_db runs it for every pending migration, so the code can rely on the
+  newest schema from the moment it starts.
+- backfill(): rewrites existing rows, one batch per call, for changes that
+  touch every row. The runner commits each batch in its own transaction
+  together with a checkpoint in migration_progress, and yields between
+  batches, so the app keeps serving and an interrupted run resumes where
+  it stopped.
+
+A database's version only moves past a migration once its backfill is done.
+Backfills smaller than STARTUP_BACKFILL_ROWS run at startup; larger ones
+wait for `flask --app app migrate`, which can first estimate them with
+--dry-run. Backfills run strictly in version order; schema steps must not
+depend on an earlier migration's backfill.
+"""
+import math
+import os
+import time
+
+from sqlalchemy import (
+    Column, Integer, MetaData, Table, create_engine, delete, event, func, inspect, insert, select, text, update,
+)
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import NullPool
+
+import storage
+from storage import chat_messages, conversations
+
+STARTUP_BACKFILL_ROWS = int(os.getenv('STARTUP_BACKFILL_ROWS', 10_000))
+DRY_RUN_BATCHES = 3  # sample batches timed by estimate()
+
+# Bookkeeping tables, created in every database next to the app's own
+metadata = MetaData()
+
+schema_version = Table(  # not on SQLite, which has PRAGMA user_version
+    'schema_version', metadata,
+    Column('version', Integer, nullable=False),
+)
+
+migration_progress = Table(
+    'migration_progress', metadata,
+    Column('version', Integer, primary_key=True),
+    Column('position', Integer, nullable=False),  # last row id handled
+    Column('end_position', Integer),  # last row id to handle, if fixed when the backfill started
+)
+
+
+class Database:
+    """One database of a Storage: the main one (users, sessions, preferences) or a message shard"""
+
+    def __init__(self, engine, main):
+        self.engine = engine
+        self.main = main
+
+    @property
+    def name(self):
+        url = self.engine.url
+        return url.database if url.get_backend_name() == 'sqlite' else url.render_as_string(hide_password=True)
+
+
+def databases(db):
+    """Database for each engine of a storage.Storage, main database first"""
+    sharded = db.message_engines[0] is not db.engine
+    yield Database(db.engine, main=True)
+    if sharded:
+        for engine in db.message_engines:
+            yield Database(engine, main=False)
+
+
+# --- Versions and checkpoints ---
+def get_version(conn):
+    if conn.dialect.name == 'sqlite':
+        return conn.exec_driver_sql('PRAGMA user_version').scalar()
+    if not inspect(conn).has_table('schema_version'):
+        return 0
+    return conn.execute(select(schema_version.c.version)).scalar() or 0
+
+
+def _set_version(conn, version):
+    if conn.dialect.name == 'sqlite':
+        conn.exec_driver_sql(f'PRAGMA user_version = {int(version)}')
+    else:
+        conn.execute(update(schema_version).values(version=version))
+
+
+def _create_bookkeeping(conn):
+    migration_progress.create(conn, checkfirst=True)
+    if conn.dialect.name != 'sqlite' and not inspect(conn).has_table('schema_version'):
+        schema_version.create(conn)
+        conn.execute(insert(schema_version).values(version=0))
+
+
+def _progress(conn, version):
+    """(position, end_position) row of a started backfill, or None"""
+    return conn.execute(
+        select(migration_progress.c.position, migration_progress.c.end_position)
+        .where(migration_progress.c.version == version)
+    ).first()
+
+
+def _save_progress(conn, version, position, end_position=None):
+    conn.execute(delete(migration_progress).where(migration_progress.c.version == version))
+    conn.execute(insert(migration_progress).values(version=version, position=position, end_position=end_position))
+
+
+def _ensure_directory(engine):
+    path = engine.url.database
+    if engine.dialect.name == 'sqlite' and path and path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+
+# --- Migrations ---
+class Migration:
+    """A numbered schema change.
+
+    schema() reruns on every start until the migration is applied, so it
+    must check before it changes anything. Migrations that rewrite existing
+    rows also implement remaining() and backfill(); `progress` is the
+    checkpoint saved after the previous batch, or None.
+    """
+    version = 0
+    name = ''
+
+    def schema(self, conn, database):
+        pass
+
+    def remaining(self, conn, progress):
+        """Rows left to backfill"""
+        return 0
+
+    def backfill(self, conn, progress, batch_size):
+        """Handle the next batch; return (rows done, new position), or None when nothing is left"""
+        return None
+
+    def finish(self, conn, database):
+        """Runs in the transaction that marks the migration applied"""
+
+
+class BaseTables(Migration):
+    """Tables missing from the database, as storage.py defines them"""
+    version = 1
+    name = 'base tables'
+
+    def schema(self, conn, database):
+        if not database.main:
+            storage.shard_metadata.create_all(conn)
+            return
+        storage.metadata.create_all(conn)
+        generation = storage.PreferencesRepository.GENERATION
+        cache_generations = storage.cache_generations
+        if not conn.execute(select(cache_generations.c.name).where(cache_generations.c.name == generation)).first():
+            conn.execute(insert(cache_generations).values(name=generation, generation=0))
+
+
+class ConversationLinks(Migration):
+    """chat_messages.conversation_pk: messages point to conversation rows by integer id.
+
+    Until the backfill links every older message, MessageRepository reads
+    conversations by their text ID; afterwards the old text index is dropped.
+    """
+    version = 2
+    name = 'conversation links'
+    unlinked = chat_messages.c.conversation_pk.is_(None)
+
+    def schema(self, conn, database):
+        columns = {column['name'] for column in inspect(conn).get_columns('chat_messages')}
+        if 'conversation_pk' not in columns:
+            conn.execute(text('ALTER TABLE chat_messages ADD COLUMN conversation_pk INTEGER REFERENCES conversations (id)'))
+        for index in chat_messages.indexes:
+            index.create(conn, checkfirst=True)
+
+    def remaining(self, conn, progress):
+        # NULLs sort first in idx_conversation_messages: an index range count
+        return conn.execute(select(func.count()).select_from(chat_messages).where(self.unlinked)).scalar()
+
+    def backfill(self, conn, progress, batch_size):
+        first = conn.execute(select(func.min(chat_messages.c.id)).where(self.unlinked)).scalar()
+        if first is None:
+            return None
+        last = first + batch_size - 1
+        batch = self.unlinked & chat_messages.c.id.between(first, last)
+
+        conn.execute(storage.insert_ignoring_duplicates(conn, conversations).from_select(
+            ['public_id', 'user_id', 'created_at'],
+            select(chat_messages.c.conversation_id, chat_messages.c.user_id, func.min(chat_messages.c.created_at))
+            .where(batch)
+            .group_by(chat_messages.c.user_id, chat_messages.c.conversation_id)
+        ))
+        linked = conn.execute(
+            update(chat_messages).where(batch).values(conversation_pk=(
+                select(conversations.c.id)
+                .where(conversations.c.user_id == chat_messages.c.user_id,
+                       conversations.c.public_id == chat_messages.c.conversation_id)
+                .scalar_subquery()
+            ))
+        ).rowcount
+        return linked, last
+
+    def finish(self, conn, database):
+        conn.execute(text('DROP INDEX IF EXISTS idx_conversation'))
+
+
+class SearchIndex(Migration):
+    """SQLite FTS5 index mirroring chat_messages.content, kept in sync by triggers.
+
+    user_id is indexed as a second column so a search can intersect the
+    user's own postings with the query terms instead of filtering every
+    match across all users afterwards. Messages saved after the triggers
+    exist are indexed by them; the backfill indexes the older ones, which
+    show up in search results as it goes. The main database gets the index
+    even while messages are sharded, so it is in place if they move back.
+    """
+    version = 3
+    name = 'search index'
+
+    def schema(self, conn, database):
+        if conn.dialect.name != 'sqlite' or has_search_index(conn):
+            return
+        # Writing the checkpoint first opens the write transaction, so no
+        # message can be saved between creating the triggers and reading
+        # the last id the backfill has to cover
+        _save_progress(conn, self.version, 0)
+        try:
+            conn.exec_driver_sql('''
+                CREATE VIRTUAL TABLE chat_messages_fts USING fts5(
+                    content, user_id,
+                    content='chat_messages', content_rowid='id',
+                    prefix='2 3 4'
+                )
+            ''')
+        except OperationalError as e:
+            print(f"⚠️ Full-text search disabled (SQLite without FTS5): {e.orig}")
+            conn.execute(delete(migration_progress).where(migration_progress.c.version == self.version))
+            return
+        conn.exec_driver_sql('''
+            CREATE TRIGGER chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END
+        ''')
+        conn.exec_driver_sql('''
+            CREATE TRIGGER chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+            END
+        ''')
+        conn.exec_driver_sql('''
+            CREATE TRIGGER chat_messages_fts_update AFTER UPDATE OF content, user_id ON chat_messages BEGIN
+                INSERT INTO chat_messages_fts (chat_messages_fts, rowid, content, user_id)
+                VALUES ('delete', old.id, old.content, old.user_id);
+                INSERT INTO chat_messages_fts (rowid, content, user_id) VALUES (new.id, new.content, new.user_id);
+            END
+        ''')
+        last_id = conn.execute(select(func.max(chat_messages.c.id))).scalar() or 0
+        _save_progress(conn, self.version, 0, last_id)
+
+    def remaining(self, conn, progress):
+        if progress is None:
+            return 0
+        return conn.execute(select(func.count()).select_from(chat_messages).where(
+            chat_messages.c.id > progress.position, chat_messages.c.id <= progress.end_position
+        )).scalar()
+
+    def backfill(self, conn, progress, batch_size):
+        if progress is None or progress.position >= progress.end_position:
+            return None
+        last = min(progress.position + batch_size, progress.end_position)
+        indexed = conn.execute(text('''
+            INSERT INTO chat_messages_fts (rowid, content, user_id)
+            SELECT id, content, user_id FROM chat_messages WHERE id > :first AND id <= :last
+        '''), {'first': progress.position, 'last': last}).rowcount
+        return indexed, last
+
+
+MIGRATIONS = [BaseTables(), ConversationLinks(), SearchIndex()]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def has_search_index(conn):
+    return conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'chat_messages_fts'")).first() is not None
+
+
+def search_index_ready(db):
+    """True if every database serving messages has the FTS5 index (possibly still backfilling)"""
+    if not db.messages_on_sqlite:
+        return False
+    for engine in db.message_engines:
+        with engine.connect() as conn:
+            if not has_search_index(conn):
+                return False
+    return True
+
+
+# --- Runner ---
+def _pending(conn):
+    version = get_version(conn)
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def _complete(conn, migration, database):
+    migration.finish(conn, database)
+    conn.execute(delete(migration_progress).where(migration_progress.c.version == migration.version))
+    _set_version(conn, migration.version)
+
+
+def apply_schema(database):
+    """Run the schema step of every pending migration.
+
+    Migrations with nothing to backfill are marked applied right away.
+    Returns [(migration, rows left to backfill)] for the others.
+    """
+    _ensure_directory(database.engine)
+    with database.engine.connect() as conn:
+        pending = _pending(conn)
+    if not pending:
+        return []
+
+    with database.engine.begin() as conn:
+        _create_bookkeeping(conn)
+    for migration in pending:
+        with database.engine.begin() as conn:
+            migration.schema(conn, database)
+
+    left = []
+    with database.engine.begin() as conn:
+        for migration in pending:
+            rows = migration.remaining(conn, _progress(conn, migration.version))
+            if rows or left:  # versions advance in order
+                left.append((migration, rows))
+            else:
+                _complete(conn, migration, database)
+    return left
+
+
+def run_backfills(database, batch_size=1000, through=None):
+    """Run the pending backfills (up to version `through`) in order.
+
+    A generator: each batch is one transaction, after which it yields
+    (migration, rows done) so the caller can pause while the app keeps
+    serving. Each migration is marked applied when its backfill finishes.
+    Call apply_schema first.
+    """
+    with database.engine.connect() as conn:
+        pending = _pending(conn)
+    for migration in pending:
+        if through is not None and migration.version > through:
+            return
+        while True:
+            with database.engine.begin() as conn:
+                # Touching the checkpoint first takes the write lock, so two
+                # runners take turns instead of both reading the same position
+                conn.execute(update(migration_progress).where(migration_progress.c.version == migration.version)
+                             .values(position=migration_progress.c.position))
+                progress = _progress(conn, migration.version)
+                step = migration.backfill(conn, progress, batch_size)
+                if step is None:
+                    _complete(conn, migration, database)
+                    break
+                done, position = step
+                _save_progress(conn, migration.version, position, progress.end_position if progress else None)
+            yield migration, done
+
+
+def upgrade(db, backfill_below=STARTUP_BACKFILL_ROWS):
+    """Bring every database of a storage.Storage up to date, as far as startup should.
+
+    Schema steps always run. A database's pending backfills also run, without
+    pauses, when fewer than `backfill_below` rows are left in total. Returns
+    [(database, migration, rows left)] for the backfills left to
+    `flask --app app migrate`.
+    """
+    left = []
+    for database in databases(db):
+        pending = apply_schema(database)
+        if pending and sum(rows for _, rows in pending) < backfill_below:
+            for _ in run_backfills(database, batch_size=backfill_below):
+                pass
+            pending = []
+        left += [(database, migration, rows) for migration, rows in pending]
+    return left
+
+
+def _transactional_engine(engine):
+    """An engine whose rolled-back transactions also undo DDL.
+
+    pysqlite only opens a transaction before DML, so DDL would commit on
+    its own; this engine issues BEGIN itself. PostgreSQL DDL is already
+    transactional. Returns None for databases where DDL commits implicitly.
+    """
+    if engine.dialect.name == 'postgresql':
+        return engine
+    if engine.dialect.name != 'sqlite':
+        return None
+    dry_engine = create_engine(engine.url, poolclass=NullPool)
+
+    @event.listens_for(dry_engine, 'connect')
+    def _autocommit_driver(dbapi_connection, _):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(dry_engine, 'begin')
+    def _begin(conn):
+        conn.exec_driver_sql('BEGIN')
+
+    return dry_engine
+
+
+def estimate(database, batch_size=1000, pause=0.0):
+    """Dry run: apply the pending migrations in a transaction that is rolled back.
+
+    Times each schema step and DRY_RUN_BATCHES sample backfill batches, and
+    extrapolates the backfill to the rows left, with `pause` seconds between
+    batches. The sample holds the locks a real batch would while it runs.
+    Returns (version, [(migration, schema seconds, rows to backfill,
+    estimated backfill seconds)]); timings are None where DDL is not
+    transactional and nothing could be tried.
+    """
+    _ensure_directory(database.engine)
+    with database.engine.connect() as conn:
+        version = get_version(conn)
+    pending = [migration for migration in MIGRATIONS if migration.version > version]
+    engine = _transactional_engine(database.engine)
+    if engine is None or not pending:
+        return version, [(migration, None, None, None) for migration in pending]
+
+    results = []
+    try:
+        with engine.connect() as conn:
+            transaction = conn.begin()
+            try:
+                _create_bookkeeping(conn)
+                for migration in pending:
+                    start = time.perf_counter()
+                    migration.schema(conn, database)
+                    schema_seconds = time.perf_counter() - start
+
+                    progress = _progress(conn, migration.version)
+                    rows = migration.remaining(conn, progress)
+                    sample_rows, sample_seconds = 0, 0.0
+                    for _ in range(DRY_RUN_BATCHES if rows else 0):
+                        start = time.perf_counter()
+                        step = migration.backfill(conn, progress, batch_size)
+                        if step is None:
+                            break
+                        done, position = step
+                        _save_progress(conn, migration.version, position, progress.end_position if progress else None)
+                        sample_seconds += time.perf_counter() - start
+                        sample_rows += done
+                        progress = _progress(conn, migration.version)
+                    backfill_seconds = (rows / sample_rows * sample_seconds + math.ceil(rows / batch_size) * pause
+                                        if sample_rows else 0.0)
+                    results.append((migration, schema_seconds, rows, backfill_seconds))
+            finally:
+                transaction.rollback()
+    finally:
+        if engine is not database.engine:
+            engine.dispose()
+    return version, results
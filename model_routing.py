@@ -0,0 +1,178 @@
+"""Model tier and output budget per chat turn.
+
+Every turn used to go to one model with a 200-token output limit. Here each
+message gets a complexity score from its length, extra questions, requests
+for detail and the size of the history sent with it:
+
+    score = words + EXTRA_QUESTION x (questions - 1) + DETAIL x (asks for detail)
+            + history characters / HISTORY_CHARS
+
+and the first tier whose max_score it stays under picks the model and the
+output-token budget. The budget is then scaled for the voice style (calm and
+playful replies are shorter) and capped when the client is in voice mode,
+where a long reply is a long wait before it is spoken.
+
+Everything is configurable: set MODEL_ROUTING_CONFIG to a JSON file whose
+keys override DEFAULT_POLICY (tiers are merged by name), or MODEL_ROUTING=0
+to send every turn to the standard tier as before. Calls, failures,
+latency, tokens and an estimated cost are counted per tier for /metrics.
+"""
+import json
+import os
+import re
+import threading
+
+MODEL_ROUTING_ENABLED = os.getenv('MODEL_ROUTING', '1') != '0'
+MODEL_ROUTING_CONFIG = os.getenv('MODEL_ROUTING_CONFIG')
+DEFAULT_TIER = 'standard'
+
+# Tiers are tried in order; prices are USD per million tokens, for the cost estimate
+DEFAULT_POLICY = {
+    'tiers': {
+        'light': {'model': 'gemini-2.0-flash-lite', 'max_output_tokens': 100, 'max_score': 10,
+                  'input_usd_per_mtok': 0.075, 'output_usd_per_mtok': 0.30},
+        'standard': {'model': 'gemini-2.0-flash', 'max_output_tokens': 200, 'max_score': 40,
+                     'input_usd_per_mtok': 0.10, 'output_usd_per_mtok': 0.40},
+        'deep': {'model': 'gemini-2.0-flash', 'max_output_tokens': 500, 'max_score': None,
+                 'input_usd_per_mtok': 0.10, 'output_usd_per_mtok': 0.40},
+    },
+    'legacy_model': 'gemini-pro',       # the google.generativeai SDK only gets the budget
+    'weights': {'extra_question': 12, 'detail': 15, 'history_chars': 400},
+    'style_budget': {'calm': 0.8, 'playful': 0.9},
+    'voice_max_output_tokens': 160,
+    'min_output_tokens': 48,
+}
+
+MODES = ('text', 'voice')
+CHARS_PER_TOKEN = 4                 # rough estimate when the response reports no usage
+
+_WORD = re.compile(r"\w+(?:'\w+)?")
+_DETAIL = re.compile(
+    r"\b(explain|describe|compare|difference between|step by step|steps|pros and cons|in detail"
+    r"|walk me through|summari[sz]e|list|why does|how does|how do i|how can i)\b"
+)
+
+
+def load_policy(path=MODEL_ROUTING_CONFIG):
+    """DEFAULT_POLICY with the overrides from a JSON file, if one is configured"""
+    policy = {key: (dict(value) if isinstance(value, dict) else value) for key, value in DEFAULT_POLICY.items()}
+    policy['tiers'] = {name: dict(tier) for name, tier in DEFAULT_POLICY['tiers'].items()}
+    if not path:
+        return policy
+    with open(path, encoding='utf-8') as f:
+        overrides = json.load(f)
+    for key, value in overrides.items():
+        if key == 'tiers':
+            for name, tier in value.items():
+                if tier is None:
+                    policy['tiers'].pop(name, None)
+                else:
+                    policy['tiers'][name] = {**policy['tiers'].get(name, {}), **tier}
+        elif isinstance(value, dict) and isinstance(policy.get(key), dict):
+            policy[key].update(value)
+        else:
+            policy[key] = value
+    return policy
+
+
+class Route:
+    __slots__ = ('tier', 'model', 'legacy_model', 'max_output_tokens', 'score')
+
+    def __init__(self, tier, model, legacy_model, max_output_tokens, score):
+        self.tier = tier
+        self.model = model
+        self.legacy_model = legacy_model
+        self.max_output_tokens = max_output_tokens
+        self.score = score
+
+
+class ModelRouter:
+    """Chooses a tier per turn and keeps per-tier latency, token and cost totals"""
+
+    def __init__(self, policy=None, enabled=MODEL_ROUTING_ENABLED):
+        self.policy = policy or load_policy()
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {name: {'calls': 0, 'errors': 0, 'seconds': 0.0, 'budget_tokens': 0,
+                              'input_tokens': 0, 'output_tokens': 0, 'cost_usd': 0.0}
+                       for name in self.policy['tiers']}
+
+    def score(self, message, history=()):
+        """Complexity of one turn; higher needs a bigger model and budget"""
+        weights = self.policy['weights']
+        text = message.lower()
+        score = len(_WORD.findall(text))
+        score += weights['extra_question'] * max(text.count('?') - 1, 0)
+        if _DETAIL.search(text):
+            score += weights['detail']
+        history_chars = sum(len(msg['content']) for msg in history)
+        return score + history_chars / weights['history_chars']
+
+    def choose(self, message, history=(), voice_style='natural', mode='text'):
+        tiers = self.policy['tiers']
+        score = self.score(message, history)
+        name = DEFAULT_TIER if DEFAULT_TIER in tiers else next(iter(tiers))
+        if self.enabled:
+            for name, tier in tiers.items():
+                if tier.get('max_score') is None or score < tier['max_score']:
+                    break
+
+        tier = tiers[name]
+        budget = tier['max_output_tokens']
+        if self.enabled:
+            budget = budget * self.policy['style_budget'].get(voice_style, 1.0)
+            if mode == 'voice':
+                budget = min(budget, self.policy['voice_max_output_tokens'])
+            budget = max(int(budget), self.policy['min_output_tokens'])
+        return Route(name, tier['model'], tier.get('legacy_model', self.policy['legacy_model']), budget, score)
+
+    def record(self, route, seconds, response=None, prompt_chars=0, error=False):
+        """One upstream call on route's tier; tokens come from the response's usage metadata"""
+        usage = getattr(response, 'usage_metadata', None)
+        input_tokens = getattr(usage, 'prompt_token_count', None) or prompt_chars // CHARS_PER_TOKEN
+        output_tokens = getattr(usage, 'candidates_token_count', None)
+        if output_tokens is None:
+            output_tokens = len(getattr(response, 'text', None) or '') // CHARS_PER_TOKEN
+        tier = self.policy['tiers'][route.tier]
+        cost = (input_tokens * tier.get('input_usd_per_mtok', 0.0)
+                + output_tokens * tier.get('output_usd_per_mtok', 0.0)) / 1e6
+        with self._lock:
+            stats = self._stats[route.tier]
+            stats['calls'] += 1
+            stats['seconds'] += seconds
+            stats['budget_tokens'] += route.max_output_tokens
+            if error:
+                stats['errors'] += 1
+                return
+            stats['input_tokens'] += input_tokens
+            stats['output_tokens'] += output_tokens
+            stats['cost_usd'] += cost
+
+    def stats(self):
+        with self._lock:
+            tiers = {}
+            for name, stats in self._stats.items():
+                calls, ok = stats['calls'], stats['calls'] - stats['errors']
+                tiers[name] = {
+                    'model': self.policy['tiers'][name]['model'],
+                    'calls': calls,
+                    'errors': stats['errors'],
+                    'mean_latency_ms': round(1000 * stats['seconds'] / calls, 1) if calls else None,
+                    'mean_budget_tokens': round(stats['budget_tokens'] / calls) if calls else None,
+                    'mean_output_tokens': round(stats['output_tokens'] / ok, 1) if ok else None,
+                    'input_tokens': stats['input_tokens'],
+                    'output_tokens': stats['output_tokens'],
+                    'cost_usd': round(stats['cost_usd'], 6),
+                }
+            return {'enabled': self.enabled, 'tiers': tiers}
+
+
+_router = None
+
+
+def get_router():
+    """Per-process router (its counters are per worker, like /metrics)"""
+    global _router
+    if _router is None:
+        _router = ModelRouter()
+    return _router
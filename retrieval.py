@@ -0,0 +1,270 @@
+"""Offline replies retrieved from past conversations.
+
+When Gemini can't answer, the assistant looks for a past user message like
+the new one and reuses the reply that followed it. Every (user message ->
+next assistant reply) pair in chat_messages is indexed as a hashed word
+unigram and bigram vector (sublinear TF, L2-normalized, FEATURE_BITS
+buckets) in scipy sparse matrices. A query is weighted by IDF from the live
+document frequencies and scored against the postings of its terms only; the
+best pair with the same voice style (and, by default, the same user) wins if
+it reaches RETRIEVAL_MIN_SCORE, otherwise the caller uses its canned lines.
+
+The index catches up on new messages by id, at most every RETRIEVAL_POLL
+seconds when queried, so turns saved by any worker are picked up. New pairs
+land in small segments that are merged as they grow (like an LSM tree): an
+insert never rewrites the whole index and a query scans a few matrices.
+Reply texts stay in the database; the index holds message ids.
+
+numpy and scipy are imported when the index is first built.
+"""
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+
+RETRIEVAL_ENABLED = os.getenv('RETRIEVAL', '1') != '0'
+RETRIEVAL_MIN_SCORE = float(os.getenv('RETRIEVAL_MIN_SCORE', 0.6))
+# 'user' only reuses replies from the asking user's own conversations; 'all'
+# shares them across users, which can repeat one user's details to another
+RETRIEVAL_SCOPE = os.getenv('RETRIEVAL_SCOPE', 'user')
+RETRIEVAL_POLL = 2.0            # seconds between catch-ups with the database
+FEATURE_BITS = 18               # 262,144 hashed unigram/bigram buckets
+SEGMENT_MIN_PAIRS = 1024        # pending pairs are flushed into a segment at this size (or on query)
+MAX_DF = 0.05                   # terms in more than this share of pairs are skipped when a query has rarer ones
+CATCH_UP_CHUNK_ROWS = 10_000
+
+_WORD = re.compile(r"[a-z0-9']+")
+_MASK = (1 << FEATURE_BITS) - 1
+
+
+def features(text):
+    """(bucket numbers, counts) of the hashed unigrams and bigrams of text"""
+    words = _WORD.findall(text.lower())
+    counts = Counter(zlib.crc32(gram.encode()) & _MASK
+                     for gram in words + [f"{a} {b}" for a, b in zip(words, words[1:])])
+    return list(counts), list(counts.values())
+
+
+class Segment:
+    """Immutable block of pairs: a CSC matrix of pairs x the buckets they use, and per-pair columns"""
+
+    def __init__(self, buckets, matrix, sources, reply_ids, users, styles):
+        self.buckets = buckets      # sorted global bucket of each matrix column
+        self.matrix = matrix
+        self.sources = sources      # index of the message repository holding the reply
+        self.reply_ids = reply_ids
+        self.users = users
+        self.styles = styles
+
+    def __len__(self):
+        return len(self.reply_ids)
+
+    @classmethod
+    def _from_entries(cls, rows, buckets, data, pairs, *columns):
+        import numpy as np
+        from scipy import sparse
+        used, local = np.unique(buckets, return_inverse=True)
+        matrix = sparse.csc_matrix((data, (rows, local)), shape=(pairs, len(used)))
+        return cls(used, matrix, *columns)
+
+    @classmethod
+    def build(cls, pairs):
+        """From pending (buckets, weights, source, reply_id, user_id, style) tuples"""
+        import numpy as np
+        lengths = np.fromiter((len(pair[0]) for pair in pairs), dtype=np.int64, count=len(pairs))
+        rows = np.repeat(np.arange(len(pairs)), lengths)
+        buckets = np.fromiter((bucket for pair in pairs for bucket in pair[0]), dtype=np.int64, count=len(rows))
+        data = np.fromiter((weight for pair in pairs for weight in pair[1]), dtype=np.float32, count=len(rows))
+        columns = list(zip(*(pair[2:] for pair in pairs)))
+        return cls._from_entries(rows, buckets, data, len(pairs),
+                                 np.array(columns[0], dtype=np.int8), np.array(columns[1], dtype=np.int64),
+                                 np.array(columns[2], dtype=np.int64), np.array(columns[3], dtype=np.int8))
+
+    def merge(self, other):
+        import numpy as np
+        first, second = self.matrix.tocoo(), other.matrix.tocoo()
+        return Segment._from_entries(
+            np.concatenate([first.row, second.row + len(self)]),
+            np.concatenate([self.buckets[first.col], other.buckets[second.col]]),
+            np.concatenate([first.data, second.data]),
+            len(self) + len(other),
+            *(np.concatenate([a, b]) for a, b in zip(
+                (self.sources, self.reply_ids, self.users, self.styles),
+                (other.sources, other.reply_ids, other.users, other.styles))))
+
+    def best(self, buckets, weights, style, user_id):
+        """(score, position) of the best allowed pair using any of buckets, or None"""
+        import numpy as np
+        columns = np.searchsorted(self.buckets, buckets)
+        present = columns < len(self.buckets)
+        present[present] = self.buckets[columns[present]] == buckets[present]
+        if not present.any():
+            return None
+        indptr, indices, data = self.matrix.indptr, self.matrix.indices, self.matrix.data
+        spans = [(indptr[column], indptr[column + 1], weight)
+                 for column, weight in zip(columns[present], weights[present])]
+        pairs = np.concatenate([indices[start:end] for start, end, _ in spans])
+        scores = np.concatenate([data[start:end] * weight for start, end, weight in spans])
+        candidates, inverse = np.unique(pairs, return_inverse=True)
+        scores = np.bincount(inverse, weights=scores)
+        allowed = self.styles[candidates] == style
+        if user_id is not None:
+            allowed &= self.users[candidates] == user_id
+        if not allowed.any():
+            return None
+        scores[~allowed] = -1.0
+        best = int(scores.argmax())
+        return float(scores[best]), int(candidates[best])
+
+
+class ReplyIndex:
+    """Nearest-neighbour index over (user message -> assistant reply) pairs"""
+
+    def __init__(self, repositories, exclude=(), min_score=RETRIEVAL_MIN_SCORE, scope=RETRIEVAL_SCOPE):
+        self.repositories = repositories
+        self.exclude = frozenset(exclude)   # canned replies, not worth retrieving
+        self.min_score = min_score
+        self.scope = scope
+        self.ready = threading.Event()
+        self.segments = []
+        self.pairs = 0
+        self._pending = []
+        self._df = None
+        self._styles = {}
+        self._last_ids = [0] * len(repositories)
+        self._open = {}                     # (source, user_id, conversation_id) -> user message awaiting its reply
+        self._next_poll = 0.0
+        self._lock = threading.Lock()       # segments, pending pairs and document frequencies
+        self._catch_up_lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Build the index from the whole history in a background thread (once)"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        threading.Thread(target=self._build, name='reply-index', daemon=True).start()
+
+    def _build(self):
+        try:
+            started = time.perf_counter()
+            self.catch_up()
+            print(f"✅ Reply index: {self.pairs:,} pairs in {time.perf_counter() - started:.1f}s")
+        except Exception as e:
+            print(f"⚠️ Reply index build failed: {e}")
+            self._started = False
+            return
+        self.ready.set()
+
+    def catch_up(self):
+        """Index the pairs completed by messages saved since the last catch-up"""
+        with self._catch_up_lock:
+            self._next_poll = time.monotonic() + RETRIEVAL_POLL
+            for source, repository in enumerate(self.repositories):
+                for rows in repository.iter_since(self._last_ids[source], CATCH_UP_CHUNK_ROWS):
+                    self._add_rows(source, rows)
+                    self._last_ids[source] = rows[-1][0]
+            with self._lock:
+                self._flush()
+
+    def _add_rows(self, source, rows):
+        pairs = []
+        for message_id, user_id, conversation_id, role, content, voice_style in rows:
+            key = (source, user_id, conversation_id)
+            if role == 'user':
+                self._open[key] = content
+                continue
+            question = self._open.pop(key, None)
+            if question is None or content in self.exclude:
+                continue
+            buckets, counts = features(question)
+            if buckets:
+                pairs.append((buckets, counts, source, message_id, user_id, voice_style))
+        if not pairs:
+            return
+
+        import numpy as np
+        with self._lock:
+            if self._df is None:
+                self._df = np.zeros(1 << FEATURE_BITS, dtype=np.int32)
+            for buckets, counts, source, message_id, user_id, voice_style in pairs:
+                self._df[buckets] += 1
+                style = self._styles.setdefault(voice_style, len(self._styles))
+                weights = [1.0 + math.log(count) for count in counts]
+                norm = math.sqrt(sum(weight * weight for weight in weights))
+                self._pending.append((buckets, [weight / norm for weight in weights],
+                                      source, message_id, user_id, style))
+            self.pairs += len(pairs)
+            if len(self._pending) >= SEGMENT_MIN_PAIRS:
+                self._flush()
+
+    def _flush(self):
+        """Turn pending pairs into a segment, merging segments of similar size (holds _lock)"""
+        if not self._pending:
+            return
+        segments = self.segments + [Segment.build(self._pending)]
+        self._pending = []
+        while len(segments) > 1 and len(segments[-2]) <= 2 * len(segments[-1]):
+            segments[-2:] = [segments[-2].merge(segments[-1])]
+        self.segments = segments
+
+    def search(self, text, voice_style, user_id=None):
+        """(score, repository index, reply message id) of the closest past pair, or None"""
+        import numpy as np
+        buckets, counts = features(text)
+        with self._lock:
+            style = self._styles.get(voice_style)
+            if style is None or not buckets:
+                return None
+            if self._pending:
+                self._flush()
+            segments, pairs = self.segments, self.pairs
+            df = self._df[buckets]
+
+        # IDF weights over every query term, but rare terms are enough to find candidates
+        buckets = np.array(buckets)
+        weights = (1.0 + np.log(counts)) * (np.log((1 + pairs) / (1 + df)) + 1.0)
+        weights /= np.linalg.norm(weights)
+        searched = (df > 0) & (df <= MAX_DF * pairs)
+        if not searched.any():
+            searched = df > 0
+        buckets, weights = buckets[searched], weights[searched]
+
+        scope_user = user_id if self.scope == 'user' else None
+        best = None
+        for segment in segments:
+            found = segment.best(buckets, weights, style, scope_user)
+            if found is not None and (best is None or found[0] > best[0]):
+                best = (found[0], int(segment.sources[found[1]]), int(segment.reply_ids[found[1]]))
+        return best
+
+    def reply(self, text, voice_style, user_id):
+        """Text of the reply to the closest past message, if one is close enough"""
+        if not self.ready.is_set() or (self.scope == 'user' and user_id is None):
+            return None
+        if time.monotonic() >= self._next_poll:
+            self.catch_up()
+        found = self.search(text, voice_style, user_id)
+        if found is None or found[0] < self.min_score:
+            return None
+        _, source, reply_id = found
+        return self.repositories[source].content(reply_id)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(storage, exclude=()):
+    """Per-process index over storage's messages"""
+    index = _indexes.get(storage)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(storage)
+            if index is None:
+                index = _indexes[storage] = ReplyIndex(storage.message_repositories, exclude)
+    return index
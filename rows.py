@@ -0,0 +1,26 @@
+"""Result rows kept as tuples until they are encoded.
+
+Shared by storage.py, which returns them, and json_provider.py, which
+encodes them, without the encoder importing the database layer.
+"""
+from itertools import repeat
+
+
+class Rows:
+    """Result rows (tuples) with their column names.
+
+    Large results are returned this way instead of as a dict per row; the
+    JSON provider encodes them as an array of {column: value} objects.
+    """
+    __slots__ = ('columns', 'rows')
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        """The rows as {column: value} dicts"""
+        return map(dict, map(zip, repeat(self.columns), self.rows))
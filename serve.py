@@ -0,0 +1,226 @@
+"""Production launcher for Aiko (gunicorn, multi-process, threaded workers).
+
+Usage:
+    python serve.py             # start the server in the foreground
+    python serve.py reload      # graceful rolling reload (new code, no dropped requests)
+    python serve.py stop        # graceful shutdown
+
+Settings are read from the environment:
+    PORT              port to bind (default 5000)
+    WEB_CONCURRENCY   worker processes (default: one per available core)
+    THREADS           threads per worker (default 4)
+    GRACEFUL_TIMEOUT  seconds in-flight requests get to finish on reload/stop (default 30)
+    MAX_REQUESTS      recycle a worker after this many requests, 0 to disable (default 0)
+    PIDFILE           master pid file (default aiko.pid)
+
+The app is loaded once in the master (preload), which builds the shared
+read-only state before forking so workers share those pages copy-on-write.
+Each worker then starts its own TTS warm-up; /ready returns 503 until that
+worker is warm. Once warm, each worker also writes a marker file named after
+its master and its own pid into <pidfile>.ready/, which is how a reload
+knows the new generation is up: /ready on the shared socket may be answered
+by an old worker.
+"""
+import glob
+import itertools
+import os
+import signal
+import sys
+import threading
+import time
+
+RELOAD_TIMEOUT = 120
+READY_POLL = 0.5
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+
+def _ready_marker(pidfile, master_pid, worker_pid):
+    return os.path.join(f"{pidfile}.ready", f"{master_pid}.{worker_pid}")
+
+
+def _mark_when_ready(app, marker):
+    while not app.is_ready():
+        time.sleep(READY_POLL)
+    os.makedirs(os.path.dirname(marker), exist_ok=True)
+    with open(marker, 'w'):
+        pass
+
+
+def _pre_fork(server, worker):
+    # Runs in the master: the lowest quota slot no live worker holds, so the
+    # workers' shares of each API key never add up to more than the key's quota
+    taken = {getattr(other, 'quota_slot', None) for other in server.WORKERS.values()}
+    worker.quota_slot = next(slot for slot in itertools.count() if slot not in taken)
+
+
+def _post_fork(server, worker):
+    # Per-worker startup: database check is a no-op after preload; TTS warms up here
+    import app
+    # Each worker tracks Gemini key usage on its own, so it gets its share of the quotas
+    app.key_pool.get_key_pool().split(server.cfg.workers, worker.quota_slot)
+    app.startup()
+    marker = _ready_marker(server.cfg.pidfile, server.pid, worker.pid)
+    threading.Thread(target=_mark_when_ready, args=(app, marker), name='ready-marker', daemon=True).start()
+
+
+def _child_exit(server, worker):
+    # Runs in the master, so a worker that was killed loses its marker too
+    try:
+        os.remove(_ready_marker(server.cfg.pidfile, server.pid, worker.pid))
+    except OSError:
+        pass
+
+
+def server_options():
+    port = int(os.environ.get('PORT', 5000))
+    max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+    return {
+        'bind': f"0.0.0.0:{port}",
+        'workers': int(os.environ.get('WEB_CONCURRENCY', available_cores())),
+        'threads': int(os.environ.get('THREADS', 4)),
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'graceful_timeout': int(os.environ.get('GRACEFUL_TIMEOUT', 30)),
+        'timeout': 120,
+        'keepalive': 5,
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'pidfile': os.environ.get('PIDFILE', 'aiko.pid'),
+        'accesslog': '-',
+        'pre_fork': _pre_fork,
+        'post_fork': _post_fork,
+        'child_exit': _child_exit,
+    }
+
+
+def run():
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn is POSIX-only; keep Windows/dev setups working without the reloader
+        print("⚠️ gunicorn not installed, falling back to a single threaded process")
+        import app
+        port = int(os.environ.get('PORT', 5000))
+        app.create_app().run(host='0.0.0.0', port=port, threaded=True)
+        return
+
+    class AikoServer(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import app
+            app.preload_shared_state()
+            return app.app
+
+    options = server_options()
+    print(f"🚀 Starting {options['workers']} workers x {options['threads']} threads on {options['bind']}")
+    AikoServer(options).run()
+
+
+# --- Process control ---
+def _read_pid(pidfile):
+    try:
+        with open(pidfile) as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def _ready_workers(pidfile, master_pid):
+    """Pids of master_pid's workers that have written their ready marker"""
+    return {os.path.basename(path).split('.', 1)[1]
+            for path in glob.glob(_ready_marker(pidfile, master_pid, '*'))}
+
+
+def _wait_ready(pidfile, master_pid, workers, deadline):
+    """Wait until `workers` workers of master_pid (the new generation) are warm"""
+    while time.time() < deadline:
+        if len(_ready_workers(pidfile, master_pid)) >= workers:
+            return True
+        time.sleep(READY_POLL)
+    return False
+
+
+def _clear_ready(pidfile, master_pid):
+    for path in glob.glob(_ready_marker(pidfile, master_pid, '*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def reload():
+    """Rolling reload: boot a new master with fresh code, then retire the old one.
+
+    USR2 starts a new master (and workers) on the same socket. Only once every
+    new worker has written its ready marker are the old workers told to
+    finish their in-flight requests and exit, so no request is refused during
+    the switch. If the new master or its workers fail to come up, the old
+    one keeps serving.
+    """
+    options = server_options()
+    pidfile = options['pidfile']
+
+    old_pid = _read_pid(pidfile)
+    if old_pid is None:
+        print(f"❌ No running server found ({pidfile})")
+        return 1
+
+    os.kill(old_pid, signal.SIGUSR2)
+    deadline = time.time() + RELOAD_TIMEOUT
+    while time.time() < deadline:
+        # The new master writes "<pidfile>.2" until the old one exits
+        new_pid = _read_pid(pidfile + '.2')
+        if new_pid and new_pid != old_pid:
+            break
+        time.sleep(0.5)
+    else:
+        print("❌ New master did not start; old workers are still serving")
+        return 1
+
+    if not _wait_ready(pidfile, new_pid, options['workers'], deadline):
+        print("❌ New workers never became ready; old workers are still serving")
+        os.kill(new_pid, signal.SIGTERM)
+        _clear_ready(pidfile, new_pid)
+        return 1
+
+    # Graceful shutdown: the old master stops accepting, its workers get up to
+    # GRACEFUL_TIMEOUT to finish in-flight requests, then it exits
+    os.kill(old_pid, signal.SIGTERM)
+    _clear_ready(pidfile, old_pid)
+    print(f"✅ Reloaded: master {old_pid} -> {new_pid}")
+    return 0
+
+
+def stop():
+    pid = _read_pid(server_options()['pidfile'])
+    if pid is None:
+        print("❌ No running server found")
+        return 1
+    os.kill(pid, signal.SIGTERM)
+    print(f"🛑 Stopping master {pid}")
+    return 0
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else 'start'
+    if command == 'start':
+        run()
+    elif command == 'reload':
+        sys.exit(reload())
+    elif command == 'stop':
+        sys.exit(stop())
+    else:
+        print(__doc__)
+        sys.exit(2)
@@ -0,0 +1,751 @@
+"""Storage layer: SQLAlchemy Core tables, a pooled engine and repository classes.
+
+SQLite (chatbot_auth.db) is the default. Setting DATABASE_URL to a server
+database, e.g. postgresql+psycopg2://aiko:secret@db/aiko, moves users,
+sessions, messages and preferences there with no code changes; SQLite-only
+features (the FTS5 search index) are switched off on other databases.
+
+Engines are created once per URL and process. Connections come from a
+QueuePool sized by DB_POOL_SIZE / DB_MAX_OVERFLOW, and forked workers drop
+the pool they inherited so no connection is shared across processes.
+
+Chat messages can optionally be split across several SQLite files (shards),
+each in WAL mode with its own write lock, so users' writes stop contending
+on one database lock. A user's messages always live in the shard picked by
+shard_index(); users, sessions and preferences stay in the main database.
+"""
+import glob
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import lru_cache
+
+from sqlalchemy import (
+    Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+    bindparam, cast, create_engine, delete, event, func, insert, or_, select, update,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.pool import QueuePool
+
+from rows import Rows
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800  # server databases drop idle connections
+
+metadata = MetaData()
+
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(255), unique=True, nullable=False),
+    Column('email', String(255), unique=True),
+    Column('password_hash', String(255), nullable=False),
+    Column('created_at', DateTime, server_default=func.current_timestamp()),
+    Column('last_login', DateTime),
+    Column('is_active', Integer, server_default='1'),
+    sqlite_autoincrement=True,
+)
+
+user_sessions = Table(
+    'user_sessions', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), nullable=False),
+    Column('session_token', String(64), unique=True, nullable=False),
+    Column('created_at', DateTime, server_default=func.current_timestamp()),
+    Column('expires_at', DateTime),
+    sqlite_autoincrement=True,
+)
+
+
+def _conversations_table(metadata, user_fk=True):
+    foreign_key = [ForeignKey('users.id')] if user_fk else []
+    return Table(
+        'conversations', metadata,
+        Column('id', Integer, primary_key=True),
+        # External ID: a ULID for new conversations, the old text ID for migrated ones
+        Column('public_id', String(255), nullable=False),
+        Column('user_id', Integer, *foreign_key, nullable=False),
+        Column('created_at', DateTime, server_default=func.current_timestamp()),
+        UniqueConstraint('user_id', 'public_id', name='uq_user_conversation'),
+        sqlite_autoincrement=True,
+    )
+
+
+def _chat_messages_table(metadata, user_fk=True):
+    foreign_key = [ForeignKey('users.id')] if user_fk else []
+    return Table(
+        'chat_messages', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, *foreign_key, nullable=False),
+        Column('conversation_id', String(255), nullable=False),  # conversations.public_id
+        Column('conversation_pk', Integer, ForeignKey('conversations.id')),  # NULL until backfilled
+        Column('role', String(16), nullable=False),  # 'user' or 'assistant'
+        Column('content', Text, nullable=False),
+        Column('voice_style', String(32), server_default='natural'),
+        Column('emotion', String(32), server_default='neutral'),
+        Column('created_at', DateTime, server_default=func.current_timestamp()),
+        Index('idx_user_messages', 'user_id', 'created_at'),
+        # Covers conversation reads in id order; SQLite stores id (the rowid) in it for free
+        Index('idx_conversation_messages', 'conversation_pk', 'id'),
+        sqlite_autoincrement=True,
+    )
+
+
+conversations = _conversations_table(metadata)
+chat_messages = _chat_messages_table(metadata)
+
+# Message shards hold only conversations and chat_messages (no users table to reference)
+shard_metadata = MetaData()
+_conversations_table(shard_metadata, user_fk=False)
+_chat_messages_table(shard_metadata, user_fk=False)
+
+user_preferences = Table(
+    'user_preferences', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id'), unique=True, nullable=False),
+    Column('voice_style', String(32), server_default='natural'),
+    Column('theme', String(32), server_default='light'),
+    Column('auto_play_voice', Integer, server_default='1'),
+    Column('speech_rate', Float, server_default='1.0'),
+    Column('speech_pitch', Float, server_default='1.0'),
+    Column('conversation_style', String(32), server_default='casual'),
+    Column('use_fillers', Integer, server_default='1'),
+    Column('use_pauses', Integer, server_default='1'),
+    Column('created_at', DateTime, server_default=func.current_timestamp()),
+    Column('updated_at', DateTime, server_default=func.current_timestamp()),
+    sqlite_autoincrement=True,
+)
+
+# Generation counters used to invalidate per-process caches
+cache_generations = Table(
+    'cache_generations', metadata,
+    Column('name', String(64), primary_key=True),
+    Column('generation', Integer, nullable=False, server_default='0'),
+)
+
+PREFERENCE_FIELDS = ('voice_style', 'theme', 'auto_play_voice', 'speech_rate', 'speech_pitch',
+                     'conversation_style', 'use_fillers', 'use_pauses')
+
+
+_CROCKFORD_BASE32 = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+
+def new_ulid():
+    """26-character ULID: millisecond timestamp then 80 random bits, so IDs sort by creation time"""
+    value = (time.time_ns() // 1_000_000) << 80 | int.from_bytes(os.urandom(10), 'big')
+    return ''.join(_CROCKFORD_BASE32[(value >> shift) & 31] for shift in range(125, -1, -5))
+
+
+def insert_ignoring_duplicates(bind, table):
+    """INSERT that skips rows violating a unique constraint (where the dialect can)"""
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(bind.dialect.name)
+    if dialect is None:
+        return insert(table)
+    return dialect.insert(table).on_conflict_do_nothing()
+
+
+def _plain(row):
+    """Row as a dict, with datetimes in the 'YYYY-MM-DD HH:MM:SS' form SQLite returns"""
+    return {key: str(value) if isinstance(value, datetime) else value for key, value in row._mapping.items()}
+
+
+def _text_columns(table, names):
+    """Columns by name, timestamps cast to text in SQL so rows need no per-value conversion"""
+    return [cast(table.c[name], String).label(name) if isinstance(table.c[name].type, DateTime) else table.c[name]
+            for name in names]
+
+
+# --- Engine ---
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def _dispose_after_fork():
+    # Pooled connections (and the pool's lock) belong to the parent process
+    for engine in list(_engines.values()):
+        engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_after_fork)
+
+
+def _enable_wal(dbapi_connection, _):
+    dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+
+def get_engine(url, wal=False):
+    """Shared engine for url, created on first use (wal: SQLite WAL journal)"""
+    engine = _engines.get(url)
+    if engine is not None:
+        return engine
+
+    with _engines_lock:
+        engine = _engines.get(url)
+        if engine is None:
+            options = {
+                'poolclass': QueuePool,
+                'pool_size': DB_POOL_SIZE,
+                'max_overflow': DB_MAX_OVERFLOW,
+                'pool_timeout': DB_POOL_TIMEOUT,
+            }
+            if url.startswith('sqlite'):
+                # Pooled connections move between request threads
+                options['connect_args'] = {'check_same_thread': False}
+            else:
+                options['pool_pre_ping'] = True
+                options['pool_recycle'] = DB_POOL_RECYCLE
+            engine = create_engine(url, **options)
+            if wal and engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', _enable_wal)
+            _engines[url] = engine
+    return engine
+
+
+# --- Repositories ---
+class Repository:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def connect(self, conn=None):
+        """A pooled connection, or `conn` to read inside the caller's transaction (see Storage.read_transaction)"""
+        return nullcontext(conn) if conn is not None else self.engine.connect()
+
+
+class UserRepository(Repository):
+    def create(self, username, email, password_hash, defaults):
+        """New user id with default preferences, or None if the name or email is taken"""
+        with self.engine.begin() as conn:
+            taken = conn.execute(
+                select(users.c.id).where(or_(users.c.username == username, users.c.email == email))
+            ).first()
+            if taken:
+                return None
+            user_id = conn.execute(insert(users).values(
+                username=username, email=email, password_hash=password_hash, created_at=datetime.now()
+            )).inserted_primary_key[0]
+            conn.execute(insert(user_preferences).values(user_id=user_id, **defaults))
+        return user_id
+
+    def credentials(self, username):
+        """(id, password_hash) of an active user, or None"""
+        with self.engine.connect() as conn:
+            return conn.execute(
+                select(users.c.id, users.c.password_hash)
+                .where(users.c.username == username, users.c.is_active == 1)
+            ).first()
+
+    def record_login(self, user_id):
+        with self.engine.begin() as conn:
+            conn.execute(update(users).where(users.c.id == user_id).values(last_login=datetime.now()))
+
+    def profile(self, user_id, conn=None):
+        with self.connect(conn) as conn:
+            row = conn.execute(
+                select(users.c.username, users.c.email, users.c.created_at, users.c.last_login)
+                .where(users.c.id == user_id)
+            ).first()
+        return _plain(row) if row else None
+
+    def id_for_username(self, username):
+        with self.engine.connect() as conn:
+            return conn.execute(select(users.c.id).where(users.c.username == username)).scalar()
+
+
+class SessionRepository(Repository):
+    def create(self, user_id, token, expires_at):
+        with self.engine.begin() as conn:
+            conn.execute(insert(user_sessions).values(user_id=user_id, session_token=token, expires_at=expires_at))
+
+    def user_for_token(self, token, now, conn=None):
+        with self.connect(conn) as conn:
+            return conn.execute(
+                select(user_sessions.c.user_id)
+                .where(user_sessions.c.session_token == token, user_sessions.c.expires_at > now)
+            ).scalar()
+
+    def delete(self, token):
+        with self.engine.begin() as conn:
+            conn.execute(delete(user_sessions).where(user_sessions.c.session_token == token))
+
+
+# Per-turn message queries are built once, with bind parameters: constructing
+# and cache-keying a Core statement costs more than running it on SQLite.
+RECENT_COLUMNS = ('role', 'content', 'emotion')
+CONVERSATION_PK_CACHE_SIZE = 4096   # recently used conversations whose ids are cached per repository
+HISTORY_COLUMNS = ('role', 'content', 'voice_style', 'emotion', 'created_at')
+_insert_message = insert(chat_messages)
+
+
+def _conversation_filter(legacy):
+    """Messages of one conversation: by its text ID before backfill, by conversation_pk after"""
+    if legacy:
+        return (chat_messages.c.user_id == bindparam('user_id'),
+                chat_messages.c.conversation_id == bindparam('conversation_id'))
+    return (chat_messages.c.conversation_pk == bindparam('conversation_pk'),)
+
+
+@lru_cache(maxsize=None)
+def _conversation_query(columns, legacy, newest_first=False):
+    # ids increase with insertion, unlike created_at (one-second resolution)
+    order = chat_messages.c.id.desc() if newest_first else chat_messages.c.id
+    return (select(*_text_columns(chat_messages, columns))
+            .where(*_conversation_filter(legacy))
+            .order_by(order)
+            .limit(bindparam('limit')).offset(bindparam('offset')))
+
+
+@lru_cache(maxsize=None)
+def _conversation_count(legacy):
+    return select(func.count()).select_from(chat_messages).where(*_conversation_filter(legacy))
+
+
+class MessageRepository(Repository):
+    LEGACY_RECHECK_SECONDS = 30
+
+    def __init__(self, engine, write_lock=None, cache_size=CONVERSATION_PK_CACHE_SIZE):
+        super().__init__(engine)
+        # Shards serialize this process's writers up front instead of having
+        # them spin on SQLite's busy handler
+        self.write_lock = write_lock or nullcontext()
+        # (user_id, public_id) -> conversations.id (never changes), least recently used first
+        self._conversation_pks = OrderedDict()
+        self._conversation_pks_lock = threading.Lock()
+        self._cache_size = cache_size
+        self._legacy_rows = None
+        self._legacy_checked_at = 0.0
+
+    def clear_cache(self):
+        """Forget cached conversation ids (they change when messages are resharded)"""
+        with self._conversation_pks_lock:
+            self._conversation_pks.clear()
+        self._legacy_rows = None
+
+    def _has_legacy_rows(self, conn):
+        """True while messages saved before the conversations table are not backfilled.
+
+        Until then, reads match conversations by their text ID (still written
+        on every message), which covers old and new rows alike.
+        """
+        if self._legacy_rows is False:
+            return False  # new messages are always linked, so this never flips back
+        now = time.monotonic()
+        if self._legacy_rows is None or now >= self._legacy_checked_at + self.LEGACY_RECHECK_SECONDS:
+            self._legacy_rows = conn.execute(
+                select(chat_messages.c.id).where(chat_messages.c.conversation_pk.is_(None)).limit(1)
+            ).first() is not None
+            self._legacy_checked_at = now
+        return self._legacy_rows
+
+    def _conversation_pk(self, conn, user_id, conversation_id, create=False):
+        key = (user_id, conversation_id)
+        with self._conversation_pks_lock:
+            pk = self._conversation_pks.get(key)
+            if pk is not None:
+                self._conversation_pks.move_to_end(key)
+                return pk
+
+        query = select(conversations.c.id).where(
+            conversations.c.user_id == user_id, conversations.c.public_id == conversation_id
+        )
+        pk = conn.execute(query).scalar()
+        if pk is None and create:
+            # Another writer may create the same conversation concurrently
+            conn.execute(insert_ignoring_duplicates(self.engine, conversations).values(
+                user_id=user_id, public_id=conversation_id, created_at=datetime.now()
+            ))
+            pk = conn.execute(query).scalar()
+        if pk is not None:
+            with self._conversation_pks_lock:
+                self._conversation_pks[key] = pk
+                if len(self._conversation_pks) > self._cache_size:
+                    self._conversation_pks.popitem(last=False)
+        return pk
+
+    def _conversation(self, conn, user_id, conversation_id):
+        """(legacy, bind parameters) for _conversation_filter, or None if the conversation is empty"""
+        if self._has_legacy_rows(conn):
+            return True, {'user_id': user_id, 'conversation_id': conversation_id}
+        pk = self._conversation_pk(conn, user_id, conversation_id)
+        return None if pk is None else (False, {'conversation_pk': pk})
+
+    def add(self, user_id, conversation_id, role, content, voice_style='natural', emotion='neutral'):
+        with self.write_lock, self.engine.begin() as conn:
+            conversation_pk = self._conversation_pk(conn, user_id, conversation_id, create=True)
+            return conn.execute(_insert_message, {
+                'user_id': user_id, 'conversation_id': conversation_id, 'conversation_pk': conversation_pk,
+                'role': role, 'content': content, 'voice_style': voice_style, 'emotion': emotion,
+            }).inserted_primary_key[0]
+
+    def _select(self, columns, user_id, conversation_id, limit, offset=0, newest_first=False, conn=None):
+        with self.connect(conn) as conn:
+            conversation = self._conversation(conn, user_id, conversation_id)
+            if conversation is None:
+                return []
+            legacy, params = conversation
+            return conn.execute(_conversation_query(columns, legacy, newest_first),
+                                {**params, 'limit': limit, 'offset': offset}).all()
+
+    def recent(self, user_id, conversation_id, limit):
+        """The last `limit` messages of a conversation, oldest first"""
+        rows = self._select(RECENT_COLUMNS, user_id, conversation_id, limit, newest_first=True)
+        return [row._asdict() for row in reversed(rows)]
+
+    def latest_page(self, user_id, conversation_id, limit, conn=None):
+        """The last `limit` messages of a conversation for display, oldest first (Rows)"""
+        rows = self._select(HISTORY_COLUMNS, user_id, conversation_id, limit, newest_first=True, conn=conn)
+        return Rows(HISTORY_COLUMNS, rows[::-1])
+
+    def count(self, user_id, conversation_id):
+        with self.engine.connect() as conn:
+            conversation = self._conversation(conn, user_id, conversation_id)
+            if conversation is None:
+                return 0
+            legacy, params = conversation
+            return conn.execute(_conversation_count(legacy), params).scalar()
+
+    def slice(self, user_id, conversation_id, offset, limit):
+        """Messages [offset, offset + limit) of a conversation, oldest first"""
+        return [row._asdict() for row in self._select(RECENT_COLUMNS, user_id, conversation_id, limit, offset)]
+
+    def history(self, user_id, conversation_id, limit):
+        """The first `limit` messages of a conversation, for display (Rows)"""
+        return Rows(HISTORY_COLUMNS, self._select(HISTORY_COLUMNS, user_id, conversation_id, limit))
+
+    def conversations(self, user_id, limit=20, conn=None):
+        """The user's most recently active conversations"""
+        with self.connect(conn) as conn:
+            if self._has_legacy_rows(conn):
+                last_activity = func.max(chat_messages.c.created_at).label('last_activity')
+                query = (select(chat_messages.c.conversation_id, last_activity)
+                         .where(chat_messages.c.user_id == user_id)
+                         .group_by(chat_messages.c.conversation_id)
+                         .order_by(last_activity.desc()))
+            else:
+                # Each conversation's newest message is one probe of idx_conversation_messages
+                messages = chat_messages.alias('messages')
+                last_message = (select(func.max(messages.c.id))
+                                .where(messages.c.conversation_pk == conversations.c.id)
+                                .correlate(conversations)
+                                .scalar_subquery())
+                query = (select(conversations.c.public_id.label('conversation_id'),
+                                chat_messages.c.created_at.label('last_activity'))
+                         .select_from(conversations)
+                         .join(chat_messages, chat_messages.c.id == last_message)
+                         .where(conversations.c.user_id == user_id)
+                         .order_by(chat_messages.c.id.desc()))
+            rows = conn.execute(query.limit(limit)).all()
+        return [_plain(row) for row in rows]
+
+    def iter_chunks(self, user_id, fields, chunk_size):
+        """Yield lists of rows (tuples) for all of a user's messages, oldest first.
+
+        Rows are streamed (a server-side cursor where the driver has one), so
+        only one chunk is held in memory however long the history is.
+        """
+        query = (select(*_text_columns(chat_messages, fields)).where(chat_messages.c.user_id == user_id)
+                 .order_by(chat_messages.c.created_at, chat_messages.c.id))
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+            yield from result.partitions()
+
+    def iter_since(self, after_id, chunk_size):
+        """Yield lists of (id, user_id, conversation_id, role, content, voice_style) rows with id > after_id, in id order"""
+        query = (select(chat_messages.c.id, chat_messages.c.user_id, chat_messages.c.conversation_id,
+                        chat_messages.c.role, chat_messages.c.content, chat_messages.c.voice_style)
+                 .where(chat_messages.c.id > after_id)
+                 .order_by(chat_messages.c.id))
+        with self.engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+            yield from result.partitions()
+
+    def content(self, message_id):
+        with self.engine.connect() as conn:
+            return conn.execute(select(chat_messages.c.content).where(chat_messages.c.id == message_id)).scalar()
+
+
+class PreferencesRepository(Repository):
+    GENERATION = 'preferences'
+
+    def _generation(self, conn):
+        return conn.execute(
+            select(cache_generations.c.generation).where(cache_generations.c.name == self.GENERATION)
+        ).scalar() or 0
+
+    def _select(self, conn, user_id):
+        row = conn.execute(
+            select(*(user_preferences.c[field] for field in PREFERENCE_FIELDS))
+            .where(user_preferences.c.user_id == user_id)
+        ).first()
+        return dict(row._mapping) if row else None
+
+    def generation(self):
+        with self.engine.connect() as conn:
+            return self._generation(conn)
+
+    def get(self, user_id, conn=None):
+        """(generation, prefs dict or None), read together"""
+        with self.connect(conn) as conn:
+            return self._generation(conn), self._select(conn, user_id)
+
+    def update(self, user_id, updates):
+        """Apply updates and bump the generation in one transaction.
+
+        Returns (generation, prefs) as written, or None if the user has no row.
+        """
+        with self.engine.begin() as conn:
+            result = conn.execute(
+                update(user_preferences).where(user_preferences.c.user_id == user_id)
+                .values(**updates, updated_at=datetime.now())
+            )
+            if result.rowcount == 0:
+                return None
+            conn.execute(
+                update(cache_generations).where(cache_generations.c.name == self.GENERATION)
+                .values(generation=cache_generations.c.generation + 1)
+            )
+            return self._generation(conn), self._select(conn, user_id)
+
+
+# --- Message shards ---
+MESSAGE_SHARD_FILE = 'messages_{index:03d}_of_{count:03d}.db'
+_SHARD_FILE_PATTERN = re.compile(r'messages_\d{3}_of_(\d{3})\.db$')
+
+
+def shard_index(user_id, count):
+    """Shard holding user_id's messages; stable across processes and restarts"""
+    return zlib.crc32(str(int(user_id)).encode()) % count
+
+
+def shard_urls(directory, count):
+    return [f"sqlite:///{os.path.join(directory, MESSAGE_SHARD_FILE.format(index=index, count=count))}"
+            for index in range(count)]
+
+
+def shard_counts_on_disk(directory):
+    """Shard counts that have files in directory"""
+    counts = set()
+    for path in glob.glob(os.path.join(directory, 'messages_*_of_*.db')):
+        match = _SHARD_FILE_PATTERN.search(path)
+        if match:
+            counts.add(int(match.group(1)))
+    return counts
+
+
+class ShardedMessageRepository:
+    """MessageRepository interface that routes every call to the user's shard"""
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def shard(self, user_id):
+        return self.shards[shard_index(user_id, len(self.shards))]
+
+    def clear_cache(self):
+        for shard in self.shards:
+            shard.clear_cache()
+
+    def add(self, user_id, *args, **kwargs):
+        return self.shard(user_id).add(user_id, *args, **kwargs)
+
+    def recent(self, user_id, conversation_id, limit):
+        return self.shard(user_id).recent(user_id, conversation_id, limit)
+
+    def count(self, user_id, conversation_id):
+        return self.shard(user_id).count(user_id, conversation_id)
+
+    def slice(self, user_id, conversation_id, offset, limit):
+        return self.shard(user_id).slice(user_id, conversation_id, offset, limit)
+
+    def history(self, user_id, conversation_id, limit):
+        return self.shard(user_id).history(user_id, conversation_id, limit)
+
+    def latest_page(self, user_id, conversation_id, limit, conn=None):
+        return self.shard(user_id).latest_page(user_id, conversation_id, limit, conn)
+
+    def conversations(self, user_id, limit=20, conn=None):
+        return self.shard(user_id).conversations(user_id, limit, conn)
+
+    def iter_chunks(self, user_id, fields, chunk_size):
+        return self.shard(user_id).iter_chunks(user_id, fields, chunk_size)
+
+
+class Storage:
+    """The main database (and any message shards), with a repository per table group"""
+
+    def __init__(self, url, message_urls=()):
+        self.url = url
+        self.engine = get_engine(url)
+        self.users = UserRepository(self.engine)
+        self.sessions = SessionRepository(self.engine)
+        self.preferences = PreferencesRepository(self.engine)
+        if message_urls:
+            self.message_engines = [get_engine(message_url, wal=True) for message_url in message_urls]
+            self.messages = ShardedMessageRepository(
+                [MessageRepository(engine, threading.Lock()) for engine in self.message_engines]
+            )
+            self.message_repositories = self.messages.shards
+        else:
+            self.message_engines = [self.engine]
+            self.messages = MessageRepository(self.engine)
+            self.message_repositories = [self.messages]
+
+    @property
+    def is_sqlite(self):
+        return self.engine.dialect.name == 'sqlite'
+
+    @property
+    def messages_on_sqlite(self):
+        return all(engine.dialect.name == 'sqlite' for engine in self.message_engines)
+
+    def message_engine(self, user_id):
+        """Engine of the database holding user_id's messages"""
+        return self.message_engines[shard_index(user_id, len(self.message_engines))]
+
+    @contextmanager
+    def read_transaction(self, engine=None):
+        """A connection whose reads all see one snapshot of the database.
+
+        pysqlite only opens a transaction before a write, so SQLite gets an
+        explicit BEGIN; server databases read at REPEATABLE READ. Pass the
+        connection as `conn` to repository reads.
+        """
+        engine = engine or self.engine
+        with engine.connect() as conn:
+            if engine.dialect.name == 'sqlite':
+                conn.exec_driver_sql('BEGIN')
+                try:
+                    yield conn
+                finally:
+                    conn.rollback()
+            else:
+                with conn.execution_options(isolation_level='REPEATABLE READ').begin():
+                    yield conn
+
+    def message_reads(self, user_id, conn):
+        """Connection for reading user_id's messages alongside `conn`, a read transaction on the main database.
+
+        Unsharded messages share its snapshot; a shard gets its own read transaction.
+        """
+        engine = self.message_engine(user_id)
+        return nullcontext(conn) if engine is self.engine else self.read_transaction(engine)
+
+    @contextmanager
+    def raw_connection(self, engine=None):
+        """Pooled DB-API connection for database-specific SQL; commits on success"""
+        engine = engine or self.engine
+        is_sqlite = engine.dialect.name == 'sqlite'
+        conn = engine.raw_connection()
+        if is_sqlite:
+            conn.driver_connection.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if is_sqlite:
+                conn.driver_connection.row_factory = None
+            conn.close()  # back to the pool
+
+
+_storages = {}
+
+
+def get_storage(url, message_urls=()):
+    key = (url, tuple(message_urls))
+    storage = _storages.get(key)
+    if storage is None:
+        storage = _storages.setdefault(key, Storage(url, message_urls))
+    return storage
+
+
+# --- Resharding ---
+def _remove_sqlite_files(engine):
+    engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(engine.url.database + suffix):
+            os.remove(engine.url.database + suffix)
+
+
+def reshard(source, target, chunk_size=5000, progress=None):
+    """Move every conversation and message from source's message databases into target's.
+
+    Run with the app stopped. The target schema must already exist and hold
+    no messages. Sources are read in id order, so each user's messages keep
+    their order; ids are reassigned by the target databases. Emptied shard
+    files are deleted (rows in the main database are deleted instead).
+    Returns the number of messages moved.
+    """
+    targets = target.message_engines
+    for engine in targets:
+        with engine.connect() as conn:
+            if conn.execute(select(func.count()).select_from(chat_messages)).scalar():
+                raise ValueError(f"Target database already holds messages: {engine.url}")
+
+    def route(user_id):
+        return shard_index(user_id, len(targets))
+
+    def copy(engine, table, query, convert):
+        """Stream query's rows from engine into the target of each row's user"""
+        copied = 0
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+            for partition in result.partitions():
+                routed = [[] for _ in targets]
+                for row in partition:
+                    routed[route(row.user_id)].append(convert(row))
+                for target_engine, rows in zip(targets, routed):
+                    if rows:
+                        with target_engine.begin() as target_conn:
+                            target_conn.execute(insert(table), rows)
+                copied += len(partition)
+                if progress and table is chat_messages:
+                    progress(moved + copied)
+        return copied
+
+    moved = 0
+    for engine in source.message_engines:
+        # Conversations first; messages then point at the new conversation ids
+        keys = {}  # old conversation id -> (user_id, public_id)
+
+        def conversation(row):
+            keys[row.id] = (row.user_id, row.public_id)
+            return {'public_id': row.public_id, 'user_id': row.user_id, 'created_at': row.created_at}
+
+        copy(engine, conversations, select(conversations).order_by(conversations.c.id), conversation)
+        new_ids = {}
+        for target_engine in targets:
+            with target_engine.connect() as conn:
+                new_ids.update(((row.user_id, row.public_id), row.id) for row in conn.execute(
+                    select(conversations.c.id, conversations.c.user_id, conversations.c.public_id)
+                ))
+
+        def message(row):
+            values = dict(row._mapping)
+            if values['conversation_pk'] is not None:
+                values['conversation_pk'] = new_ids[keys[values['conversation_pk']]]
+            return values
+
+        columns = [column for column in chat_messages.c if column.name != 'id']
+        moved += copy(engine, chat_messages, select(*columns).order_by(chat_messages.c.id), message)
+
+        if engine is source.engine:
+            with engine.begin() as conn:
+                conn.execute(delete(chat_messages))
+                conn.execute(delete(conversations))
+        else:
+            _remove_sqlite_files(engine)
+
+    source.messages.clear_cache()
+    target.messages.clear_cache()
+    return moved
@@ -0,0 +1,74 @@
+"""Shared fixtures for the test suite.
+
+Tests run offline on throwaway SQLite files. Set AIKO_TEST_DATABASE_URL to
+a scratch server database (e.g. postgresql+psycopg2://...) to run the
+database tests against it as well; every table in it is dropped first.
+"""
+import os
+import sys
+
+import pytest
+from sqlalchemy import MetaData
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep every test offline: without a key the assistant uses its local fallback
+os.environ.pop('GEMINI_API_KEY', None)
+os.environ.pop('GEMINI_API_KEYS', None)
+os.environ['RETRIEVAL'] = '0'
+
+import migrations  # noqa: E402
+import storage  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get('AIKO_TEST_DATABASE_URL')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', "slow: builds large fixtures; runs only with AIKO_SLOW_TESTS=1")
+
+
+def _drop_all_tables(url):
+    engine = storage.get_engine(url)
+    existing = MetaData()
+    existing.reflect(engine)
+    existing.drop_all(engine)
+
+
+@pytest.fixture(params=['sqlite', 'server'])
+def main_url(request, tmp_path):
+    """URL of an empty main database: a SQLite file, or AIKO_TEST_DATABASE_URL"""
+    if request.param == 'sqlite':
+        url = f"sqlite:///{tmp_path / 'main.db'}"
+        yield url
+        storage.get_engine(url).dispose()
+        return
+    if not TEST_DATABASE_URL:
+        pytest.skip("AIKO_TEST_DATABASE_URL is not set")
+    _drop_all_tables(TEST_DATABASE_URL)
+    yield TEST_DATABASE_URL
+    storage.get_engine(TEST_DATABASE_URL).dispose()
+
+
+@pytest.fixture
+def db(main_url):
+    """A migrated storage.Storage with messages in the main database"""
+    db = storage.Storage(main_url)
+    migrations.upgrade(db)
+    return db
+
+
+@pytest.fixture
+def app_db(tmp_path, monkeypatch):
+    """The app module on a fresh SQLite database, with its caches emptied"""
+    import app
+    monkeypatch.delenv('DATABASE_URL', raising=False)
+    monkeypatch.setattr(app, 'DATABASE', str(tmp_path / 'chatbot_auth.db'))
+    monkeypatch.setattr(app, 'MESSAGE_SHARDS', 0)
+    monkeypatch.setattr(app, 'MESSAGE_SHARD_DIR', str(tmp_path / 'message_shards'))
+    monkeypatch.setattr(app, '_preferences_cache', {})
+    monkeypatch.setattr(app, '_preferences_generation', None)
+    monkeypatch.setattr(app, '_preferences_next_poll', 0.0)
+    monkeypatch.setattr(app, '_search_stats', {})
+    app.init_db(force=True)
+    yield app
+    app.get_storage().engine.dispose()
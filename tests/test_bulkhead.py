@@ -0,0 +1,122 @@
+import threading
+import time
+
+import pytest
+
+from bulkhead import Bulkhead, Rejected
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+class Caller(threading.Thread):
+    """Takes a slot at `priority` and holds it until released; records its outcome"""
+
+    def __init__(self, bulkhead, priority='text', timeout=5.0):
+        super().__init__(daemon=True)
+        self.bulkhead = bulkhead
+        self.priority = priority
+        self.timeout = timeout
+        self.admitted = threading.Event()
+        self.release = threading.Event()
+        self.outcome = None
+
+    def run(self):
+        try:
+            with self.bulkhead.slot(self.priority, self.timeout):
+                self.outcome = 'admitted'
+                self.admitted.set()
+                self.release.wait(5.0)
+        except Rejected as e:
+            self.outcome = e.reason
+
+    def finish(self):
+        self.release.set()
+        self.join(5.0)
+
+
+def queued(bulkhead, count):
+    wait_until(lambda: bulkhead.stats()['queued'] == count)
+
+
+def test_admits_up_to_the_limit_then_rejects_when_the_queue_is_full():
+    bulkhead = Bulkhead(limit=1, queue_size=0)
+    holder = Caller(bulkhead)
+    holder.start()
+    assert holder.admitted.wait(5.0)
+
+    with pytest.raises(Rejected) as rejected:
+        with bulkhead.slot('voice'):
+            pass
+    assert rejected.value.reason == 'full'
+
+    holder.finish()
+    with bulkhead.slot('text'):
+        assert bulkhead.stats()['in_flight'] == 1
+    assert bulkhead.stats()['in_flight'] == 0
+
+
+def test_queued_call_times_out():
+    bulkhead = Bulkhead(limit=1, queue_size=1)
+    holder = Caller(bulkhead)
+    holder.start()
+    assert holder.admitted.wait(5.0)
+
+    with pytest.raises(Rejected) as rejected:
+        with bulkhead.slot('text', timeout=0.01):
+            pass
+    assert rejected.value.reason == 'timeout'
+    assert bulkhead.stats()['queued'] == 0
+    holder.finish()
+
+
+def test_voice_displaces_queued_background_work():
+    bulkhead = Bulkhead(limit=1, queue_size=1)
+    holder = Caller(bulkhead)
+    holder.start()
+    assert holder.admitted.wait(5.0)
+    background = Caller(bulkhead, 'background')
+    background.start()
+    queued(bulkhead, 1)
+
+    voice = Caller(bulkhead, 'voice')
+    voice.start()
+    background.join(5.0)
+    assert background.outcome == 'displaced'
+
+    # A call no more urgent than the queued one is turned away instead
+    with pytest.raises(Rejected) as rejected:
+        with bulkhead.slot('voice'):
+            pass
+    assert rejected.value.reason == 'full'
+
+    holder.finish()
+    assert voice.admitted.wait(5.0)
+    voice.finish()
+    assert bulkhead.stats()['by_priority']['background']['shed']['displaced'] == 1
+
+
+def test_freed_slot_goes_to_the_most_urgent_waiter():
+    bulkhead = Bulkhead(limit=1, queue_size=3)
+    holder = Caller(bulkhead)
+    holder.start()
+    assert holder.admitted.wait(5.0)
+
+    waiters = [Caller(bulkhead, priority) for priority in ('background', 'text', 'voice')]
+    for count, waiter in enumerate(waiters, 1):
+        waiter.start()
+        queued(bulkhead, count)
+
+    # One slot: each waiter is admitted only once the previous one has finished
+    order = []
+    holder.finish()
+    for _ in waiters:
+        wait_until(lambda: any(waiter.admitted.is_set() and waiter not in order for waiter in waiters))
+        admitted = next(waiter for waiter in waiters if waiter.admitted.is_set() and waiter not in order)
+        order.append(admitted)
+        admitted.finish()
+    assert [waiter.priority for waiter in order] == ['voice', 'text', 'background']
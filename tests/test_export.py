@@ -0,0 +1,96 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tracemalloc
+
+import pytest
+from sqlalchemy import insert
+
+from storage import chat_messages
+
+# Memory is compared between N and EXPORT_SCALE x N messages: bounded memory
+# means ten times the rows needs about the same peak
+EXPORT_ROWS = 1000
+EXPORT_CHUNK_ROWS = 50     # small chunks, so EXPORT_ROWS already spans many of them
+EXPORT_SCALE = 10
+EXPORT_MAX_GROWTH = 1.5
+SLOW_EXPORT_ROWS = 1_000_000
+SLOW_EXPORT_MAX_PEAK = 4 * 1024 * 1024
+
+
+def add_messages(app, user_id, count, batch=10_000):
+    engine = app.get_storage().engine
+    for start in range(0, count, batch):
+        with engine.begin() as conn:
+            conn.execute(insert(chat_messages), [
+                {'user_id': user_id, 'conversation_id': f"conv_{i // 50}",
+                 'role': 'user' if i % 2 == 0 else 'assistant',
+                 'content': f"Message {i}, with \"quotes\", commas and some ünïcode to escape. " * 2}
+                for i in range(start, min(start + batch, count))
+            ])
+
+
+def new_user(app, name):
+    user_id, error = app.create_user(name, f'{name}@example.com', 'a long enough password')
+    assert error is None
+    return user_id
+
+
+def drain(app, user_id, fmt, compress=False, chunk_size=EXPORT_CHUNK_ROWS):
+    return b''.join(app.export_messages(user_id, fmt, compress, chunk_size))
+
+
+def export_peak(app, user_id, fmt, compress, chunk_size=EXPORT_CHUNK_ROWS):
+    """Peak bytes traced while streaming user_id's export"""
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        for _ in app.export_messages(user_id, fmt, compress, chunk_size):
+            pass
+        return tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+
+
+def test_ndjson_and_csv_hold_every_message_in_order(app_db):
+    user_id, other = new_user(app_db, 'exporter'), new_user(app_db, 'other')
+    add_messages(app_db, user_id, 250)
+    add_messages(app_db, other, 10)
+
+    lines = drain(app_db, user_id, 'ndjson').decode().splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert len(rows) == 250
+    assert list(rows[0]) == list(app_db.EXPORT_FIELDS)
+    assert [row['content'] for row in rows] == [
+        f"Message {i}, with \"quotes\", commas and some ünïcode to escape. " * 2 for i in range(250)]
+
+    table = list(csv.reader(io.StringIO(drain(app_db, user_id, 'csv').decode())))
+    assert table[0] == list(app_db.EXPORT_FIELDS)
+    assert [line[3] for line in table[1:]] == [row['content'] for row in rows]
+
+    assert gzip.decompress(drain(app_db, user_id, 'ndjson', compress=True)) == '\n'.join(lines).encode() + b'\n'
+
+    with pytest.raises(ValueError):
+        drain(app_db, user_id, 'xml')
+
+
+@pytest.mark.parametrize('fmt, compress', [('ndjson', False), ('csv', False), ('ndjson', True)])
+def test_memory_does_not_grow_with_history(app_db, fmt, compress):
+    small, large = new_user(app_db, 'small'), new_user(app_db, 'large')
+    add_messages(app_db, small, EXPORT_ROWS)
+    add_messages(app_db, large, EXPORT_SCALE * EXPORT_ROWS)
+
+    drain(app_db, small, fmt, compress)  # warm statement and codec caches
+    small_peak, large_peak = export_peak(app_db, small, fmt, compress), export_peak(app_db, large, fmt, compress)
+    assert large_peak <= EXPORT_MAX_GROWTH * small_peak, (small_peak, large_peak)
+
+
+@pytest.mark.slow
+@pytest.mark.skipif(not os.environ.get('AIKO_SLOW_TESTS'), reason="set AIKO_SLOW_TESTS=1 to build a million-row history")
+def test_million_row_export_fits_a_fixed_budget(app_db):
+    user_id = new_user(app_db, 'exporter')
+    add_messages(app_db, user_id, SLOW_EXPORT_ROWS)
+    peak = export_peak(app_db, user_id, 'ndjson', True, app_db.EXPORT_CHUNK_ROWS)
+    assert peak <= SLOW_EXPORT_MAX_PEAK, peak
@@ -0,0 +1,233 @@
+from types import SimpleNamespace
+
+import pytest
+
+import key_pool
+import tts
+from key_pool import KeyPool, KeysExhausted
+
+
+class Clock:
+    """Stands in for the time module in key_pool, so windows and cooldowns are exact"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(key_pool, 'time', clock)
+    monkeypatch.setattr(key_pool, 'GEMINI_KEY_COOLDOWN', 10.0)
+    return clock
+
+
+def requests(pool):
+    return [stats['requests'] for stats in pool.stats().values()]
+
+
+def test_balances_by_remaining_quota(clock):
+    # A key with twice the quota takes twice the calls, then every key is out
+    pool = KeyPool([('small', 4, 0), ('large', 8, 0)])
+    for _ in range(12):
+        pool.succeeded(pool.acquire())
+    assert requests(pool) == [4, 8]
+    with pytest.raises(KeysExhausted) as exhausted:
+        pool.acquire()
+    assert exhausted.value.retry_after == key_pool.QUOTA_WINDOW
+
+    # The calls leave the window a minute after they were made
+    clock.now += key_pool.QUOTA_WINDOW
+    assert pool.stats()['key2…arge']['last_minute_requests'] == 0
+    pool.acquire()
+
+
+def test_token_quota(clock):
+    pool = KeyPool([('a', 0, 1000)])
+    pool.succeeded(pool.acquire(), input_tokens=900, output_tokens=100)
+    with pytest.raises(KeysExhausted):
+        pool.acquire()
+
+
+def test_cooldown_doubles_per_consecutive_429(clock):
+    pool = KeyPool([('flaky', 0, 0), ('steady', 0, 0)])
+    flaky, steady = pool.keys
+
+    pool.rate_limited(pool.acquire(only=1))
+    assert flaky.cooldown_until - clock.now == 10.0
+    assert steady.cooldown_until == 0.0
+    assert pool.acquire().api_key is steady
+
+    clock.now += 10.0
+    pool.rate_limited(pool.acquire(only=1))
+    assert flaky.cooldown_until - clock.now == 20.0
+    assert (flaky.strikes, steady.strikes) == (2, 0)
+
+    # A success resets the backoff
+    clock.now += 20.0
+    pool.succeeded(pool.acquire(only=1))
+    pool.rate_limited(pool.acquire(only=1))
+    assert flaky.cooldown_until - clock.now == 10.0
+
+
+def test_cooldown_uses_the_delay_the_api_asked_for(clock):
+    error = Exception("429 RESOURCE_EXHAUSTED. Please retry in 7.5s.")
+    assert key_pool.is_rate_limited(error)
+    assert key_pool.retry_after(error) == 7.5
+
+    pool = KeyPool([('a', 0, 0)])
+    pool.rate_limited(pool.acquire(), key_pool.retry_after(error))
+    with pytest.raises(KeysExhausted) as exhausted:
+        pool.acquire()
+    assert exhausted.value.retry_after == 7.5
+
+
+def test_affinity_sticks_until_the_key_is_rate_limited(clock):
+    pool = KeyPool([('first', 10, 0), ('second', 10, 0)])
+    for _ in range(4):
+        pool.succeeded(pool.acquire((1, 'c1')))
+    assert requests(pool) == [4, 0]
+
+    # Another conversation goes to the emptier key
+    pool.succeeded(pool.acquire((2, 'c1')))
+    assert requests(pool) == [4, 1]
+
+    # After a 429 the conversation follows the retry to the other key, and stays there
+    lease = pool.acquire((1, 'c1'))
+    pool.rate_limited(lease)
+    retry = pool.acquire((1, 'c1'), exclude=[lease.api_key])
+    assert retry.api_key.key == 'second'
+    pool.succeeded(retry)
+    clock.now += key_pool.QUOTA_WINDOW
+    assert pool.acquire((1, 'c1')).api_key.key == 'second'
+
+
+def test_exhausted_when_every_key_is_cooling_down(clock):
+    pool = KeyPool([('a', 0, 0), ('b', 0, 0)])
+    pool.rate_limited(pool.acquire(), 5.0)
+    pool.rate_limited(pool.acquire(), 3.0)
+    with pytest.raises(KeysExhausted) as exhausted:
+        pool.acquire()
+    assert exhausted.value.retry_after == 3.0
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 4, 7])
+def test_split_shares_add_up_to_each_limit(workers):
+    specs = [('a', 15, 1000), ('b', 0, 0), ('c', 2, 3)]
+    limits = {key: rpm for key, rpm, _ in specs}
+    shares = []
+    for slot in range(workers):
+        pool = KeyPool(specs)
+        pool.split(workers, slot)
+        shares.append({key.key: (key.rpm, key.tpm) for key in pool.keys})
+        # No worker is handed a key with no calls left to make
+        assert all(rpm or not limits[key] for key, (rpm, _) in shares[-1].items())
+
+    for key, rpm, _ in specs:
+        if rpm:
+            assert sum(share[key][0] for share in shares if key in share) == rpm
+        else:
+            assert all(share[key] == (0, 0) for share in shares)
+
+
+def test_split_drops_keys_without_a_share():
+    pool = KeyPool([('a', 2, 0), ('b', 0, 0)])
+    pool.split(3, slot=2)
+    assert [key.key for key in pool.keys] == ['b']
+
+
+# --- The assistant and Gemini TTS on a key pool ---
+class FakeRateLimit(Exception):
+    code = 429
+
+
+class FakeGenai:
+    """Stands in for google.genai: each key answers `limits[key]` calls, then 429s"""
+
+    def __init__(self, limits=None):
+        self.limits = limits or {}
+        self.calls = {}
+
+    def Client(self, api_key, http_options=None):
+        fake = self
+
+        class Models:
+            def generate_content(self, model, contents, config):
+                calls = fake.calls[api_key] = fake.calls.get(api_key, 0) + 1
+                if calls > fake.limits.get(api_key, float('inf')):
+                    raise FakeRateLimit("429 RESOURCE_EXHAUSTED")
+                usage = SimpleNamespace(prompt_token_count=100, candidates_token_count=10)
+                return SimpleNamespace(text="Learning piano as an adult is great.", usage_metadata=usage)
+
+        return SimpleNamespace(models=Models())
+
+
+@pytest.fixture
+def gemini(monkeypatch, clock):
+    """Route the assistant's Gemini calls through a FakeGenai; returns a function making one turn"""
+    import app
+    import bulkhead
+    monkeypatch.setattr(app, 'genai', FakeGenai())
+    monkeypatch.setattr(app, 'USE_NEW_GENAI', True)
+    monkeypatch.setattr(app, '_genai_loaded', True)
+    monkeypatch.setattr(app, 'gemini_available', True)
+    monkeypatch.setattr(app, 'GEMINI_BASE_URL', None)
+    monkeypatch.setattr(bulkhead, '_llm_bulkhead', bulkhead.Bulkhead(limit=4, queue_size=0))
+    assistant = app.GeminiChatAssistant()
+
+    def turn(pool, user_id=1):
+        assistant.keys = pool
+        message = "What do you think about learning to play the piano as an adult?"
+        return assistant.generate_response(message, [], user_id, 'natural', None)
+
+    return SimpleNamespace(app=app, turn=turn)
+
+
+def test_assistant_moves_to_the_next_key_after_a_429(gemini):
+    gemini.app.genai.limits = {'flaky': 1}
+    pool = KeyPool([('flaky', 0, 0), ('steady', 0, 0)])
+    assert gemini.turn(pool)['is_gemini']
+    assert gemini.turn(pool)['is_gemini']       # flaky 429s, steady answers
+    assert [stats['rate_limited'] for stats in pool.stats().values()] == [1, 0]
+    assert requests(pool) == [2, 1]
+
+
+def test_assistant_answers_offline_when_every_key_is_limited(gemini):
+    gemini.app.genai.limits = {'a': 0, 'b': 0}
+    pool = KeyPool([('a', 0, 0), ('b', 0, 0)])
+    assert not gemini.turn(pool)['is_gemini']
+    assert [stats['rate_limited'] for stats in pool.stats().values()] == [1, 1]
+
+    # The next turn does not call upstream at all
+    assert not gemini.turn(pool)['is_gemini']
+    assert gemini.app.genai.calls == {'a': 1, 'b': 1}
+
+
+def test_gemini_tts_leases_keys(monkeypatch, clock):
+    class FakeClient:
+        def __init__(self):
+            self.keys = []
+
+        def synthesize(self, text, voice_name='Kore', api_key=None):
+            self.keys.append(api_key)
+            if api_key == 'limited':
+                raise tts.RateLimitedError("Gemini TTS rate limited: retry in 4s")
+            return [0] * 10, 24000
+
+    pool = KeyPool([('limited', 0, 0), ('spare', 0, 0)])
+    client = FakeClient()
+    monkeypatch.setattr(key_pool, '_pool', pool)
+    monkeypatch.setattr(tts, '_gemini_tts', client)
+
+    engine = tts.GeminiEngine()
+    assert engine.synthesize("Hello there.", 'natural')[1] == 24000
+    assert engine.synthesize("Hello there.", 'natural')[1] == 24000
+    assert client.keys == ['limited', 'spare', 'spare']
+    assert pool.keys[0].cooldown_until - clock.now == 4.0
+
+    pool.rate_limited(pool.acquire(exclude=[pool.keys[0]]))
+    with pytest.raises(tts.TTSError):
+        engine.synthesize("Hello there.", 'natural')
@@ -0,0 +1,69 @@
+from sqlalchemy import func, select, update
+
+import migrations
+from storage import chat_messages
+
+
+def version(engine):
+    with engine.connect() as conn:
+        return migrations.get_version(conn)
+
+
+def unlinked(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(chat_messages)
+                            .where(chat_messages.c.conversation_pk.is_(None))).scalar()
+
+
+def unmigrate(db):
+    """Put the database back at version 1 with its messages not yet linked to conversations"""
+    with db.engine.begin() as conn:
+        conn.execute(update(chat_messages).values(conversation_pk=None))
+        migrations._set_version(conn, 1)
+    db.messages.clear_cache()
+
+
+def test_fresh_database_is_at_the_latest_version(db):
+    assert version(db.engine) == migrations.LATEST_VERSION
+    assert migrations.upgrade(db) == []
+
+
+def test_dry_run_rolls_back(db):
+    user_id = db.users.create('migrated', 'migrated@example.com', 'x$y', {})
+    for i in range(25):
+        db.messages.add(user_id, f'c{i % 3}', 'user', f"message {i}")
+    unmigrate(db)
+    main = next(migrations.databases(db))
+
+    start, results = migrations.estimate(main, batch_size=4)
+    assert start == 1
+    links = results[0]
+    assert (links[0].version, links[2]) == (2, 25)
+    assert links[1] is not None and links[3] > 0
+
+    # Nothing the dry run did is left behind
+    assert version(db.engine) == 1
+    assert unlinked(db.engine) == 25
+
+    assert migrations.upgrade(db) == []
+    assert version(db.engine) == migrations.LATEST_VERSION
+    assert unlinked(db.engine) == 0
+    assert db.messages.count(user_id, 'c0') == 9
+
+
+def test_large_backfill_waits_for_migrate(db):
+    user_id = db.users.create('migrated', 'migrated@example.com', 'x$y', {})
+    for i in range(5):
+        db.messages.add(user_id, 'c1', 'user', f"message {i}")
+    unmigrate(db)
+
+    left = migrations.upgrade(db, backfill_below=5)
+    assert [(migration.version, rows) for _, migration, rows in left][0] == (2, 5)
+    assert version(db.engine) == 1
+
+    # Reads fall back to the text conversation id until the backfill is done
+    assert db.messages.count(user_id, 'c1') == 5
+    for _ in migrations.run_backfills(next(migrations.databases(db)), batch_size=2):
+        pass
+    assert version(db.engine) == migrations.LATEST_VERSION
+    assert unlinked(db.engine) == 0
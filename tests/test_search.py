@@ -0,0 +1,67 @@
+import pytest
+
+
+@pytest.fixture
+def user(app_db):
+    user_id, error = app_db.create_user('searcher', 'searcher@example.com', 'a long enough password')
+    assert error is None
+    return user_id
+
+
+def save(app, user_id, contents):
+    return [app.save_chat_message(user_id, 'c1', 'user', content) for content in contents]
+
+
+def search_all(app, user_id, text, limit):
+    """Every hit for text, a page of `limit` at a time, following the cursors"""
+    hits, after = [], None
+    while True:
+        page, cursor = app.search_messages(user_id, text, limit, after)
+        hits += page
+        if cursor is None:
+            return hits
+        after = app.parse_search_cursor(cursor)
+
+
+def test_pages_cover_every_hit_once(app_db, user):
+    # Identical messages tie on score; the id breaks the tie across pages
+    ids = save(app_db, user, ["piano lessons every week"] * 23
+               + ["piano piano piano", "I practised the piano today", "no match here"])
+    hits = search_all(app_db, user, "piano", limit=5)
+
+    assert sorted(hit['id'] for hit in hits) == sorted(ids[:-1])
+    ranked = [(-hit['score'], hit['id']) for hit in hits]
+    assert ranked == sorted(ranked)
+
+
+def test_pages_only_hold_the_users_own_messages(app_db, user):
+    other, _ = app_db.create_user('other', 'other@example.com', 'a long enough password')
+    mine = save(app_db, user, ["piano scales"] * 3)
+    save(app_db, other, ["piano scales"] * 3)
+    assert sorted(hit['id'] for hit in search_all(app_db, user, "piano", limit=2)) == mine
+
+
+def test_cursor_is_an_integer_score_and_id(app_db, user):
+    save(app_db, user, ["piano scales", "piano chords", "piano songs"])
+    hits, cursor = app_db.search_messages(user, "piano", limit=2)
+    score, message_id = app_db.parse_search_cursor(cursor)
+    assert message_id == hits[-1]['id']
+    assert score == round(hits[-1]['score'] * app_db.SEARCH_SCORE_SCALE)
+
+    with pytest.raises(ValueError):
+        app_db.parse_search_cursor("0.25:7")
+
+
+def test_search_route_rejects_a_bad_cursor(app_db, user):
+    save(app_db, user, ["piano scales", "piano chords"])
+    client = app_db.app.test_client()
+    headers = {'Authorization': app_db.create_session_token(user)}
+
+    response = client.get('/search?q=piano&limit=1', headers=headers)
+    assert response.status_code == 200
+    cursor = response.get_json()['next_cursor']
+    response = client.get(f'/search?q=piano&limit=1&cursor={cursor}', headers=headers)
+    assert response.status_code == 200 and response.get_json()['next_cursor'] is None
+
+    response = client.get('/search?q=piano&cursor=not-a-cursor', headers=headers)
+    assert response.status_code == 400
@@ -0,0 +1,183 @@
+"""The repositories in storage.py, on SQLite and (with AIKO_TEST_DATABASE_URL) a server database.
+
+Message tests run with messages in the main database and split over two
+SQLite shard files next to it.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+import migrations
+import storage
+from storage import chat_messages
+
+DEFAULTS = {'voice_style': 'natural', 'theme': 'light', 'auto_play_voice': 1, 'speech_rate': 1.0,
+            'speech_pitch': 1.0, 'conversation_style': 'casual', 'use_fillers': 1, 'use_pauses': 1}
+
+
+@pytest.fixture(params=[0, 2], ids=['unsharded', 'sharded'])
+def any_db(request, main_url, tmp_path):
+    """A migrated Storage, with messages in the main database or in two shard files"""
+    db = storage.Storage(main_url, storage.shard_urls(str(tmp_path / 'shards'), request.param))
+    migrations.upgrade(db)
+    yield db
+    for engine in db.message_engines:
+        engine.dispose()
+
+
+def new_user(db, name='alice'):
+    return db.users.create(name, f'{name}@example.com', 'salt$hash', DEFAULTS)
+
+
+def message_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(chat_messages)).scalar()
+
+
+# --- Users, sessions and preferences (always in the main database) ---
+def test_users(db):
+    user_id = new_user(db)
+    assert new_user(db) is None                                         # username taken
+    assert db.users.create('bob', 'alice@example.com', 'x$y', DEFAULTS) is None   # email taken
+
+    assert db.users.credentials('alice') == (user_id, 'salt$hash')
+    assert db.users.credentials('nobody') is None
+    assert db.users.id_for_username('alice') == user_id
+
+    assert db.users.profile(user_id)['last_login'] is None
+    db.users.record_login(user_id)
+    profile = db.users.profile(user_id)
+    assert profile['username'] == 'alice' and profile['email'] == 'alice@example.com'
+    assert profile['last_login'] is not None
+    assert db.users.profile(user_id + 1) is None
+
+
+def test_sessions(db):
+    user_id = new_user(db)
+    now = datetime.now()
+    db.sessions.create(user_id, 'token', now + timedelta(days=7))
+    assert db.sessions.user_for_token('token', now) == user_id
+    assert db.sessions.user_for_token('token', now + timedelta(days=8)) is None
+    assert db.sessions.user_for_token('other', now) is None
+
+    db.sessions.delete('token')
+    assert db.sessions.user_for_token('token', now) is None
+
+
+def test_preferences(db):
+    user_id = new_user(db)
+    generation, prefs = db.preferences.get(user_id)
+    assert prefs == DEFAULTS
+    assert db.preferences.generation() == generation
+
+    written = db.preferences.update(user_id, {'theme': 'dark', 'speech_rate': 1.5})
+    assert written == (generation + 1, {**DEFAULTS, 'theme': 'dark', 'speech_rate': 1.5})
+    assert db.preferences.get(user_id) == written
+
+    assert db.preferences.update(user_id + 1, {'theme': 'dark'}) is None
+    assert db.preferences.generation() == generation + 1
+    assert db.preferences.get(user_id + 1) == (generation + 1, None)
+
+
+# --- Messages ---
+def test_conversation_reads(any_db):
+    messages = any_db.messages
+    user_id = new_user(any_db)
+    for i in range(6):
+        messages.add(user_id, 'c1', 'user' if i % 2 == 0 else 'assistant', f"message {i}", 'warm', 'happy')
+    messages.add(user_id, 'c2', 'user', "another conversation")
+
+    assert messages.count(user_id, 'c1') == 6
+    assert messages.count(user_id, 'missing') == 0
+    assert [row['content'] for row in messages.recent(user_id, 'c1', 2)] == ["message 4", "message 5"]
+    assert messages.recent(user_id, 'c1', 1)[0] == {'role': 'assistant', 'content': "message 5", 'emotion': 'happy'}
+    assert [row['content'] for row in messages.slice(user_id, 'c1', 1, 2)] == ["message 1", "message 2"]
+    assert messages.recent(user_id, 'missing', 10) == []
+
+    history = messages.history(user_id, 'c1', 3)
+    assert history.columns == storage.HISTORY_COLUMNS
+    assert [row['content'] for row in history] == ["message 0", "message 1", "message 2"]
+    assert list(history)[0]['voice_style'] == 'warm'
+    latest = messages.latest_page(user_id, 'c1', 2)
+    assert [row['content'] for row in latest] == ["message 4", "message 5"]
+
+    assert [row['conversation_id'] for row in messages.conversations(user_id)] == ['c2', 'c1']
+    assert messages.conversations(user_id + 1) == []
+
+
+def test_conversations_are_per_user(any_db):
+    messages = any_db.messages
+    alice, bob = new_user(any_db, 'alice'), new_user(any_db, 'bob')
+    messages.add(alice, 'shared-id', 'user', "from alice")
+    messages.add(bob, 'shared-id', 'user', "from bob")
+    assert [row['content'] for row in messages.recent(alice, 'shared-id', 10)] == ["from alice"]
+    assert [row['content'] for row in messages.recent(bob, 'shared-id', 10)] == ["from bob"]
+
+
+def test_iter_chunks_streams_every_message_in_order(any_db):
+    user_id, other = new_user(any_db, 'alice'), new_user(any_db, 'bob')
+    for i in range(7):
+        any_db.messages.add(user_id, f'c{i % 2}', 'user', f"message {i}")
+    any_db.messages.add(other, 'c0', 'user', "not alice's")
+
+    chunks = list(any_db.messages.iter_chunks(user_id, ('id', 'content'), 3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+    assert [row.content for chunk in chunks for row in chunk] == [f"message {i}" for i in range(7)]
+
+
+def test_iter_since_and_content(db):
+    user_id = new_user(db)
+    ids = [db.messages.add(user_id, 'c1', 'user', f"message {i}") for i in range(5)]
+    rows = [row for chunk in db.messages.iter_since(ids[1], 2) for row in chunk]
+    assert [row.id for row in rows] == ids[2:]
+    assert (rows[0].user_id, rows[0].conversation_id, rows[0].voice_style) == (user_id, 'c1', 'natural')
+    assert db.messages.content(ids[3]) == "message 3"
+
+
+def test_messages_go_to_the_users_shard(db, tmp_path):
+    sharded = storage.Storage(db.url, storage.shard_urls(str(tmp_path / 'shards'), 2))
+    migrations.upgrade(sharded)
+    users = [new_user(sharded, f'user{i}') for i in range(6)]
+    for user_id in users:
+        sharded.messages.add(user_id, 'c1', 'user', "hello")
+
+    assert message_count(sharded.engine) == 0
+    for index, engine in enumerate(sharded.message_engines):
+        expected = sum(storage.shard_index(user_id, 2) == index for user_id in users)
+        assert message_count(engine) == expected
+    for user_id in users:
+        assert sharded.message_engine(user_id) is sharded.message_engines[storage.shard_index(user_id, 2)]
+        assert sharded.messages.count(user_id, 'c1') == 1
+    for engine in sharded.message_engines:
+        engine.dispose()
+
+
+def test_reshard_moves_every_message(db, tmp_path):
+    users = [new_user(db, f'user{i}') for i in range(4)]
+    for user_id in users:
+        for i in range(3):
+            db.messages.add(user_id, f'c{i % 2}', 'user', f"{user_id}: {i}")
+
+    sharded = storage.Storage(db.url, storage.shard_urls(str(tmp_path / 'shards'), 2))
+    migrations.upgrade(sharded)
+    assert storage.reshard(db, sharded, chunk_size=4) == 12
+    assert message_count(db.engine) == 0
+    for user_id in users:
+        assert [row['content'] for row in sharded.messages.recent(user_id, 'c0', 10)] == \
+            [f"{user_id}: 0", f"{user_id}: 2"]
+    for engine in sharded.message_engines:
+        engine.dispose()
+
+
+def test_conversation_id_cache_is_bounded(db):
+    messages = storage.MessageRepository(db.engine, cache_size=2)
+    user_id = new_user(db)
+    for conversation_id in ('a', 'b', 'a', 'c'):
+        messages.add(user_id, conversation_id, 'user', "hello")
+    # 'b' was the least recently used when 'c' came in
+    assert [key[1] for key in messages._conversation_pks] == ['a', 'c']
+    assert messages.count(user_id, 'b') == 1
+
+    messages.clear_cache()
+    assert not messages._conversation_pks
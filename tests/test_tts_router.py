@@ -0,0 +1,202 @@
+import threading
+
+import numpy as np
+import pytest
+
+import tts
+from tts import TTSEngine, TTSError, TTSRouter
+
+
+class Clock:
+    """Stands in for the time module in tts: engines advance it instead of sleeping"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+class StubEngine(TTSEngine):
+    """Canned audio that takes `latency` seconds on the fake clock.
+
+    Fails while `failing` is set, and every call from `fail_after` on; calls
+    are logged to `log` in order. A call made while `gate` is set blocks
+    until the gate opens.
+    """
+
+    def __init__(self, name, clock, log, latency=0.0, rate=24000, quality=2, failing=False, fail_after=None):
+        self.name, self.clock, self.log = name, clock, log
+        self.latency, self.rate, self.quality = latency, rate, quality
+        self.failing, self.fail_after = failing, fail_after
+        self.expected_latency = 0.0
+        self.calls = 0
+        self.gate = None
+        self.entered = threading.Event()
+
+    def synthesize(self, text, voice_style):
+        self.calls += 1
+        self.log.append(self.name)
+        if self.gate is not None:
+            self.entered.set()
+            self.gate.wait(5.0)
+        self.clock.now += self.latency
+        if self.failing or (self.fail_after is not None and self.calls > self.fail_after):
+            raise TTSError(f"{self.name} is down")
+        return np.zeros(100, dtype=np.int16), self.rate
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(tts, 'time', clock)
+    monkeypatch.setattr(tts, 'ROUTER_COOLDOWN', 30.0)
+    return clock
+
+
+@pytest.fixture
+def engines(clock):
+    """make(name, **options) -> a StubEngine sharing the clock and call log; .log holds the calls"""
+    log = []
+
+    def make(name, **options):
+        return StubEngine(name, clock, log, **options)
+
+    make.log = log
+    return make
+
+
+def router_of(*engines):
+    router = TTSRouter()
+    for engine in engines:
+        router.register(engine)
+    return router
+
+
+def trip(router, engine):
+    """Fail `engine` until the router stops trusting it"""
+    engine.failing = True
+    for _ in range(tts.ROUTER_MIN_CALLS):
+        router.synthesize("Hello there.")
+    assert not router.stats()[engine.name]['healthy']
+    engine.failing = False
+
+
+def test_ranks_by_measured_p95_latency(engines):
+    slow, fast = engines('slow', latency=0.5), engines('fast', latency=0.01)
+    router = router_of(slow, fast)
+    # Unmeasured engines tie at their expected latency; the first call times slow
+    assert router.synthesize("Hello there.")[2] == ['slow']
+    router.synthesize("Hello there.")
+    assert router.rank() == [fast, slow]
+    assert router.synthesize("Hi there. How are you? Good.")[2] == ['fast']
+
+
+def test_latency_ties_are_broken_by_cost(engines):
+    dear, cheap = engines('dear'), engines('cheap')
+    dear.cost_per_1k_chars = 0.02
+    assert router_of(dear, cheap).rank() == [cheap, dear]
+
+
+def test_rank_skips_engines_that_cannot_serve_the_request(engines):
+    low, styled = engines('low', quality=1), engines('styled', quality=3)
+    styled.styles = frozenset({'warm'})
+    router = router_of(low, styled)
+    assert router.rank('natural', 1) == [low]
+    assert router.rank('warm', 3) == [styled]
+    assert not router.available('natural', 'high')
+    with pytest.raises(tts.NoEngineError):
+        router.synthesize("Hello there.", 'natural', 'high')
+
+
+def test_fails_over_in_rank_order(engines):
+    first, second, third = (engines('first', failing=True), engines('second', failing=True),
+                            engines('third'))
+    first.expected_latency, second.expected_latency, third.expected_latency = 0.1, 0.2, 0.3
+    router = router_of(third, first, second)
+    assert router.synthesize("Hello there.")[2] == ['third']
+    assert engines.log == ['first', 'second', 'third']
+
+    second.failing = third.failing = True
+    with pytest.raises(TTSError):
+        router.synthesize("Hello there.")
+
+
+def test_fails_over_mid_reply_at_the_same_rate(engines):
+    # The primary dies after the first sentence; the rest of the reply moves
+    # to the backup and is resampled to the primary's rate
+    primary, backup = engines('primary', rate=22050, fail_after=1), engines('backup', quality=3)
+    backup.expected_latency = 1.0
+    router = router_of(primary, backup)
+    samples, rate, used = router.synthesize("Hi there. I'm happy to help. What would you like to talk about?")
+    assert used == ['primary', 'backup'] and rate == 22050
+    assert engines.log == ['primary', 'primary', 'backup', 'backup']
+    assert len(samples) == 100 + 2 * round(100 * 22050 / 24000)
+
+
+def test_failing_engine_is_tripped_and_tried_last(engines):
+    flaky, backup = engines('flaky'), engines('backup', latency=0.2)
+    backup.expected_latency = 1.0
+    router = router_of(flaky, backup)
+    trip(router, flaky)
+    assert router.rank() == [backup, flaky]
+
+    # Skipped while it cools down, but still tried if everything else fails
+    calls = flaky.calls
+    assert router.synthesize("Hello there.")[2] == ['backup']
+    assert flaky.calls == calls
+    backup.failing = True
+    assert router.synthesize("Hello there.")[2] == ['flaky']
+
+
+def test_reopens_after_the_cooldown(engines, clock):
+    flaky, backup = engines('flaky'), engines('backup', latency=0.2)
+    backup.expected_latency = 1.0
+    router = router_of(flaky, backup)
+    trip(router, flaky)
+
+    clock.now += tts.ROUTER_COOLDOWN / 2
+    assert router.synthesize("Hello there.")[2] == ['backup']
+    assert engines.log[-2:] == ['backup', 'backup']
+
+    # A failed probe starts a new cooldown
+    clock.now += tts.ROUTER_COOLDOWN
+    flaky.failing = True
+    assert router.synthesize("Hello there.")[2] == ['backup']
+    assert engines.log[-2:] == ['flaky', 'backup']
+    assert router.rank() == [backup, flaky]
+
+    # A successful one puts the engine back in rotation
+    clock.now += tts.ROUTER_COOLDOWN + 1
+    flaky.failing = False
+    assert router.synthesize("Hello there.")[2] == ['flaky']
+    assert router.rank() == [flaky, backup]
+
+
+def test_one_probe_at_a_time(engines, clock):
+    flaky, backup = engines('flaky'), engines('backup', latency=0.2)
+    backup.expected_latency = 1.0
+    router = router_of(flaky, backup)
+    trip(router, flaky)
+    clock.now += tts.ROUTER_COOLDOWN + 1
+
+    # The first request after the cooldown probes the engine and blocks in it...
+    flaky.gate = threading.Event()
+    probe = {}
+    thread = threading.Thread(target=lambda: probe.update(used=router.synthesize("Hello there.")[2]))
+    thread.start()
+    assert flaky.entered.wait(5.0)
+
+    # ...while every other request stays on the backup
+    calls = flaky.calls
+    for _ in range(3):
+        assert router.synthesize("Hello there.")[2] == ['backup']
+    assert flaky.calls == calls
+
+    flaky.gate.set()
+    thread.join(5.0)
+    assert probe['used'] == ['flaky']
+    assert not router._stats['flaky'].probing
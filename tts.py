@@ -0,0 +1,793 @@
+"""Server-side text-to-speech helpers.
+
+Piper voices are ONNX models that take a noticeable amount of time to load,
+so they are cached per process and can be warmed up in a background thread
+at startup. Set PIPER_MODELS to a comma-separated list of .onnx paths (for
+example piper_models/en_US-jenny-medium.onnx) to enable the warm-up.
+
+Concurrent Piper requests go through PiperBatcher, which groups sentences
+that arrive within a few milliseconds of each other into one ONNX call.
+
+Gemini TTS is called from the server (the API key never reaches the
+browser) through one pooled HTTP session per process, with each request
+leasing a key from the same key pool as the chat calls.
+
+TTSRouter picks between every installed engine (Piper, Gemini, gTTS,
+pyttsx3) per request, based on capability metadata and measured latency.
+"""
+import base64
+import collections
+import io
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+import audio
+import key_pool
+
+PIPER_MODELS_ENV = 'PIPER_MODELS'
+WARMUP_TEXT = "Hello."
+# 0 lets onnxruntime use one thread per core; with several workers per host,
+# set it to cores / WEB_CONCURRENCY so workers don't oversubscribe the CPU
+PIPER_INTRA_OP_THREADS = int(os.getenv('PIPER_INTRA_OP_THREADS', 0))
+
+_voices = {}
+_voices_lock = threading.Lock()
+_warmup_thread = None
+warmup_done = threading.Event()
+
+
+def configured_models():
+    """Piper model paths listed in the environment"""
+    return [path.strip() for path in os.getenv(PIPER_MODELS_ENV, '').split(',') if path.strip()]
+
+
+def get_piper_voice(model_path):
+    """Load a Piper voice once per process and return the cached instance"""
+    voice = _voices.get(model_path)
+    if voice is not None:
+        return voice
+
+    with _voices_lock:
+        voice = _voices.get(model_path)
+        if voice is None:
+            from piper.voice import PiperVoice
+            voice = PiperVoice.load(model_path)
+            voice.session = tuned_session(model_path)
+            _voices[model_path] = voice
+    return voice
+
+
+def tuned_session(model_path):
+    """onnxruntime session with full graph optimization and explicit thread counts.
+
+    Batches are run one at a time, so parallelism comes from intra-op threads
+    (inside each operator) rather than inter-op threads.
+    """
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    options.intra_op_num_threads = PIPER_INTRA_OP_THREADS
+    options.inter_op_num_threads = 1
+    return onnxruntime.InferenceSession(model_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+
+def synthesize_raw(voice, text):
+    """Synthesize text to 16-bit mono PCM bytes across Piper API versions"""
+    if hasattr(voice, 'synthesize_stream_raw'):
+        return b''.join(voice.synthesize_stream_raw(text))
+    return b''.join(chunk.audio_int16_bytes for chunk in voice.synthesize(text))
+
+
+def _warm_up(model_paths):
+    for model_path in model_paths:
+        try:
+            voice = get_piper_voice(model_path)
+            # First inference allocates the ONNX runtime buffers
+            synthesize_raw(voice, WARMUP_TEXT)
+            print(f"✅ Piper voice ready: {os.path.basename(model_path)}")
+        except Exception as e:
+            print(f"⚠️ Piper warm-up failed for {model_path}: {e}")
+    warmup_done.set()
+
+
+def start_warmup(model_paths=None):
+    """Load configured Piper voices in a daemon thread; safe to call repeatedly"""
+    global _warmup_thread
+    model_paths = configured_models() if model_paths is None else model_paths
+    if not model_paths:
+        warmup_done.set()
+        return None
+
+    with _voices_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(
+                target=_warm_up, args=(model_paths,), name='tts-warmup', daemon=True
+            )
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+# --- Batched Piper inference ---
+PIPER_BATCH_WINDOW_MS = float(os.getenv('PIPER_BATCH_WINDOW_MS', 5))
+PIPER_MAX_BATCH = int(os.getenv('PIPER_MAX_BATCH', 8))
+# Trailing output below this level is padding when a model reports no durations
+PADDING_LEVEL = 1e-3
+
+
+def sentence_ids(voice, text):
+    """Phoneme ids for each sentence of text"""
+    return [voice.phonemes_to_ids(phonemes) for phonemes in voice.phonemize(text) if phonemes]
+
+
+def _scales(voice):
+    import numpy as np
+    config = voice.config
+    # noise_w_scale in piper-tts 1.3+, noise_w before
+    noise_w = getattr(config, 'noise_w_scale', None) or getattr(config, 'noise_w', 0.8)
+    return np.array([config.noise_scale, config.length_scale, noise_w], dtype=np.float32)
+
+
+def _trim_padding(samples):
+    import numpy as np
+    loud = np.flatnonzero(np.abs(samples) > PADDING_LEVEL)
+    return samples[:loud[-1] + 1] if loud.size else samples[:0]
+
+
+def infer_batch(voice, id_lists):
+    """Run several sentences through one ONNX call; returns one float array each.
+
+    Sequences are right-padded with id 0 (Piper's pad symbol) and masked by
+    input_lengths. Models exported with alignments also return per-phoneme
+    durations, which give each sentence's exact length; otherwise trailing
+    padding is trimmed by level.
+    """
+    import numpy as np
+
+    lengths = np.fromiter((len(ids) for ids in id_lists), dtype=np.int64, count=len(id_lists))
+    batch = np.zeros((len(id_lists), lengths.max()), dtype=np.int64)
+    for row, ids in enumerate(id_lists):
+        batch[row, :len(ids)] = ids
+
+    inputs = {'input': batch, 'input_lengths': lengths, 'scales': _scales(voice)}
+    if voice.config.num_speakers > 1:
+        speaker = getattr(voice.config, 'default_speaker_id', 0)
+        inputs['sid'] = np.full(len(id_lists), speaker, dtype=np.int64)
+
+    result = voice.session.run(None, inputs)
+    output = result[0].reshape(len(id_lists), -1)
+    if len(result) > 1:
+        durations = result[1].reshape(len(id_lists), -1)
+        valid = np.arange(durations.shape[1]) < lengths[:, np.newaxis]
+        hop = getattr(voice.config, 'hop_length', 256)
+        sizes = (np.where(valid, durations, 0).sum(axis=1) * hop).astype(int)
+        return [output[row, :size] for row, size in enumerate(sizes)]
+    return [_trim_padding(row) for row in output]
+
+
+def _pcm16(samples):
+    """Peak-normalize float model output to int16, as Piper itself does"""
+    import numpy as np
+    peak = np.max(np.abs(samples)) if samples.size else 0.0
+    if peak < 1e-8:
+        return np.zeros(samples.size, dtype=np.int16)
+    return (np.clip(samples / peak, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+class PiperBatcher:
+    """Micro-batches concurrent Piper sentence jobs per voice model.
+
+    Request threads phonemize their text (espeak runs in parallel) and queue
+    one job per sentence. A single scheduler thread waits up to window_ms for
+    more jobs to arrive, runs up to max_batch jobs for the same model in one
+    session.run(), and completes each job's Future.
+    """
+
+    def __init__(self, window_ms=PIPER_BATCH_WINDOW_MS, max_batch=PIPER_MAX_BATCH):
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self._pending = collections.deque()  # (model_path, phoneme ids, Future)
+        self._condition = threading.Condition()
+        self._thread = None
+        # Metrics, updated under the condition's lock
+        self.jobs = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.inference_seconds = 0.0
+        self.batch_sizes = collections.Counter()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='piper-batcher', daemon=True)
+            self._thread.start()
+
+    def submit(self, model_path, phoneme_ids):
+        """Queue one sentence; the Future resolves to its float audio"""
+        future = Future()
+        with self._condition:
+            self._ensure_thread()
+            self._pending.append((model_path, phoneme_ids, future))
+            self.max_queue_depth = max(self.max_queue_depth, len(self._pending))
+            self._condition.notify()
+        return future
+
+    def synthesize(self, model_path, text, timeout=30):
+        """Return (int16 samples, sample rate) for text, batched with other callers"""
+        import numpy as np
+        voice = get_piper_voice(model_path)
+        futures = [self.submit(model_path, ids) for ids in sentence_ids(voice, text)]
+        try:
+            sentences = [_pcm16(future.result(timeout)) for future in futures]
+        except Exception as e:
+            raise TTSError(f"Piper synthesis failed: {e}") from e
+        samples = np.concatenate(sentences) if sentences else np.zeros(0, dtype=np.int16)
+        return samples, voice.config.sample_rate
+
+    def _next_batch(self):
+        with self._condition:
+            while not self._pending:
+                self._condition.wait()
+            # Give concurrent requests a moment to join this batch
+            deadline = time.monotonic() + self.window
+            while len(self._pending) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            model_path = self._pending[0][0]
+            batch, rest = [], collections.deque()
+            while self._pending:
+                job = self._pending.popleft()
+                if job[0] == model_path and len(batch) < self.max_batch:
+                    batch.append(job)
+                else:
+                    rest.append(job)
+            self._pending = rest
+        return model_path, batch
+
+    def _run(self):
+        while True:
+            model_path, batch = self._next_batch()
+            started = time.perf_counter()
+            try:
+                outputs = infer_batch(get_piper_voice(model_path), [ids for _, ids, _ in batch])
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                with self._condition:
+                    self.jobs += len(batch)
+                    self.batches += 1
+                    self.batch_sizes[len(batch)] += 1
+                    self.inference_seconds += time.perf_counter() - started
+            for (_, _, future), output in zip(batch, outputs):
+                future.set_result(output)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'queue_depth': len(self._pending),
+                'max_queue_depth': self.max_queue_depth,
+                'jobs': self.jobs,
+                'batches': self.batches,
+                'mean_batch_size': round(self.jobs / self.batches, 2) if self.batches else 0.0,
+                'batch_sizes': {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                'mean_inference_ms': round(1000 * self.inference_seconds / self.batches, 2) if self.batches else 0.0,
+            }
+
+
+_piper_batcher = None
+_piper_batcher_lock = threading.Lock()
+
+
+def get_piper_batcher():
+    """Shared per-process batcher"""
+    global _piper_batcher
+    if _piper_batcher is None:
+        with _piper_batcher_lock:
+            if _piper_batcher is None:
+                _piper_batcher = PiperBatcher()
+    return _piper_batcher
+
+
+# --- Gemini TTS ---
+GEMINI_TTS_MODEL = 'gemini-2.5-flash-preview-tts'
+GEMINI_API_URL = os.getenv('GEMINI_API_URL', 'https://generativelanguage.googleapis.com/v1beta')
+GEMINI_TTS_POOL_SIZE = int(os.getenv('GEMINI_TTS_POOL_SIZE', 10))
+
+# Same voice per style as the browser used when it called Gemini directly
+GEMINI_TTS_VOICES = {
+    'natural': 'Kore',
+    'warm': 'Lyra',
+    'energetic': 'Iris',
+    'calm': 'Sage',
+    'playful': 'Zoe',
+}
+
+
+class TTSError(Exception):
+    """Speech synthesis failed upstream"""
+
+
+class RateLimitedError(TTSError):
+    """The API answered 429 for this key"""
+    code = 429
+
+
+class GeminiTTSClient:
+    """Gemini TTS over a keep-alive connection pool; the key can be chosen per request"""
+
+    def __init__(self, api_key=None, base_url=GEMINI_API_URL, pool_size=GEMINI_TTS_POOL_SIZE, timeout=30):
+        self.api_key = api_key
+        self.url = f"{base_url.rstrip('/')}/models/{GEMINI_TTS_MODEL}:generateContent"
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    if self.api_key:
+                        session.headers.update({'x-goog-api-key': self.api_key})
+                    self._session = session
+        return self._session
+
+    def synthesize(self, text, voice_name='Kore', api_key=None):
+        """Return (int16 samples, sample rate) for text, sent with api_key if given"""
+        payload = {
+            'contents': [{'parts': [{'text': text}]}],
+            'generationConfig': {
+                'responseModalities': ['AUDIO'],
+                'speechConfig': {'voiceConfig': {'prebuiltVoiceConfig': {'voiceName': voice_name}}},
+            },
+        }
+        try:
+            headers = {'x-goog-api-key': api_key} if api_key else None
+            response = self.session.post(self.url, json=payload, headers=headers, timeout=self.timeout)
+        except Exception as e:
+            raise TTSError(f"Gemini TTS request failed: {e}") from e
+        if response.status_code == 429:
+            # The body carries the retry delay, which key_pool.retry_after reads
+            raise RateLimitedError(f"Gemini TTS returned HTTP 429: {response.text[:500]}")
+        if response.status_code != 200:
+            raise TTSError(f"Gemini TTS returned HTTP {response.status_code}")
+
+        try:
+            inline = response.json()['candidates'][0]['content']['parts'][0]['inlineData']
+            mimetype = inline['mimeType']
+            pcm = base64.b64decode(inline['data'])
+        except (KeyError, IndexError, ValueError) as e:
+            raise TTSError(f"Unexpected Gemini TTS response: {e}") from e
+        if not mimetype.startswith('audio/L16'):
+            raise TTSError(f"Unsupported Gemini audio format: {mimetype}")
+
+        return audio.pcm16_from_bytes(pcm), audio.parse_pcm_mimetype(mimetype)
+
+
+_gemini_tts = None
+
+
+def get_gemini_tts():
+    """Shared Gemini TTS client, or None when the key pool is empty"""
+    global _gemini_tts
+    if not key_pool.get_key_pool():
+        return None
+    if _gemini_tts is None:
+        _gemini_tts = GeminiTTSClient()
+    return _gemini_tts
+
+
+# --- Engine routing ---
+QUALITY_LEVELS = {'low': 1, 'standard': 2, 'high': 3}
+ROUTER_WINDOW = 50             # calls kept per engine for p95 latency and error rate
+ROUTER_MAX_ERROR_RATE = 0.5    # above this (over the window) an engine is unhealthy...
+ROUTER_COOLDOWN = 30.0         # ...until this many seconds after its last failure
+ROUTER_MIN_CALLS = 3           # errors needed before health is judged at all
+
+
+class NoEngineError(TTSError):
+    """No registered engine can serve the request"""
+
+
+class TTSEngine:
+    """A speech engine plus the metadata the router ranks it by.
+
+    styles: voice styles it can render (None for all); quality: 1-3, see
+    QUALITY_LEVELS; cost_per_1k_chars: USD, used to break latency ties;
+    expected_latency: seconds per sentence, used until real calls are timed.
+    """
+    name = 'engine'
+    styles = None
+    quality = 1
+    cost_per_1k_chars = 0.0
+    expected_latency = 1.0
+
+    def available(self):
+        return True
+
+    def supports(self, voice_style, min_quality):
+        return self.quality >= min_quality and (self.styles is None or voice_style in self.styles)
+
+    def synthesize(self, text, voice_style):
+        """Return (int16 samples, sample rate)"""
+        raise NotImplementedError
+
+
+class PiperEngine(TTSEngine):
+    name = 'piper'
+    quality = 2
+    expected_latency = 0.2
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.name = f"piper:{os.path.splitext(os.path.basename(model_path))[0]}"
+
+    def synthesize(self, text, voice_style):
+        return get_piper_batcher().synthesize(self.model_path, text)
+
+
+class GeminiEngine(TTSEngine):
+    name = 'gemini'
+    styles = frozenset(GEMINI_TTS_VOICES)
+    quality = 3
+    cost_per_1k_chars = 0.01
+    expected_latency = 1.5
+
+    def available(self):
+        return get_gemini_tts() is not None
+
+    def synthesize(self, text, voice_style):
+        client = get_gemini_tts()
+        if client is None:
+            raise TTSError("No Gemini API key configured")
+        keys, tried = key_pool.get_key_pool(), []
+        while True:
+            try:
+                lease = keys.acquire(exclude=tried)
+            except key_pool.KeysExhausted as e:
+                raise TTSError(str(e)) from e
+            try:
+                result = client.synthesize(text, GEMINI_TTS_VOICES.get(voice_style, 'Kore'), lease.api_key.key)
+            except RateLimitedError as e:
+                # Cool this key down and try the next one
+                keys.rate_limited(lease, key_pool.retry_after(e))
+                tried.append(lease.api_key)
+                continue
+            except TTSError:
+                keys.failed(lease)
+                raise
+            keys.succeeded(lease)
+            return result
+
+
+class GTTSEngine(TTSEngine):
+    """Google Translate TTS: free and remote, returns MP3"""
+    name = 'gtts'
+    quality = 1
+    expected_latency = 1.0
+
+    def synthesize(self, text, voice_style):
+        import soundfile as sf
+        from gtts import gTTS
+        buffer = io.BytesIO()
+        try:
+            gTTS(text, lang='en').write_to_fp(buffer)
+        except Exception as e:
+            raise TTSError(f"gTTS request failed: {e}") from e
+        buffer.seek(0)
+        samples, rate = sf.read(buffer, dtype='int16')
+        return (samples if samples.ndim == 1 else samples[:, 0]), rate
+
+
+class Pyttsx3Engine(TTSEngine):
+    """The OS speech engine; offline but single-threaded and file based"""
+    name = 'pyttsx3'
+    quality = 1
+    expected_latency = 2.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def synthesize(self, text, voice_style):
+        import tempfile
+        import pyttsx3
+        import soundfile as sf
+        with self._lock, tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'speech.wav')
+            engine = pyttsx3.init()
+            engine.save_to_file(text, path)
+            engine.runAndWait()
+            if not os.path.exists(path):
+                raise TTSError("pyttsx3 produced no audio")
+            samples, rate = sf.read(path, dtype='int16')
+        return (samples if samples.ndim == 1 else samples[:, 0]), rate
+
+
+class EngineStats:
+    """Rolling latency and outcome window for one engine"""
+
+    def __init__(self, window=ROUTER_WINDOW):
+        self.latencies = collections.deque(maxlen=window)
+        self.outcomes = collections.deque(maxlen=window)  # True for success
+        self.last_failure = 0.0
+        self.calls = 0
+        self.probing = False        # a half-open probe call is in flight
+
+    def record(self, seconds, ok):
+        self.calls += 1
+        self.probing = False
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(seconds)
+        else:
+            self.last_failure = time.monotonic()
+
+    def p95(self, default):
+        if not self.latencies:
+            return default
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def tripped(self):
+        return len(self.outcomes) >= ROUTER_MIN_CALLS and self.error_rate() > ROUTER_MAX_ERROR_RATE
+
+    def healthy(self):
+        if not self.tripped():
+            return True
+        # Half-open: after the cooldown one request at a time may try the engine again
+        return not self.probing and time.monotonic() - self.last_failure > ROUTER_COOLDOWN
+
+    def admit(self):
+        """Whether a call may go to the engine now; claims the half-open probe when it is free"""
+        if not self.tripped():
+            return True
+        if self.healthy():
+            self.probing = True
+            return True
+        return False
+
+
+def _min_quality(quality):
+    return QUALITY_LEVELS.get(quality, quality) if isinstance(quality, str) else quality
+
+
+class TTSRouter:
+    """Sends each sentence to the fastest healthy engine that fits the request.
+
+    Engines are ranked by rolling p95 latency (their expected_latency until
+    they have been timed), then cost. A reply is synthesized sentence by
+    sentence and stays on one engine while it works; if that engine fails
+    mid-reply, the remaining sentences fail over to the next engine and are
+    resampled to the rate the reply started with.
+    """
+
+    def __init__(self):
+        self.engines = []
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def register(self, engine):
+        self.engines.append(engine)
+        self._stats[engine.name] = EngineStats()
+        return engine
+
+    def rank(self, voice_style='natural', min_quality=1):
+        """Capable, available engines, best first; unhealthy ones only as a last resort"""
+        with self._lock:
+            scored = [
+                (not self._stats[engine.name].healthy(),
+                 self._stats[engine.name].p95(engine.expected_latency),
+                 engine.cost_per_1k_chars,
+                 index, engine)
+                for index, engine in enumerate(self.engines)
+                if engine.supports(voice_style, min_quality) and engine.available()
+            ]
+        return [entry[-1] for entry in sorted(scored)]
+
+    def available(self, voice_style='natural', quality='standard'):
+        return bool(self.rank(voice_style, _min_quality(quality)))
+
+    def _attempts(self, engines):
+        """engines in order, except that unhealthy ones (open, or being probed
+        by another request) wait until the others have failed"""
+        held = []
+        for engine in list(engines):
+            with self._lock:
+                admitted = self._stats[engine.name].admit()
+            if admitted:
+                yield engine
+            else:
+                held.append(engine)
+        yield from held
+
+    def _call(self, engine, text, voice_style):
+        started = time.perf_counter()
+        try:
+            result = engine.synthesize(text, voice_style)
+        except Exception:
+            with self._lock:
+                self._stats[engine.name].record(time.perf_counter() - started, False)
+            raise
+        with self._lock:
+            self._stats[engine.name].record(time.perf_counter() - started, True)
+        return result
+
+    def synthesize(self, text, voice_style='natural', quality='standard'):
+        """Return (int16 samples, sample rate, names of the engines used)"""
+        import numpy as np
+
+        engines = self.rank(voice_style, _min_quality(quality))
+        if not engines:
+            raise NoEngineError(f"No TTS engine for style {voice_style!r} at quality {quality!r}")
+
+        parts, sample_rate, used = [], None, []
+        for sentence in audio.split_sentences(text) or [text]:
+            for engine in self._attempts(engines):
+                try:
+                    samples, rate = self._call(engine, sentence, voice_style)
+                    break
+                except Exception as e:
+                    print(f"⚠️ TTS engine {engine.name} failed, failing over: {e}")
+                    engines.remove(engine)
+            else:
+                raise TTSError("Every TTS engine failed")
+
+            if sample_rate is None:
+                sample_rate = rate
+            elif rate != sample_rate:
+                samples = audio.resample(samples, rate, sample_rate)
+            parts.append(samples)
+            if engine.name not in used:
+                used.append(engine.name)
+
+        return np.concatenate(parts), sample_rate, used
+
+    def stats(self):
+        with self._lock:
+            return {
+                engine.name: {
+                    'quality': engine.quality,
+                    'cost_per_1k_chars': engine.cost_per_1k_chars,
+                    'calls': self._stats[engine.name].calls,
+                    'p95_ms': round(1000 * self._stats[engine.name].p95(engine.expected_latency), 1),
+                    'error_rate': round(self._stats[engine.name].error_rate(), 3),
+                    'healthy': self._stats[engine.name].healthy(),
+                }
+                for engine in self.engines
+            }
+
+
+_router = None
+
+
+def _module_available(name):
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+
+def get_tts_router():
+    """Per-process router over every engine installed/configured here"""
+    global _router
+    if _router is None:
+        router = TTSRouter()
+        for model_path in configured_models():
+            router.register(PiperEngine(model_path))
+        router.register(GeminiEngine())
+        if _module_available('gtts'):
+            router.register(GTTSEngine())
+        if _module_available('pyttsx3'):
+            router.register(Pyttsx3Engine())
+        _router = router
+    return _router
+
+
+# --- Acknowledgement clips ---
+# Played the moment a chat message is sent, to cover the time the LLM takes.
+# Rendered once per phrase (then cached on disk), so serving one costs no synthesis.
+ACK_CACHE_DIR = os.getenv('ACK_CACHE_DIR', 'ack_clips')
+ACK_PHRASES = {
+    'natural': {
+        True: ("Hmm, let me think...", "Oh, good question...", "Umm, let's see..."),
+        False: ("Let me think.", "Good question.", "One moment."),
+    },
+    'warm': {
+        True: ("Aww, hmm, let me think...", "Oh, I hear you...", "Mmm, okay..."),
+        False: ("I hear you.", "Let me think about that.", "Of course."),
+    },
+    'energetic': {
+        True: ("Ooh, okay, okay...", "Oh wow, hmm...", "Ooh, let me see!"),
+        False: ("Great question!", "Okay, let's see!", "Love it!"),
+    },
+    'calm': {
+        True: ("Mmm... let me think.", "Hmm... I see.", "Ah... okay."),
+        False: ("Let me think.", "I see.", "Alright."),
+    },
+    'playful': {
+        True: ("Hmm hmm, let me see...", "Ooh, tricky one...", "Heh, okay..."),
+        False: ("Ooh, fun question!", "Let me see!", "Challenge accepted!"),
+    },
+}
+
+ack_ready = threading.Event()
+
+
+class AckBank:
+    """Pre-rendered acknowledgement clips per (voice style, use_fillers)"""
+
+    def __init__(self, cache_dir=ACK_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self._clips = {}  # (style, use_fillers) -> [(text, int16 samples, rate)]
+
+    def _path(self, style, text):
+        import hashlib
+        digest = hashlib.sha1(f"{style}|{text}".encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{style}-{digest}.wav")
+
+    def _load_or_render(self, style, text, render):
+        import soundfile as sf
+        path = self._path(style, text)
+        if os.path.exists(path):
+            samples, rate = sf.read(path, dtype='int16')
+            return samples, rate
+
+        samples, rate = render(text, style)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Other workers may be rendering the same clip: write, then rename
+        temporary = f"{path}.{os.getpid()}.tmp"
+        sf.write(temporary, samples, rate, format='WAV', subtype='PCM_16')
+        os.replace(temporary, path)
+        return samples, rate
+
+    def build(self, render):
+        """Load or render every phrase; render(text, style) -> (int16 samples, rate)"""
+        for style, by_fillers in ACK_PHRASES.items():
+            for use_fillers, phrases in by_fillers.items():
+                clips = []
+                for text in phrases:
+                    try:
+                        clips.append((text, *self._load_or_render(style, text, render)))
+                    except Exception as e:
+                        print(f"⚠️ Acknowledgement clip failed ({style}: {text}): {e}")
+                self._clips[(style, use_fillers)] = clips
+
+    def pick(self, style, use_fillers):
+        """(text, samples, rate) for a random clip, or None if none are ready"""
+        clips = self._clips.get((style, bool(use_fillers))) or self._clips.get(('natural', bool(use_fillers)))
+        return random.choice(clips) if clips else None
+
+
+ack_bank = AckBank()
+_ack_thread = None
+
+
+def start_ack_bank(render):
+    """Build the acknowledgement bank in a daemon thread once voices are warm"""
+    global _ack_thread
+
+    def build():
+        warmup_done.wait()
+        ack_bank.build(render)
+        ack_ready.set()
+
+    with _voices_lock:
+        if _ack_thread is None:
+            _ack_thread = threading.Thread(target=build, name='ack-bank', daemon=True)
+            _ack_thread.start()
+    return _ack_thread